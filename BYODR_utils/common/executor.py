@@ -0,0 +1,139 @@
+from __future__ import absolute_import
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from BYODR_utils.common.latency import LatencyTracker, new_trace, stamp_trace
+
+logger = logging.getLogger(__name__)
+
+
+class CoalescingExecutor(object):
+    """
+    Runs tasks in the background on at most a fixed number of threads.
+    A task identical to one still waiting in the queue, the same callable with the same arguments, is dropped and so is a task beyond the queue size.
+    Both are counted and the tasks dropped for the queue size are logged.
+    Threads are started on demand and exit after being idle for a while. The arguments must be hashable.
+    """
+
+    def __init__(self, max_workers=1, max_pending=32, idle_seconds=10.0, report_seconds=60):
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        self._idle_seconds = idle_seconds
+        self._report_seconds = report_seconds
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._keys = set()
+        self._num_workers = 0
+        self._num_idle = 0
+        self._quit = False
+        self._counts = collections.Counter()
+        self._reported = None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                if not self._queue and not self._quit:
+                    self._num_idle += 1
+                    self._condition.wait(self._idle_seconds)
+                    self._num_idle -= 1
+                if self._quit or not self._queue:
+                    self._num_workers -= 1
+                    return
+                key, fn, args = self._queue.popleft()
+                self._keys.discard(key)
+            try:
+                fn(*args)
+            except Exception:
+                logger.error("Background task {} failed: {}".format(getattr(fn, "__name__", fn), traceback.format_exc()))
+
+    def _drop(self, fn):
+        # Called with the condition held, the log is limited to one line per report period.
+        self._counts["dropped"] += 1
+        _now = time.time()
+        if self._reported is None or _now - self._reported > self._report_seconds:
+            self._reported = _now
+            logger.warning("Dropped background task {} with {} tasks pending, {} dropped so far.".format(getattr(fn, "__name__", fn), len(self._queue), self._counts["dropped"]))
+
+    def submit(self, fn, *args):
+        """Returns whether the task was queued."""
+        key = (fn,) + args
+        with self._condition:
+            if self._quit:
+                return False
+            if key in self._keys:
+                self._counts["coalesced"] += 1
+                return False
+            if len(self._queue) >= self._max_pending:
+                self._drop(fn)
+                return False
+            self._keys.add(key)
+            self._queue.append((key, fn, args))
+            if self._num_idle < len(self._queue) and self._num_workers < self._max_workers:
+                self._num_workers += 1
+                _thread = threading.Thread(target=self._work)
+                _thread.daemon = True
+                _thread.start()
+            self._condition.notify()
+            return True
+
+    def get_num_pending(self):
+        with self._condition:
+            return len(self._queue)
+
+    def get_metrics(self):
+        with self._condition:
+            _metrics = dict(self._counts)
+            _metrics["pending"] = len(self._queue)
+        return _metrics
+
+    def quit(self):
+        """Drops the waiting tasks, running tasks finish on their own."""
+        with self._condition:
+            self._quit = True
+            self._queue.clear()
+            self._keys.clear()
+            self._condition.notify_all()
+
+
+class TimedExecutor(object):
+    """
+    Runs the blocking calls of the web handlers on a fixed number of threads off the event loop.
+    Keeps the time each call waited for a thread and ran by name.
+    """
+
+    def __init__(self, max_workers=4, maxlen=1000):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._maxlen = maxlen
+        self._lock = threading.Lock()
+        self._trackers = collections.OrderedDict()
+
+    def _tracker(self, name):
+        with self._lock:
+            if name not in self._trackers:
+                self._trackers[name] = LatencyTracker(stages=("queue", "run"), maxlen=self._maxlen)
+            return self._trackers[name]
+
+    def _call(self, name, trace, fn, args):
+        _trace = stamp_trace(trace, "run")
+        try:
+            return fn(*args)
+        finally:
+            self._tracker(name).record(_trace, end_stage="done")
+
+    def run(self, name, fn, *args):
+        """Returns the future of the result to await on the event loop of the calling thread."""
+        return asyncio.wrap_future(self._executor.submit(self._call, name, new_trace("queue"), fn, args))
+
+    def get_metrics(self):
+        with self._lock:
+            _trackers = list(self._trackers.items())
+        return collections.OrderedDict((name, tracker.summary()) for name, tracker in _trackers)
+
+    def quit(self):
+        self._executor.shutdown(wait=False)
@@ -4,16 +4,19 @@ import collections
 import datetime
 import json
 import logging
+import mmap
 import multiprocessing
 import os
 import sys
 import threading
 import time
+import traceback
 
 import numpy as np
 import zmq
 
 from BYODR_utils.common import timestamp
+from BYODR_utils.common.latency import new_trace
 
 if sys.version_info > (3,):
     # noinspection PyShadowingBuiltins
@@ -34,11 +37,68 @@ else:
         return sender.send(val, flags)
 
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 logger = logging.getLogger(__name__)
 
 
+class JSONCodec(object):
+    name = b"json"
+
+    @staticmethod
+    def encode(data):
+        return json.dumps(data).encode("utf-8")
+
+    @staticmethod
+    def decode(payload):
+        return json.loads(payload)
+
+
+class MsgPackCodec(object):
+    name = b"msgpack"
+
+    @staticmethod
+    def encode(data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    @staticmethod
+    def decode(payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+_codecs = dict((c.name, c) for c in ([JSONCodec] + ([] if msgpack is None else [MsgPackCodec])))
+
+
+def get_codec(name):
+    """The json codec is the fallback for codecs that are not installed."""
+    _name = name.encode("utf-8") if isinstance(name, str) else name
+    if _name not in _codecs:
+        logger.warning("Codec '{}' is not available - using json instead.".format(name))
+    return _codecs.get(_name, JSONCodec)
+
+
+def decode_message(frames):
+    """
+    Messages are either the single frame 'topic:json' string or the multipart topic, codec name and payload frames.
+    Returns None for payloads in a codec that is not installed.
+    """
+    if len(frames) == 1:
+        return json.loads(frames[0].decode("utf-8").split(":", 1)[1])
+    codec = _codecs.get(frames[1])
+    if codec is None:
+        logger.warning("Dropped message with unknown codec '{}'.".format(frames[1]))
+        return None
+    return codec.decode(frames[2])
+
+
 class JSONPublisher(object):
-    def __init__(self, url, topic="", hwm=1, clean_start=True):
+    def __init__(self, url, topic="", hwm=1, clean_start=True, codec=None):
+        """
+        :param codec: Name of the codec for the multipart message format e.g. 'msgpack'. The default is the 'topic:json' string message.
+        """
         if clean_start and url.startswith("ipc://") and os.path.exists(url[6:]):
             os.remove(url[6:])
         publisher = zmq.Context().socket(zmq.PUB)
@@ -46,12 +106,16 @@ class JSONPublisher(object):
         publisher.bind(url)
         self._publisher = publisher
         self._topic = topic
+        self._codec = None if codec is None else get_codec(codec)
 
     def publish(self, data, topic=None):
         _topic = self._topic if topic is None else topic
         if data is not None:
             data = dict((k, v) for k, v in data.items() if v is not None)
-            send_string(self._publisher, "{}:{}".format(_topic, json.dumps(data)), zmq.NOBLOCK)
+            if self._codec is None:
+                send_string(self._publisher, "{}:{}".format(_topic, json.dumps(data)), zmq.NOBLOCK)
+            else:
+                self._publisher.send_multipart([_topic.encode("utf-8"), self._codec.name, self._codec.encode(data)], flags=zmq.NOBLOCK)
 
 
 class ImagePublisher(object):
@@ -66,17 +130,117 @@ class ImagePublisher(object):
 
     def publish(self, _img, topic=None):
         _topic = self._topic if topic is None else topic.encode("utf-8")
+        _time = timestamp()
         # json.dumps(...) returns a string, it needs to be encoded into bytes.
         self._publisher.send_multipart(
             [
                 _topic,
-                json.dumps(dict(time=timestamp(), shape=_img.shape)).encode("utf-8"),
+                json.dumps(dict(time=_time, shape=_img.shape, trace=new_trace("camera", _time))).encode("utf-8"),
                 np.ascontiguousarray(_img, dtype=np.uint8),
             ],
             flags=zmq.NOBLOCK,
         )
 
 
+def _shared_image_path(url):
+    # The ring file is placed next to the ipc socket which is on the tmpfs volume shared by the service containers.
+    return os.path.splitext(url[6:])[0] + ".shm" if url.startswith("ipc://") else None
+
+
+class SharedImageRing(object):
+    """
+    Fixed number of image slots in a memory-mapped file.
+    The file starts with a page of slot headers, one 64-bit sequence number per slot, followed by the slots themselves.
+    A header is set to -1 while its slot is written and to the sequence number of the frame once the slot is complete.
+    The readers copy the slot and compare the header to the sequence number in the frame metadata before and after the copy,
+    a frame whose slot was written to in the meantime is discarded.
+    """
+
+    _page = 4096
+
+    def __init__(self, path, num_slots, slot_size, writable=False):
+        self._num_slots = num_slots
+        self._slot_size = slot_size
+        self._data_offset = max(self._page, -(-(num_slots * 8) // self._page) * self._page)
+        _file_size = self._data_offset + num_slots * slot_size
+        if writable:
+            # Replace rather than truncate the file as readers may still have the previous ring mapped.
+            _tmp = path + ".tmp"
+            with open(_tmp, "w+b") as f:
+                f.truncate(_file_size)
+                self._mm = mmap.mmap(f.fileno(), _file_size, access=mmap.ACCESS_WRITE)
+            os.rename(_tmp, path)
+        else:
+            with open(path, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), _file_size, access=mmap.ACCESS_READ)
+        self._headers = np.frombuffer(self._mm, dtype=np.int64, count=num_slots)
+
+    def get_num_slots(self):
+        return self._num_slots
+
+    def get_slot_size(self):
+        return self._slot_size
+
+    def _slot(self, sequence, shape):
+        _slot = sequence % self._num_slots
+        _offset = self._data_offset + _slot * self._slot_size
+        return _slot, np.frombuffer(self._mm, dtype=np.uint8, count=int(np.prod(shape)), offset=_offset).reshape(shape)
+
+    def write(self, sequence, image):
+        _slot, _view = self._slot(sequence, image.shape)
+        self._headers[_slot] = -1
+        np.copyto(_view, image, casting="unsafe")
+        self._headers[_slot] = sequence
+        return _slot
+
+    def read(self, sequence, shape):
+        """Returns a copy of the frame or None when the slot no longer holds the frame."""
+        _slot, _view = self._slot(sequence, shape)
+        if self._headers[_slot] != sequence:
+            return None
+        _image = np.array(_view)
+        # The writer may have started on the slot while it was copied.
+        return _image if self._headers[_slot] == sequence else None
+
+
+class SharedMemoryImagePublisher(ImagePublisher):
+    """
+    Writes the images once to a shared memory ring and publishes only the slot metadata.
+    Subscribers on the same host map the ring and each take their own copy of an image instead of receiving it over the socket.
+    The ring belongs on a tmpfs, a file on disk has the kernel write back every frame.
+    Urls other than ipc fall back to the multipart image message.
+    """
+
+    def __init__(self, url, topic="", hwm=1, clean_start=True, num_slots=8):
+        super(SharedMemoryImagePublisher, self).__init__(url, topic=topic, hwm=hwm, clean_start=clean_start)
+        self._path = _shared_image_path(url)
+        self._num_slots = num_slots
+        self._ring = None
+        self._ring_id = None
+        self._sequence = 0
+
+    def _ensure_ring(self, num_bytes):
+        # The slot size follows the largest image published so far.
+        # The previous ring is unmapped once the last view on it is released.
+        if self._ring is None or self._ring.get_slot_size() < num_bytes:
+            _slot_size = -(-num_bytes // 64) * 64
+            self._ring = SharedImageRing(self._path, self._num_slots, _slot_size, writable=True)
+            self._ring_id = timestamp()
+            logger.info("Created shared image ring '{}' with {} slots of {} bytes.".format(self._path, self._num_slots, _slot_size))
+        return self._ring
+
+    def publish(self, _img, topic=None):
+        if self._path is None:
+            return super(SharedMemoryImagePublisher, self).publish(_img, topic=topic)
+        _topic = self._topic if topic is None else topic.encode("utf-8")
+        _ring = self._ensure_ring(_img.nbytes)
+        self._sequence += 1
+        _slot = _ring.write(self._sequence, _img)
+        _time = timestamp()
+        md = dict(time=_time, shape=_img.shape, trace=new_trace("camera", _time), ring=self._ring_id, slots=_ring.get_num_slots(), slot_size=_ring.get_slot_size(), slot=_slot, sequence=self._sequence)
+        self._publisher.send_multipart([_topic, json.dumps(md).encode("utf-8")], flags=zmq.NOBLOCK)
+
+
 class JSONReceiver(object):
     def __init__(self, url, topic=b"", hwm=1, receive_timeout_ms=2, pop=False):
         subscriber = zmq.Context().socket(zmq.SUB)
@@ -85,6 +249,7 @@ class JSONReceiver(object):
         subscriber.setsockopt(zmq.LINGER, 0)
         subscriber.connect(url)
         subscriber.setsockopt(zmq.SUBSCRIBE, topic)
+        self.url = url
         self._pop = pop
         self._unpack = hwm == 1
         self._subscriber = subscriber
@@ -95,10 +260,27 @@ class JSONReceiver(object):
         with self._lock:
             try:
                 # Does not replace local queue messages when none are available.
-                self._queue.appendleft(json.loads(receive_string(self._subscriber).split(":", 1)[1]))
+                _message = decode_message(self._subscriber.recv_multipart())
+                if _message is not None:
+                    self._queue.appendleft(_message)
             except zmq.Again:
                 pass
 
+    def drain(self):
+        # Consume all available messages without blocking.
+        with self._lock:
+            while True:
+                try:
+                    _message = decode_message(self._subscriber.recv_multipart(zmq.NOBLOCK))
+                    if _message is not None:
+                        self._queue.appendleft(_message)
+                except zmq.Again:
+                    break
+
+    @property
+    def socket(self):
+        return self._subscriber
+
     def get(self):
         _view = self._queue[0] if (self._queue and self._unpack) else list(self._queue) if self._queue else None
         if self._pop:
@@ -139,6 +321,48 @@ def json_collector(url, topic, event, receive_timeout_ms=1000, hwm=1, pop=False)
     return CollectorThread(JSONReceiver(url, topic, hwm=hwm, receive_timeout_ms=receive_timeout_ms, pop=pop), event=event)
 
 
+class PollingCollectorThread(threading.Thread):
+    """
+    Single thread for all the receivers of a process. Receivers are drained when their socket becomes readable.
+    Add the receivers before the thread is started.
+    """
+
+    def __init__(self, receivers=(), event=None, poll_timeout_ms=100):
+        super(PollingCollectorThread, self).__init__()
+        self._receivers = []
+        self._quit_event = multiprocessing.Event() if event is None else event
+        self._poll_timeout_ms = poll_timeout_ms
+        list(map(self.add, receivers))
+
+    def add(self, receiver):
+        self._receivers.append(receiver)
+        return receiver
+
+    def get(self, index=0):
+        return self._receivers[index].get()
+
+    def peek(self, index=0):
+        return self._receivers[index].peek()
+
+    def quit(self):
+        self._quit_event.set()
+
+    def run(self):
+        poller = zmq.Poller()
+        _sockets = {}
+        for receiver in self._receivers:
+            poller.register(receiver.socket, zmq.POLLIN)
+            _sockets[receiver.socket] = receiver
+        while not self._quit_event.is_set():
+            # The timeout bounds the time to notice the quit event.
+            for socket, _ in poller.poll(self._poll_timeout_ms):
+                # A malformed message must not stop the thread that serves all the other receivers.
+                try:
+                    _sockets[socket].drain()
+                except Exception:
+                    logger.error("Failed to receive from '{}': {}".format(_sockets[socket].url, traceback.format_exc()))
+
+
 class ReceiverThread(threading.Thread):
     def __init__(self, url, event=None, topic=b"", hwm=1, receive_timeout_ms=1):
         super(ReceiverThread, self).__init__()
@@ -168,9 +392,10 @@ class ReceiverThread(threading.Thread):
     def run(self):
         while not self._quit_event.is_set():
             try:
-                _latest = json.loads(receive_string(self._subscriber).split(":", 1)[1])
-                self._queue.appendleft(_latest)
-                list(map(lambda x: x(_latest), self._listeners))
+                _latest = decode_message(self._subscriber.recv_multipart())
+                if _latest is not None:
+                    self._queue.appendleft(_latest)
+                    list(map(lambda x: x(_latest), self._listeners))
             except zmq.Again:
                 pass
 
@@ -187,20 +412,40 @@ class CameraThread(threading.Thread):
         self._subscriber = subscriber
         self._quit_event = event
         self._images = collections.deque(maxlen=1)
+        self._ring_path = _shared_image_path(url)
+        self._ring = None
+        self._ring_id = None
+        self._listeners = []
+
+    def add_listener(self, c):
+        """The listeners are called with the metadata and image of each frame on the camera thread."""
+        self._listeners.append(c)
 
     def capture(self):
         return self._images[0] if bool(self._images) else (None, None)
 
+    def _shared_image(self, md):
+        # The ring hands out copies so the consumers may keep the images for as long as they like.
+        if self._ring is None or self._ring_id != md["ring"]:
+            self._ring = SharedImageRing(self._ring_path, md["slots"], md["slot_size"])
+            self._ring_id = md["ring"]
+        return self._ring.read(md["sequence"], tuple(md["shape"]))
+
     def run(self):
         while not self._quit_event.is_set():
             try:
-                [_, md, data] = self._subscriber.recv_multipart()
-                md = json.loads(md)
-                height, width, channels = md["shape"]
-                img = np.frombuffer(buffer(data), dtype=np.uint8)
-                img = img.reshape((height, width, channels))
-                self._images.appendleft((md, img))
-            except ValueError as e:
+                frames = self._subscriber.recv_multipart()
+                md = json.loads(frames[1])
+                if len(frames) > 2:
+                    height, width, channels = md["shape"]
+                    img = np.frombuffer(buffer(frames[2]), dtype=np.uint8)
+                    img = img.reshape((height, width, channels))
+                else:
+                    img = self._shared_image(md)
+                if img is not None:
+                    self._images.appendleft((md, img))
+                    list(map(lambda x: x(md, img), self._listeners))
+            except (IOError, ValueError) as e:
                 logger.warning(e)
             except zmq.Again:
                 pass
@@ -251,12 +496,19 @@ class LocalIPCServer(JSONServerThread):
         self._name = name
         self._m_startup = collections.deque(maxlen=1)
         self._m_capabilities = collections.deque(maxlen=1)
+        self._f_latency = None
+
+    def register_latency(self, fn_summary):
+        self._f_latency = fn_summary
 
     def register_start(self, errors, capabilities=None):
         capabilities = {} if capabilities is None else capabilities
         self._m_startup.append((datetime.datetime.utcnow().strftime("%b %d %H:%M:%S.%s UTC"), errors))
         self._m_capabilities.append(capabilities)
 
+    def register_capabilities(self, capabilities):
+        self._m_capabilities.append({} if capabilities is None else capabilities)
+
     def serve(self, message):
         try:
             if message.get("request") == "system/startup/list" and self._m_startup:
@@ -269,6 +521,8 @@ class LocalIPCServer(JSONServerThread):
                 return {self._name: {ts: messages}}
             elif message.get("request") == "system/service/capabilities" and self._m_capabilities:
                 return {self._name: self._m_capabilities[-1]}
+            elif message.get("request") == "system/service/latency" and self._f_latency is not None:
+                return {self._name: self._f_latency()}
         except IndexError:
             pass
         return {}
@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+
+import collections
+import threading
+
+import numpy as np
+
+from BYODR_utils.common import timestamp
+
+# The pipeline stages in order of occurrence. Each stage stamps the trace with its own timestamp.
+TRACE_STAGES = ("camera", "capture", "inference", "pilot", "relay")
+
+
+def new_trace(stage, ts=None):
+    return {stage: timestamp() if ts is None else ts}
+
+
+def stamp_trace(trace, stage, ts=None):
+    """Returns a copy of the trace with the stage added or None when there is no trace to propagate."""
+    if trace is None:
+        return None
+    _trace = dict(trace)
+    _trace[stage] = timestamp() if ts is None else ts
+    return _trace
+
+
+class LatencyTracker(object):
+    """
+    Collects the durations between consecutive trace stages and reports the percentiles in milliseconds.
+    Durations measured by a remote partner, with its own clock, are recorded as is.
+    """
+
+    def __init__(self, stages=TRACE_STAGES, maxlen=1000):
+        self._stages = stages
+        self._maxlen = maxlen
+        self._lock = threading.Lock()
+        self._samples = collections.OrderedDict()
+
+    def _add(self, name, duration_micro):
+        if name not in self._samples:
+            self._samples[name] = collections.deque(maxlen=self._maxlen)
+        self._samples[name].append(duration_micro * 1e-3)
+
+    def record(self, trace, remote=None, end_stage="return", ts=None):
+        if not trace:
+            return
+        _ts = timestamp() if ts is None else ts
+        _present = [s for s in self._stages if s in trace]
+        with self._lock:
+            for previous, current in zip(_present, _present[1:]):
+                self._add("{}>{}".format(previous, current), trace[current] - trace[previous])
+            if _present:
+                self._add("{}>{}".format(_present[-1], end_stage), _ts - trace[_present[-1]])
+                self._add("total", _ts - trace[_present[0]])
+            for name, duration in (remote or {}).items():
+                self._add(name, duration)
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+    def summary(self):
+        with self._lock:
+            _items = [(name, np.array(values)) for name, values in self._samples.items() if values]
+        return dict((name, dict(n=len(values), p50=float(np.percentile(values, 50)), p95=float(np.percentile(values, 95)), p99=float(np.percentile(values, 99)))) for name, values in _items)
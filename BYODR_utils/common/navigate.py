@@ -1,16 +1,16 @@
 from __future__ import absolute_import
 
-import glob
+import collections
 import json
 import logging
 import multiprocessing
 import os
 import threading
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
 from BYODR_utils.common import timestamp
 
-
 logger = logging.getLogger(__name__)
 
 
@@ -104,9 +104,13 @@ class AbstractRouteDataSource(object):
         raise NotImplementedError()
 
     @abstractmethod
-    def load_routes(self):
+    def load_routes(self, force=False):
         raise NotImplementedError()
 
+    def is_watched(self):
+        """Whether a directory watcher keeps the list of routes current."""
+        return False
+
     @abstractmethod
     def list_routes(self):
         raise NotImplementedError()
@@ -115,8 +119,12 @@ class AbstractRouteDataSource(object):
     def get_selected_route(self):
         raise NotImplementedError()
 
+    def load_route(self, route_name):
+        """Reads the route ahead of opening it, sources that do not support this return None."""
+        return None
+
     @abstractmethod
-    def open(self, route_name=None):
+    def open(self, route_name=None, state=None):
         raise NotImplementedError()
 
     @abstractmethod
@@ -143,6 +151,10 @@ class AbstractRouteDataSource(object):
     def list_all_images(self):
         raise NotImplementedError()
 
+    @abstractmethod
+    def list_all_image_files(self):
+        raise NotImplementedError()
+
     @abstractmethod
     def get_image(self, image_id):
         raise NotImplementedError()
@@ -160,22 +172,152 @@ class AbstractRouteDataSource(object):
         raise NotImplementedError()
 
 
+class ImageCache(object):
+    """
+    Least recently used cache of loaded images bounded by the total number of bytes of the images.
+    Prefetches run on a single background thread.
+    """
+
+    def __init__(self, fn_load_image=(lambda x: x), max_bytes=(32 << 20)):
+        self._fn_load_image = fn_load_image
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._images = collections.OrderedDict()
+        self._num_bytes = 0
+        self._pending = set()
+        self._executor = None
+        self._quit = False
+
+    @staticmethod
+    def _size(image):
+        return getattr(image, "nbytes", 0)
+
+    def _put(self, fname, image):
+        with self._lock:
+            if fname in self._images:
+                return
+            self._images[fname] = image
+            self._num_bytes += self._size(image)
+            while self._num_bytes > self._max_bytes and len(self._images) > 1:
+                _, _evicted = self._images.popitem(last=False)
+                self._num_bytes -= self._size(_evicted)
+
+    def _load(self, fname):
+        try:
+            self._put(fname, self._fn_load_image(fname))
+        except Exception as e:
+            logger.warning("Unable to load image '{}': {}".format(fname, e))
+        finally:
+            with self._lock:
+                self._pending.discard(fname)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._images)
+
+    def get_num_bytes(self):
+        with self._lock:
+            return self._num_bytes
+
+    def get(self, fname):
+        with self._lock:
+            if fname in self._images:
+                self._images.move_to_end(fname)
+                return self._images[fname]
+        image = self._fn_load_image(fname)
+        self._put(fname, image)
+        return image
+
+    def prefetch(self, fnames):
+        with self._lock:
+            # The images are still loaded on request after quit but no longer ahead of time.
+            if self._quit:
+                return
+            _missing = [f for f in fnames if f not in self._images and f not in self._pending]
+            self._pending.update(_missing)
+            if _missing and self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            # Submitted under the lock so a concurrent quit cannot shut the executor down in between.
+            [self._executor.submit(self._load, f) for f in _missing]
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._num_bytes = 0
+
+    def quit(self):
+        with self._lock:
+            self._quit = True
+            _executor, self._executor = self._executor, None
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+
+
+class _LazyImageList(object):
+    # Read-only sequence of the route images loaded through the cache.
+    def __init__(self, fn_get_image, size):
+        self._fn_get_image = fn_get_image
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._fn_get_image(i) for i in range(*index.indices(self._size))]
+        if not -self._size <= index < self._size:
+            raise IndexError("Image index out of range.")
+        return self._fn_get_image(index % self._size)
+
+    def __iter__(self):
+        return (self._fn_get_image(i) for i in range(self._size))
+
+
+class RouteState(object):
+    """The navigation points and images of a route read from disk and ready to be made current."""
+
+    def __init__(self, route_name=None):
+        self.route_name = route_name
+        self.points = []
+        self.all_images = []
+        self.all_image_files = []
+        self.image_index_to_point = {}
+        self.image_index_to_point_id = {}
+        self.point_to_instructions = {}
+        self.point_id_to_image_ids = {}
+        # By point name the modification key, image files, images and instructions for the next reload.
+        self.point_cache = {}
+
+
 class FileSystemRouteDataSource(AbstractRouteDataSource):
 
-    def __init__(self, directory, fn_load_image=(lambda x: x), load_instructions=True):
+    def __init__(self, directory, fn_load_image=(lambda x: x), load_instructions=True, load_images=True, cache_mb=None, prefetch_points=0, load_workers=4):
+        """
+        :param cache_mb: When set the images are loaded on demand and kept in a cache of at most this many megabytes instead of all in memory.
+        :param prefetch_points: The number of navigation points on either side of a requested image to load ahead in the background.
+        :param load_workers: The number of threads to load the images of a route with.
+        """
         self.directory = directory
         self.fn_load_image = fn_load_image
         self.load_instructions = load_instructions
+        self.load_images = load_images
+        self.image_cache = None if cache_mb is None else ImageCache(fn_load_image, max_bytes=int(cache_mb * (1 << 20)))
+        self.prefetch_points = prefetch_points
+        self.load_workers = load_workers
         self.quit_event = multiprocessing.Event()
         self._load_timestamp = 0
+        self._load_mtime = None
+        self._point_cache = {}
         self.routes = []
         self.selected_route = None
         # Route specific data follows.
         self.points = []
         self.all_images = []
+        self.all_image_files = []
         self.image_index_to_point = {}
         self.image_index_to_point_id = {}
         self.point_to_instructions = {}
+        self.point_id_to_image_ids = {}
         self._check_exists()
 
     def _check_exists(self):
@@ -186,22 +328,30 @@ class FileSystemRouteDataSource(AbstractRouteDataSource):
         self.selected_route = None
         self.points = []
         self.all_images = []
+        self.all_image_files = []
         self.image_index_to_point = {}
         self.image_index_to_point_id = {}
         self.point_to_instructions = {}
+        self.point_id_to_image_ids = {}
+        if self.image_cache is not None:
+            self.image_cache.clear()
         self.quit_event.clear()
 
-    def load_routes(self):
+    def load_routes(self, force=False):
         self._check_exists()
         if not self._exists:
             self._reset()
         else:
             _now = timestamp()  # In micro seconds.
-            if _now - self._load_timestamp > 1e6:
-                # Each route is a sub-directory of the base folder.
-                self.routes = [d for d in os.listdir(self.directory) if not d.startswith(".")]
+            if force or _now - self._load_timestamp > 1e6:
                 self._load_timestamp = _now
-                logger.info("Directory '{}' contains the following routes {}.".format(self.directory, self.routes))
+                # Routes are only added or removed when the modification time of the base folder changes.
+                _mtime = os.path.getmtime(self.directory)
+                if force or _mtime != self._load_mtime:
+                    # Each route is a sub-directory of the base folder.
+                    self.routes = [d for d in os.listdir(self.directory) if not d.startswith(".")]
+                    self._load_mtime = _mtime
+                    logger.info("Directory '{}' contains the following routes {}.".format(self.directory, self.routes))
 
     @staticmethod
     def _get_command(fname):
@@ -221,53 +371,116 @@ class FileSystemRouteDataSource(AbstractRouteDataSource):
     def get_selected_route(self):
         return self.selected_route
 
-    def open(self, route_name=None):
-        # Reopening the selected route constitutes a reload of the disk state.
-        self._reset()
-        if self._exists and route_name in self.routes:
-            try:
-                # Load the route navigation points.
-                _route_directory = os.path.join(self.directory, route_name)
-                if os.path.exists(_route_directory) and os.path.isdir(_route_directory):
-                    np_dirs = sorted([d for d in os.listdir(_route_directory) if not d.startswith(".")])
-                    logger.info("{} -> {}".format(route_name, np_dirs))
-                    # Take the existing sort-order.
-                    image_id = 0
-                    point_id = 0  # Cannot enumerate as points without images must be skipped.
+    @staticmethod
+    def _point_key(np_dir, im_files, command_files):
+        # Images added or removed change the directory time, images and instructions overwritten in place only their own.
+        _files = im_files + command_files
+        return tuple([os.path.getmtime(np_dir)] + [os.path.getmtime(f) if os.path.exists(f) else None for f in _files])
+
+    def _read_point(self, route_name, point_name, point_cache):
+        np_dir = os.path.join(self.directory, route_name, point_name)
+        _command_files = [os.path.join(np_dir, "command.json"), os.path.join(np_dir, point_name + ".json")]
+        im_files = sorted([os.path.join(np_dir, f) for f in os.listdir(np_dir) if f.endswith((".jpg", ".jpeg")) and not f.startswith(".")])
+        _key = self._point_key(np_dir, im_files, _command_files)
+        _cached = point_cache.get(point_name)
+        if _cached is not None and _cached[0] == _key:
+            return _cached, False
+        instructions = None
+        if self.load_instructions:
+            contents = self._get_command(_command_files[0])
+            contents = contents if contents else self._get_command(_command_files[1])
+            instructions = _parse_navigation_instructions(contents)
+        return (_key, im_files, None, instructions), True
+
+    def load_route(self, route_name):
+        """
+        Reads the route from disk without changing the current state so it can run while the source is in use.
+        The points of the previously read route with unchanged directories are reused.
+        """
+        state = RouteState(route_name)
+        if not self._exists or route_name not in self.routes:
+            return state
+        _point_cache = self._point_cache.get(route_name, {})
+        _load_images = self.load_images and self.image_cache is None
+        try:
+            # Load the route navigation points.
+            _route_directory = os.path.join(self.directory, route_name)
+            if os.path.exists(_route_directory) and os.path.isdir(_route_directory):
+                np_dirs = sorted([d for d in os.listdir(_route_directory) if not d.startswith(".")])
+                logger.info("{} -> {}".format(route_name, np_dirs))
+                _points = []
+                _futures = {}
+                with ThreadPoolExecutor(max_workers=max(1, self.load_workers)) as executor:
                     for point_name in np_dirs:
                         if self.quit_event.is_set():
                             break
-                        np_dir = os.path.join(self.directory, route_name, point_name)
-                        _pattern = np_dir + os.path.sep
-                        im_files = sorted([f for f_ in [glob.glob(_pattern + e) for e in ("*.jpg", "*.jpeg")] for f in f_])
-                        if len(im_files) < 1:
-                            logger.info("Skipping point '{}' as there are no images for it.".format(point_name))
-                            continue
-                        if self.load_instructions:
-                            contents = self._get_command(os.path.join(np_dir, "command.json"))
-                            contents = contents if contents else self._get_command(os.path.join(np_dir, point_name + ".json"))
-                            self.point_to_instructions[point_name] = _parse_navigation_instructions(contents)
-                        # Collect images by navigation point.
-                        for im_file in im_files:
-                            self.all_images.append(self.fn_load_image(im_file))
-                            self.image_index_to_point[image_id] = point_name
-                            self.image_index_to_point_id[image_id] = point_id
-                            image_id += 1
-                        # Accept the point.
-                        self.points.append(point_name)
-                        point_id += 1
-                    self.selected_route = route_name
-            except OSError as e:
-                logger.info(e)
+                        (_key, im_files, images, instructions), _changed = self._read_point(route_name, point_name, _point_cache)
+                        if _load_images and (_changed or images is None):
+                            # The images of all points are decoded in parallel.
+                            _futures[point_name] = [executor.submit(self.fn_load_image, f) for f in im_files]
+                        _points.append((point_name, _key, im_files, images, instructions))
+                # Take the existing sort-order.
+                image_id = 0
+                point_id = 0  # Cannot enumerate as points without images must be skipped.
+                for point_name, _key, im_files, images, instructions in _points:
+                    if point_name in _futures:
+                        images = [f.result() for f in _futures[point_name]]
+                    state.point_cache[point_name] = (_key, im_files, images, instructions)
+                    if len(im_files) < 1:
+                        logger.info("Skipping point '{}' as there are no images for it.".format(point_name))
+                        continue
+                    if self.load_instructions:
+                        state.point_to_instructions[point_name] = instructions
+                    # Collect images by navigation point.
+                    state.point_id_to_image_ids[point_id] = list(range(image_id, image_id + len(im_files)))
+                    if _load_images:
+                        state.all_images.extend(images)
+                    for im_file in im_files:
+                        state.all_image_files.append(im_file)
+                        state.image_index_to_point[image_id] = point_name
+                        state.image_index_to_point_id[image_id] = point_id
+                        image_id += 1
+                    # Accept the point.
+                    state.points.append(point_name)
+                    point_id += 1
+        except OSError as e:
+            logger.info(e)
+            state.route_name = None
+        if self.quit_event.is_set():
+            # An interrupted read is incomplete.
+            state.route_name = None
+        return state
+
+    def open(self, route_name=None, state=None):
+        if self.quit_event.is_set() or (state is not None and state.route_name != route_name):
+            # The read was interrupted or failed, keep the current state rather than read the route again under the caller's lock.
+            return
+        # Reopening the selected route constitutes a reload of the disk state.
+        self._reset()
+        if state is None:
+            state = self.load_route(route_name)
+        if self._exists and route_name in self.routes and state.route_name == route_name:
+            self.points = state.points
+            self.all_images = state.all_images
+            self.all_image_files = state.all_image_files
+            self.image_index_to_point = state.image_index_to_point
+            self.image_index_to_point_id = state.image_index_to_point_id
+            self.point_to_instructions = state.point_to_instructions
+            self.point_id_to_image_ids = state.point_id_to_image_ids
+            self._point_cache = {route_name: state.point_cache}
+            self.selected_route = route_name
 
     def is_open(self):
         return self.selected_route in self.routes
 
     def close(self):
         self._reset()
+        self._point_cache = {}
 
     def quit(self):
         self.quit_event.set()
+        if self.image_cache is not None:
+            self.image_cache.quit()
 
     def list_navigation_points(self):
         return self.points
@@ -277,10 +490,31 @@ class FileSystemRouteDataSource(AbstractRouteDataSource):
         return os.path.exists(_dir) and os.path.isdir(_dir)
 
     def list_all_images(self):
+        if self.load_images and self.image_cache is not None:
+            return _LazyImageList(self._get_cached_image, len(self.all_image_files))
         return self.all_images
 
+    def list_all_image_files(self):
+        return self.all_image_files
+
+    def _get_cached_image(self, image_id):
+        return self.image_cache.get(self.all_image_files[image_id])
+
+    def _prefetch(self, image_id):
+        _point_id = self.image_index_to_point_id.get(image_id)
+        if _point_id is not None:
+            _points = range(_point_id - self.prefetch_points, _point_id + self.prefetch_points + 1)
+            self.image_cache.prefetch([self.all_image_files[i] for p in _points for i in self.point_id_to_image_ids.get(p, [])])
+
     def get_image(self, image_id):
         image_id = -1 if image_id is None else image_id
+        if self.load_images and self.image_cache is not None:
+            if not len(self.all_image_files) > image_id >= 0:
+                return None
+            image = self._get_cached_image(image_id)
+            if self.prefetch_points > 0:
+                self._prefetch(image_id)
+            return image
         images = self.list_all_images()
         return images[image_id] if len(images) > image_id >= 0 else None
 
@@ -301,6 +535,7 @@ class ReloadableDataSource(AbstractRouteDataSource):
         # Cache the most recent selected route.
         self._last_listed_routes = []
         self._last_selected_route = None
+        self._watched = False
 
     def _do_safe(self, fn):
         _acquired = self._lock.acquire(False)
@@ -313,9 +548,19 @@ class ReloadableDataSource(AbstractRouteDataSource):
     def __len__(self):
         return self._do_safe(lambda acquired: len(self._delegate) if acquired else 0)
 
-    def load_routes(self):
+    def load_routes(self, force=False):
         with self._lock:
-            self._delegate.load_routes()
+            self._delegate.load_routes(force)
+
+    def watch(self, watcher, directory):
+        """Reloads the routes on changes in the directory instead of on request."""
+        watcher.watch(directory, lambda paths: self.load_routes(force=True))
+        self._watched = True
+        # The watcher reports changes only so the routes already on disk are read once here.
+        self.load_routes(force=True)
+
+    def is_watched(self):
+        return self._watched
 
     def list_routes(self):
         _acquired = self._lock.acquire(False)
@@ -337,9 +582,11 @@ class ReloadableDataSource(AbstractRouteDataSource):
             if _acquired:
                 self._lock.release()
 
-    def open(self, route_name=None):
+    def open(self, route_name=None, state=None):
+        # The route is read off-lock so the accessors keep answering from the current state until the swap.
+        state = self._delegate.load_route(route_name) if state is None else state
         with self._lock:
-            self._delegate.open(route_name)
+            self._delegate.open(route_name, state)
 
     def is_open(self):
         return self._do_safe(lambda acquired: self._delegate.is_open() if acquired else False)
@@ -361,6 +608,9 @@ class ReloadableDataSource(AbstractRouteDataSource):
     def list_all_images(self):
         return self._do_safe(lambda acquired: self._delegate.list_all_images() if acquired else [])
 
+    def list_all_image_files(self):
+        return self._do_safe(lambda acquired: self._delegate.list_all_image_files() if acquired else [])
+
     def get_image(self, image_id):
         return self._do_safe(lambda acquired: self._delegate.get_image(image_id) if acquired else None)
 
@@ -105,6 +105,12 @@ class CollectServer(object):
         self._errors.append(errors)
         self._capabilities.append(capabilities)
 
+    def register_capabilities(self, capabilities):
+        self._capabilities.append({} if capabilities is None else capabilities)
+
+    def get_capabilities(self):
+        return self._capabilities[-1]
+
     def collect(self):
         return self._errors
 
@@ -0,0 +1,404 @@
+from __future__ import absolute_import
+
+import asyncio
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from . import ipc, watcher
+from .executor import CoalescingExecutor, TimedExecutor
+from .latency import LatencyTracker, new_trace, stamp_trace
+from .navigate import FileSystemRouteDataSource, ImageCache
+from .ipc import JSONCodec, JSONPublisher, JSONReceiver, MsgPackCodec, PollingCollectorThread, SharedImageRing, decode_message, get_codec
+from .watcher import DirectoryWatcher
+
+
+def _ring_pair(tmpdir, num_slots=2, slot_size=1024):
+    _path = os.path.join(str(tmpdir.realpath()), "camera.ring")
+    return SharedImageRing(_path, num_slots, slot_size, writable=True), SharedImageRing(_path, num_slots, slot_size)
+
+
+def test_shared_image_ring_read(tmpdir):
+    writer, reader = _ring_pair(tmpdir)
+    image = np.arange(8 * 8 * 3, dtype=np.uint8).reshape((8, 8, 3))
+    writer.write(5, image)
+    _read = reader.read(5, image.shape)
+    assert np.array_equal(_read, image)
+    # The reader owns the copy, later writes to the slot do not change it.
+    writer.write(7, np.zeros_like(image))
+    assert np.array_equal(_read, image)
+
+
+def test_shared_image_ring_sequence_mismatch(tmpdir):
+    writer, reader = _ring_pair(tmpdir)
+    image = np.ones((8, 8, 3), dtype=np.uint8)
+    writer.write(1, image)
+    # The publisher cycled through the slots and frame 3 took the slot of frame 1.
+    writer.write(3, image * 3)
+    assert reader.read(1, image.shape) is None
+    assert np.array_equal(reader.read(3, image.shape), image * 3)
+
+
+def test_shared_image_ring_slot_being_written(tmpdir):
+    writer, reader = _ring_pair(tmpdir)
+    image = np.ones((8, 8, 3), dtype=np.uint8)
+    _slot = writer.write(4, image)
+    # The writer marks the slot while it copies the pixels in.
+    writer._headers[_slot] = -1
+    assert reader.read(4, image.shape) is None
+
+
+def test_shared_image_ring_overwritten_during_copy(tmpdir, monkeypatch):
+    writer, reader = _ring_pair(tmpdir)
+    image = np.ones((8, 8, 3), dtype=np.uint8)
+    writer.write(2, image)
+    _copy = np.array
+
+    def _copy_while_written(view):
+        # The publisher laps the ring while the reader copies the slot.
+        _image = _copy(view)
+        writer.write(4, image * 4)
+        return _image
+
+    monkeypatch.setattr(ipc.np, "array", _copy_while_written)
+    assert reader.read(2, image.shape) is None
+
+
+_state = {"time": 1600000000000000, "steering": -0.25, "throttle": 0.5, "driver": "driver_mode.inference.dnn", "trace": {"camera": 1, "inference": 2}, "flags": [1, 0]}
+
+
+@pytest.mark.parametrize("codec", [JSONCodec, MsgPackCodec])
+def test_codec_round_trip(codec):
+    if codec is MsgPackCodec and ipc.msgpack is None:
+        pytest.skip("msgpack is not installed")
+    assert codec.decode(codec.encode(_state)) == _state
+    assert decode_message([b"aav/pilot/output", codec.name, codec.encode(_state)]) == _state
+
+
+def test_decode_message_formats():
+    # The single frame string message of the publishers without a codec.
+    assert decode_message([("aav/pilot/output:" + JSONCodec.encode(_state).decode("utf-8")).encode("utf-8")]) == _state
+    assert decode_message([b"aav/pilot/output", b"unknown", b"payload"]) is None
+    assert get_codec("unknown") is JSONCodec
+
+
+def _wait_for(fn, timeout=5.0):
+    _until = time.time() + timeout
+    while time.time() < _until:
+        _value = fn()
+        if _value is not None:
+            return _value
+        time.sleep(0.01)
+    return None
+
+
+@pytest.mark.parametrize("codec", [None, "msgpack"])
+def test_polling_collector_receives(tmpdir, codec):
+    _urls = ["ipc://" + os.path.join(str(tmpdir.realpath()), name + ".sock") for name in ("pilot", "vehicle")]
+    publishers = [JSONPublisher(url=url, topic="aav/test", codec=codec) for url in _urls]
+    collector = PollingCollectorThread(poll_timeout_ms=10)
+    receivers = [collector.add(JSONReceiver(url=url, topic=b"aav/test")) for url in _urls]
+    collector.start()
+    try:
+        # Publish until the subscriptions are in place.
+        def _received(i):
+            publishers[i].publish(dict(_state, index=i))
+            return receivers[i].get()
+
+        for i in range(len(_urls)):
+            assert _wait_for(lambda: _received(i)) == dict(_state, index=i)
+        assert collector.peek(1) == dict(_state, index=1)
+    finally:
+        collector.quit()
+        collector.join()
+
+
+@pytest.fixture
+def polling_watcher(monkeypatch):
+    monkeypatch.setattr(watcher, "_create_backend", lambda: watcher._PollingBackend(settle_seconds=0.2))
+    _watcher = DirectoryWatcher(poll_seconds=0.05, debounce_seconds=0.3)
+    assert _watcher.is_polling()
+    yield _watcher
+    _watcher.quit()
+    _watcher.join()
+
+
+def test_directory_watcher_polling(tmpdir, polling_watcher):
+    _directory = str(tmpdir.realpath())
+    _calls, _written = [], []
+    _called = threading.Event()
+    polling_watcher.watch(_directory, lambda paths: (_calls.append(paths), _called.set()))
+    polling_watcher.watch(_directory, lambda paths: _written.append(paths), written_only=True)
+    polling_watcher.start()
+    time.sleep(0.1)
+    # A burst of creates within the debounce time is reported at once.
+    _files = [os.path.join(_directory, "{}.onnx".format(i)) for i in range(3)]
+    for _file in _files:
+        with open(_file, "w") as f:
+            f.write("model")
+        time.sleep(0.05)
+    assert _called.wait(5.0)
+    assert _calls == [_files]
+    # The files count as written once they held still.
+    assert _wait_for(lambda: True if sorted(sum(_written, [])) == _files else None)
+    _called.clear()
+    os.remove(_files[1])
+    assert _called.wait(5.0)
+    assert _calls[-1] == [_files[1]]
+    _num_written = len(_written)
+    time.sleep(0.5)
+    assert len(_written) == _num_written
+
+
+def test_polling_collector_survives_malformed_messages(tmpdir):
+    _urls = ["ipc://" + os.path.join(str(tmpdir.realpath()), name + ".sock") for name in ("pilot", "vehicle")]
+    publishers = [JSONPublisher(url=url, topic="aav/test") for url in _urls]
+    collector = PollingCollectorThread(poll_timeout_ms=10)
+    receivers = [collector.add(JSONReceiver(url=url, topic=b"aav/test")) for url in _urls]
+    collector.start()
+    try:
+
+        def _received(i, value):
+            publishers[i].publish(dict(value=value))
+            _message = receivers[i].get()
+            return _message if _message == dict(value=value) else None
+
+        [_wait_for(lambda: _received(i, 0)) for i in range(len(_urls))]
+        # The first publisher sends a payload that does not decode.
+        ipc.send_string(publishers[0]._publisher, "aav/test:{not json")
+        time.sleep(0.1)
+        assert collector.is_alive()
+        assert _wait_for(lambda: _received(1, 1)) == dict(value=1)
+        assert _wait_for(lambda: _received(0, 2)) == dict(value=2)
+    finally:
+        collector.quit()
+        collector.join()
+
+
+def test_coalescing_executor():
+    executor = CoalescingExecutor(max_workers=1)
+    _gate = threading.Event()
+    _calls = []
+    try:
+        # Hold up the thread while the same task is submitted.
+        assert executor.submit(_gate.wait)
+        assert _wait_for(lambda: (executor.get_num_pending() == 0) or None)
+        assert executor.submit(_calls.append, 1)
+        assert not executor.submit(_calls.append, 1)
+        assert executor.submit(_calls.append, 2)
+        assert not executor.submit(_calls.append, 1)
+        assert executor.get_metrics() == dict(coalesced=2, pending=2)
+        _gate.set()
+        assert _wait_for(lambda: (len(_calls) == 2) or None)
+        assert _calls == [1, 2]
+        # Once it ran the task is queued again.
+        assert executor.submit(_calls.append, 1)
+        assert _wait_for(lambda: (len(_calls) == 3) or None)
+    finally:
+        executor.quit()
+    assert not executor.submit(_calls.append, 3)
+
+
+def test_coalescing_executor_overflow(caplog):
+    executor = CoalescingExecutor(max_workers=1, max_pending=2)
+    _gate = threading.Event()
+    _calls = []
+    try:
+        assert executor.submit(_gate.wait)
+        assert _wait_for(lambda: (executor.get_num_pending() == 0) or None)
+        assert [executor.submit(_calls.append, i) for i in range(5)] == [True, True, False, False, False]
+        assert executor.get_metrics() == dict(dropped=3, pending=2)
+        # One line per report period.
+        assert len([r for r in caplog.records if "Dropped background task" in r.getMessage()]) == 1
+        _gate.set()
+        assert _wait_for(lambda: (len(_calls) == 2) or None)
+        assert _calls == [0, 1]
+    finally:
+        executor.quit()
+
+
+def test_timed_executor():
+    executor = TimedExecutor(max_workers=2)
+
+    def _fail():
+        raise ValueError("failed")
+
+    async def _calls():
+        _results = await asyncio.gather(*[executor.run("square", lambda x: time.sleep(0.01) or x * x, i) for i in range(4)])
+        with pytest.raises(ValueError):
+            await executor.run("fail", _fail)
+        return _results
+
+    try:
+        assert asyncio.new_event_loop().run_until_complete(_calls()) == [0, 1, 4, 9]
+        _metrics = executor.get_metrics()
+        assert list(_metrics) == ["square", "fail"]
+        assert _metrics["square"]["total"]["n"] == 4
+        assert _metrics["square"]["run>done"]["p50"] >= 10
+        # With two threads for four calls half of them waited on one.
+        assert _metrics["square"]["queue>run"]["p95"] >= 5
+        assert set(_metrics["square"]) == {"queue>run", "run>done", "total"}
+        assert _metrics["fail"]["total"]["n"] == 1
+    finally:
+        executor.quit()
+
+
+def test_trace_stamps():
+    trace = new_trace("camera", ts=100)
+    assert trace == {"camera": 100}
+    _stamped = stamp_trace(trace, "capture", ts=250)
+    # The trace handed on is a copy.
+    assert _stamped == {"camera": 100, "capture": 250} and trace == {"camera": 100}
+    assert stamp_trace(None, "capture") is None
+
+
+def test_latency_tracker():
+    tracker = LatencyTracker(stages=("camera", "capture", "inference"), maxlen=1000)
+    assert tracker.summary() == {}
+    tracker.record(None)
+    tracker.record({})
+    assert tracker.summary() == {}
+    # The stages are taken in pipeline order whatever the order in the trace, a missing stage is skipped.
+    for i in range(1, 101):
+        tracker.record({"inference": 3000 + i * 1000, "camera": 0, "capture": 1000}, remote=dict(pi_drive=2000), end_stage="relay", ts=10000 + i * 1000)
+    tracker.record({"camera": 0, "inference": 5000}, end_stage="relay", ts=5000)
+    summary = tracker.summary()
+    assert set(summary) == {"camera>capture", "capture>inference", "inference>relay", "camera>inference", "total", "pi_drive"}
+    # The durations are reported in milliseconds.
+    assert summary["camera>capture"] == dict(n=100, p50=1.0, p95=1.0, p99=1.0)
+    assert summary["pi_drive"]["p99"] == 2.0
+    assert summary["capture>inference"]["n"] == 100
+    assert summary["capture>inference"]["p50"] == pytest.approx(np.percentile(np.arange(1, 101) + 2.0, 50))
+    assert summary["capture>inference"]["p95"] == pytest.approx(np.percentile(np.arange(1, 101) + 2.0, 95))
+    assert summary["capture>inference"]["p99"] == pytest.approx(np.percentile(np.arange(1, 101) + 2.0, 99))
+    assert summary["inference>relay"]["p50"] == 7.0
+    assert summary["total"]["n"] == 101
+    assert summary["total"]["p50"] == pytest.approx(np.percentile([10.0 + i for i in range(1, 101)] + [5.0], 50))
+    assert summary["camera>inference"] == dict(n=1, p50=5.0, p95=5.0, p99=5.0)
+    tracker.reset()
+    assert tracker.summary() == {}
+
+
+def test_latency_tracker_bounded():
+    tracker = LatencyTracker(stages=("camera", "capture"), maxlen=10)
+    [tracker.record({"camera": 0, "capture": i * 1000}, ts=i * 1000) for i in range(100)]
+    # Only the latest samples count.
+    assert tracker.summary()["camera>capture"] == dict(n=10, p50=94.5, p95=pytest.approx(98.55), p99=pytest.approx(98.91))
+
+
+def test_image_cache_bounded():
+    cache = ImageCache(fn_load_image=(lambda f: np.zeros(100, dtype=np.uint8)), max_bytes=300)
+    [cache.get(f) for f in ("a", "b", "c")]
+    # The image requested last is kept the longest.
+    cache.get("a")
+    cache.get("d")
+    assert list(cache._images) == ["c", "a", "d"]
+    assert cache.get_num_bytes() == 300 and len(cache) == 3
+    # An image larger than the bound is still kept on its own.
+    cache._fn_load_image = lambda f: np.zeros(1000, dtype=np.uint8)
+    cache.get("e")
+    assert list(cache._images) == ["e"] and cache.get_num_bytes() == 1000
+
+
+def test_image_cache_no_prefetch_after_quit():
+    cache = ImageCache(fn_load_image=(lambda f: np.zeros(10, dtype=np.uint8)))
+    cache.prefetch(["a", "b"])
+    assert _wait_for(lambda: len(cache) == 2 or None)
+    cache.quit()
+    cache.prefetch(["c"])
+    assert cache._executor is None and len(cache) == 2
+    # The images are still loaded on request.
+    assert cache.get("c") is not None and len(cache) == 3
+
+
+def _route(directory, points):
+    for point, images in points.items():
+        os.makedirs(os.path.join(directory, "route", point))
+        for image in images:
+            with open(os.path.join(directory, "route", point, image), "w") as f:
+                f.write(image)
+
+
+def test_route_images_through_the_cache(tmpdir):
+    _directory = str(tmpdir)
+    _route(_directory, {"p0": ["a.jpg", "b.jpg"], "p1": ["c.jpg"], "p2": ["d.jpg"], "p3": ["e.jpg"]})
+    _loads = []
+
+    def _load(fname):
+        _loads.append(os.path.basename(fname))
+        return np.zeros(10, dtype=np.uint8) + len(_loads)
+
+    source = FileSystemRouteDataSource(_directory, fn_load_image=_load, load_instructions=False, cache_mb=1, prefetch_points=1)
+    try:
+        source.load_routes()
+        source.open("route")
+        # Nothing is loaded before it is asked for.
+        assert _loads == []
+        images = source.list_all_images()
+        assert len(images) == 5
+        assert images[-1] is images[4] and _loads == ["e.jpg"]
+        assert [x[0] for x in images[1:3]] == [2, 3]
+        with pytest.raises(IndexError):
+            images[5]
+        assert source.get_image(None) is None and source.get_image(5) is None
+        # The images of the neighbouring points are loaded in the background.
+        assert source.get_image(2) is images[2]
+        assert _wait_for(lambda: len(source.image_cache) == 5 or None)
+        assert sorted(_loads) == ["a.jpg", "b.jpg", "c.jpg", "d.jpg", "e.jpg"]
+    finally:
+        source.quit()
+
+
+def test_route_reload_reads_the_changed_points(tmpdir):
+    _directory = str(tmpdir)
+    _route(_directory, {"p0": ["a.jpg", "b.jpg"], "p1": ["c.jpg"], "p2": ["d.jpg", "e.jpg"]})
+    _loads = []
+
+    def _load(fname):
+        _loads.append(os.path.basename(fname))
+        return os.path.basename(fname)
+
+    source = FileSystemRouteDataSource(_directory, fn_load_image=_load, load_instructions=False, load_workers=4)
+    source.load_routes()
+    source.open("route")
+    # The images are read in parallel and kept in the order of the route.
+    assert sorted(_loads) == ["a.jpg", "b.jpg", "c.jpg", "d.jpg", "e.jpg"]
+    assert list(source.list_all_images()) == ["a.jpg", "b.jpg", "c.jpg", "d.jpg", "e.jpg"]
+    # A reload reuses the points that did not change.
+    del _loads[:]
+    source.open("route", source.load_route("route"))
+    assert _loads == [] and len(source) == 3
+    # An image overwritten in place changes the point it belongs to.
+    _file = os.path.join(_directory, "route", "p2", "e.jpg")
+    _mtime = os.path.getmtime(_file) + 10
+    os.utime(_file, (_mtime, _mtime))
+    source.open("route", source.load_route("route"))
+    assert sorted(_loads) == ["d.jpg", "e.jpg"]
+    assert list(source.list_all_images()) == ["a.jpg", "b.jpg", "c.jpg", "d.jpg", "e.jpg"]
+
+
+def test_route_interrupted_read_keeps_the_state(tmpdir):
+    _directory = str(tmpdir)
+    _route(_directory, {"p0": ["a.jpg"], "p1": ["b.jpg"], "p2": ["c.jpg"]})
+    source = FileSystemRouteDataSource(_directory, fn_load_image=(lambda f: os.path.basename(f)), load_instructions=False)
+    source.load_routes()
+    source.open("route")
+    _file = os.path.join(_directory, "route", "p0", "a.jpg")
+    _mtime = os.path.getmtime(_file) + 10
+    os.utime(_file, (_mtime, _mtime))
+
+    def _interrupt(fname):
+        source.quit_event.set()
+        return "new"
+
+    source.fn_load_image = _interrupt
+    state = source.load_route("route")
+    assert state.route_name is None
+    source.open("route", state)
+    # The route as read before is still in use.
+    assert source.is_open() and len(source) == 3
+    assert list(source.list_all_images()) == ["a.jpg", "b.jpg", "c.jpg"]
+    assert source.get_image(0) == "a.jpg"
@@ -0,0 +1,237 @@
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Flags from the linux inotify header.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+# The contents of files are complete once they are closed after writing or moved in.
+_WRITTEN_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class _InotifyBackend(object):
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}
+
+    def add(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, directory.encode("utf-8"), _WATCH_MASK)
+        if wd < 0:
+            return False
+        self._directories[wd] = directory
+        return True
+
+    def read(self, timeout, quit_event):
+        """Returns the changed paths and the written files by directory and the directories that are no longer watched."""
+        changes, written, lost = {}, {}, set()
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return changes, written, lost
+        try:
+            data = os.read(self._fd, 64 << 10)
+        except (IOError, OSError):
+            return changes, written, lost
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + _EVENT_HEADER.size : offset + _EVENT_HEADER.size + length].rstrip(b"\0").decode("utf-8", "replace")
+            offset += _EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped so everything may have changed.
+                [changes.setdefault(d, set()).add(d) for d in self._directories.values()]
+                [written.setdefault(d, set()).add(d) for d in self._directories.values()]
+            directory = self._directories.get(wd)
+            if directory is None:
+                continue
+            changes.setdefault(directory, set()).add(os.path.join(directory, name) if name else directory)
+            if name and mask & _WRITTEN_MASK:
+                written.setdefault(directory, set()).add(os.path.join(directory, name))
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                if not mask & IN_IGNORED:
+                    self._libc.inotify_rm_watch(self._fd, wd)
+                del self._directories[wd]
+                lost.add(directory)
+        return changes, written, lost
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _PollingBackend(object):
+    def __init__(self, settle_seconds=1.0):
+        self._settle_seconds = settle_seconds
+        self._snapshots = {}
+        # By path the modification time and size of a changed file and when they were first seen.
+        self._unsettled = {}
+
+    @staticmethod
+    def _snapshot(directory):
+        _entries = {}
+        for name in os.listdir(directory):
+            try:
+                _stat = os.stat(os.path.join(directory, name))
+                _entries[name] = (_stat.st_mtime, _stat.st_size)
+            except OSError:
+                pass
+        return _entries
+
+    def add(self, directory):
+        try:
+            self._snapshots[directory] = self._snapshot(directory)
+            return True
+        except OSError:
+            return False
+
+    def _settled(self, directory, current, names):
+        # A file is taken to be written once its modification time and size held still for the settle time.
+        _now = time.time()
+        for name in names:
+            path = os.path.join(directory, name)
+            if name in current:
+                self._unsettled[path] = (current[name], _now)
+            else:
+                self._unsettled.pop(path, None)
+        _written = set()
+        for path, (stat, seen) in list(self._unsettled.items()):
+            if os.path.dirname(path) == directory and _now - seen >= self._settle_seconds:
+                del self._unsettled[path]
+                if current.get(os.path.basename(path)) == stat:
+                    _written.add(path)
+        return _written
+
+    def read(self, timeout, quit_event):
+        changes, written, lost = {}, {}, set()
+        quit_event.wait(timeout)
+        for directory, previous in list(self._snapshots.items()):
+            try:
+                current = self._snapshot(directory)
+            except OSError:
+                del self._snapshots[directory]
+                changes[directory] = {directory}
+                lost.add(directory)
+                continue
+            _names = set(n for n in set(previous) | set(current) if previous.get(n) != current.get(n))
+            if _names:
+                self._snapshots[directory] = current
+                changes[directory] = set(os.path.join(directory, n) for n in _names)
+            _written = self._settled(directory, current, _names)
+            if _written:
+                written[directory] = _written
+        return changes, written, lost
+
+    def close(self):
+        self._snapshots.clear()
+        self._unsettled.clear()
+
+
+def _create_backend():
+    if sys.platform.startswith("linux"):
+        try:
+            return _InotifyBackend()
+        except (OSError, AttributeError) as e:
+            logger.warning("Falling back to polling the watched directories: {}".format(e))
+    return _PollingBackend()
+
+
+class DirectoryWatcher(threading.Thread):
+    """
+    Calls back with the changed paths when entries of a watched directory are created, removed or written.
+    Uses inotify on linux and compares directory listings otherwise, where a file counts as written once it stopped changing.
+    Directories that do not exist yet are watched once they appear, which is reported as a change.
+    """
+
+    def __init__(self, event=None, poll_seconds=1.0, debounce_seconds=0.2):
+        super(DirectoryWatcher, self).__init__()
+        self._quit_event = multiprocessing.Event() if event is None else event
+        self._poll_seconds = poll_seconds
+        self._debounce_seconds = debounce_seconds
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._pending = set()
+        self._backend = _create_backend()
+
+    def is_polling(self):
+        return isinstance(self._backend, _PollingBackend)
+
+    def watch(self, directory, callback, written_only=False):
+        """
+        :param written_only: Call back only with the files closed after writing or moved into the directory, not with files still being written.
+        """
+        directory = os.path.abspath(os.path.expanduser(directory))
+        with self._lock:
+            if directory not in self._callbacks:
+                self._callbacks[directory] = []
+                self._pending.add(directory)
+            self._callbacks[directory].append((callback, written_only))
+
+    def quit(self):
+        self._quit_event.set()
+
+    def _add_pending(self):
+        with self._lock:
+            _pending = list(self._pending)
+        _added = [d for d in _pending if os.path.isdir(d) and self._backend.add(d)]
+        with self._lock:
+            self._pending.difference_update(_added)
+        return _added
+
+    def _dispatch(self, changes, written):
+        for directory in set(changes) | set(written):
+            with self._lock:
+                _callbacks = list(self._callbacks.get(directory, []))
+            for callback, written_only in _callbacks:
+                paths = written.get(directory) if written_only else changes.get(directory)
+                if not paths:
+                    continue
+                try:
+                    callback(sorted(paths))
+                except Exception as e:
+                    logger.warning("Watch callback for '{}' failed: {}".format(directory, e))
+
+    def run(self):
+        # The directories present at start are considered unchanged.
+        self._add_pending()
+        while not self._quit_event.is_set():
+            changes = dict((d, {d}) for d in self._add_pending())
+            _changes, _written, _lost = self._backend.read(self._poll_seconds, self._quit_event)
+            if (_changes or _written) and self._debounce_seconds > 0:
+                # Collect the events of a burst of changes to call back once.
+                _until = time.time() + self._debounce_seconds
+                while not self._quit_event.is_set() and time.time() < _until:
+                    _more, _more_written, _more_lost = self._backend.read(max(0, _until - time.time()), self._quit_event)
+                    [_changes.setdefault(d, set()).update(p) for d, p in _more.items()]
+                    [_written.setdefault(d, set()).update(p) for d, p in _more_written.items()]
+                    _lost.update(_more_lost)
+            [changes.setdefault(d, set()).update(p) for d, p in _changes.items()]
+            if _lost:
+                with self._lock:
+                    self._pending.update(_lost)
+            if (changes or _written) and not self._quit_event.is_set():
+                self._dispatch(changes, _written)
+        self._backend.close()
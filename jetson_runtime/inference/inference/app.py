@@ -1,27 +1,32 @@
 from __future__ import absolute_import
 
 import argparse
+import fnmatch
 import glob
+import hashlib
 import logging
 import os
 import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 
 # For operators see: https://github.com/glenfletcher/Equation/blob/master/Equation/equation_base.py
 from Equation import Expression
-from scipy.special import softmax
 from six.moves import range
-from sklearn.metrics.pairwise import cosine_distances
 
 from BYODR_utils.common import timestamp, Configurable, Application
-from BYODR_utils.common.ipc import CameraThread, JSONPublisher, LocalIPCServer, json_collector
+from BYODR_utils.common.executor import CoalescingExecutor
+from BYODR_utils.common.ipc import CameraThread, JSONPublisher, JSONReceiver, LocalIPCServer, PollingCollectorThread
+from BYODR_utils.common.latency import stamp_trace
 from BYODR_utils.common.navigate import FileSystemRouteDataSource, ReloadableDataSource
 from BYODR_utils.common.option import parse_option, PropertyError
-from .image import get_registered_function
-from .torched import DynamicMomentum, TRTDriver
+from BYODR_utils.common.watcher import DirectoryWatcher
+from .cache import RouteFeatureCache, function_description
+from .image import create_fused_preprocessor, get_registered_function
+from .torched import DynamicMomentum, TRTDriver, EXECUTION_PROVIDERS, GRAPH_OPTIMIZATION_LEVELS
 
 if sys.version_info > (3,):
     from configparser import ConfigParser as SafeConfigParser
@@ -31,9 +36,22 @@ else:
 logger = logging.getLogger(__name__)
 
 
+def _normalize_rows(matrix):
+    # Zero rows are left as is like sklearn does.
+    _norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(_norms == 0, 1, _norms)
+
+
+def _softmax(x):
+    _e = np.exp(x - np.max(x))
+    return _e / _e.sum()
+
+
 class RouteMemory(object):
     def __init__(self):
         self._recognition_threshold = 0
+        self._match_window = 0
+        self._index_points = 0
         self._num_points = 0
         self._num_codes = 0
         self._navigation_point = None
@@ -42,8 +60,14 @@ class RouteMemory(object):
         self._evidence = None
         # Image id index to navigation point id.
         self._code_points = None
+        # Navigation point id to image ids.
+        self._point_images = None
         # Image id index to features.
         self._code_book = None
+        # The code book rows with unit length.
+        self._unit_book = None
+        # Navigation point id to the unit length mean of its image features.
+        self._point_centroids = None
         self._destination_keys = None
         self._destination_values = None
 
@@ -53,6 +77,14 @@ class RouteMemory(object):
     def set_threshold(self, value):
         self._recognition_threshold = value
 
+    def set_search(self, window=0, index_points=0):
+        """
+        :param window: Number of navigation points on either side of the current one to match against. Zero searches the whole route.
+        :param index_points: Number of closest navigation point centroids to match against, outside of the window. Zero disables the index.
+        """
+        self._match_window = window
+        self._index_points = index_points
+
     def reset(self, n_points=0, code_points=None, coordinates=None, keys=None, values=None):
         self._navigation_point = None
         self._tracking = None
@@ -62,14 +94,38 @@ class RouteMemory(object):
         self._code_book = None if coordinates is None else np.array(coordinates)
         self._destination_keys = None if keys is None else np.array(keys)
         self._destination_values = None if values is None else np.array(values)
+        self._unit_book = None if self._code_book is None else _normalize_rows(self._code_book)
+        self._point_images, self._point_centroids = None, None
+        if self._code_points is not None and self._unit_book is not None:
+            self._point_images = [np.flatnonzero(self._code_points == point) for point in range(n_points)]
+            self._point_centroids = _normalize_rows(np.array([self._unit_book[images].mean(axis=0) for images in self._point_images]))
         self._evidence_reset()
 
     def is_open(self):
         return self._code_book is not None
 
-    def _distances(self, features):
-        # return np.clip(abs(cosine_distances(self._code_book, np.reshape(features, [1, -1])).flatten() - self._cosine_diagonal), 0, 1)
-        return cosine_distances(self._code_book, np.reshape(features, [1, -1])).flatten()
+    def _candidates(self, unit_features):
+        # None means all images are candidates.
+        if self._navigation_point is not None and self._match_window > 0 and 2 * self._match_window + 1 < self._num_points:
+            _point = self._navigation_point[0]
+            _points = [(_point + i) % self._num_points for i in range(-self._match_window, self._match_window + 1)]
+        elif 0 < self._index_points < self._num_points:
+            _points = np.argpartition(-np.matmul(self._point_centroids, unit_features), self._index_points - 1)[: self._index_points]
+            # Keep the current, previous and next navigation points.
+            _points = _points if self._navigation_point is None else np.union1d(_points, self._navigation_point)
+        else:
+            return None
+        _images = np.concatenate([self._point_images[p] for p in _points])
+        return _images if self._tracking is None else np.union1d(_images, [self._tracking])
+
+    def _distances(self, unit_features, candidates=None):
+        # The cosine distances as computed by sklearn cosine_distances.
+        if candidates is None:
+            return np.clip(1.0 - np.matmul(self._unit_book, unit_features), 0, 2)
+        # The maximum distance for the images outside of the candidate set.
+        _errors = np.full(self._num_codes, 2, dtype=self._unit_book.dtype)
+        _errors[candidates] = np.clip(1.0 - np.matmul(self._unit_book[candidates], unit_features), 0, 2)
+        return _errors
 
     def match(self, features, query):
         code_points = self._code_points
@@ -77,10 +133,16 @@ class RouteMemory(object):
         _point, _previous, _next = (-1, -1, -1) if _before_match else self._navigation_point
         _threshold = self._recognition_threshold
 
-        # The beliefs incorporate local information through the network probabilities.
-        _p_out = softmax(np.matmul(query.reshape([1, -1]), self._destination_keys.T)).flatten()
         # The features are those of the source coordinates.
-        _errors = self._distances(features)
+        _unit_features = _normalize_rows(np.reshape(features, [-1]).astype(self._unit_book.dtype))
+        _candidates = self._candidates(_unit_features)
+        _errors = self._distances(_unit_features, _candidates)
+        # The beliefs incorporate local information through the network probabilities.
+        if _candidates is None:
+            _p_out = _softmax(np.matmul(self._destination_keys, query.reshape([-1])))
+        else:
+            _p_out = np.zeros(self._num_codes, dtype=_errors.dtype)
+            _p_out[_candidates] = _softmax(np.matmul(self._destination_keys[_candidates], query.reshape([-1])))
         _beliefs = _p_out * np.exp(-np.e * _errors)
         self._evidence = np.minimum(self._evidence, _errors)
 
@@ -126,20 +188,43 @@ class Navigator(object):
         self._lock = threading.Lock()
         self._quit_event = threading.Event()
         self._memory = RouteMemory()
+        self._cache = None if user_directory is None else RouteFeatureCache(os.path.join(user_directory, ".cache", "routes"))
         self._network = None
         self._store = None
         self._fn_dave_image = None
         self._fn_alex_image = None
+        self._preprocess = None
         self._gumbel = None
         self._destination = None
+        self._route_batch_size = 1
+        self._network_args = None
+        self._watcher = None
+        # Route opens and model builds are coalesced while one is in progress.
+        self._tasks = CoalescingExecutor(max_workers=1)
 
-    def _create_network(self, gpu_id=0, runtime_compilation=1):
+    def _create_network(self, gpu_id=0, runtime_compilation=1, io_binding=False, session_options=None):
         user_directory, internal_directory = self._model_directories
-        network = TRTDriver(user_directory, internal_directory, gpu_id=gpu_id, runtime_compilation=runtime_compilation)
+        network = TRTDriver(user_directory, internal_directory, gpu_id=gpu_id, runtime_compilation=runtime_compilation, io_binding=io_binding, **(session_options or {}))
         return network
 
-    def _pull_image_features(self, image):
-        return self._network.features(dave_image=self._fn_dave_image(image), alex_image=self._fn_alex_image(image))
+    def _load_image(self, fname):
+        return self._fn_alex_image(cv2.imread(fname))
+
+    def _pull_image_features(self, images):
+        _dave_images = [self._fn_dave_image(image) for image in images]
+        _alex_images = [self._fn_alex_image(image) for image in images]
+        return self._network.features_batch(dave_images=_dave_images, alex_images=_alex_images, batch_size=self._route_batch_size)
+
+    def _pull_file_features(self, files):
+        return self._pull_image_features([self._load_image(f) for f in files])
+
+    def _feature_key(self):
+        # The features depend on the model and the image transformations.
+        _model_hash = self._network.get_model_hash()
+        if _model_hash is None:
+            return None
+        _transforms = function_description(self._fn_dave_image) + function_description(self._fn_alex_image)
+        return "{}_{}".format(_model_hash[:16], hashlib.sha1(_transforms.encode("utf-8")).hexdigest()[:8])
 
     def _route_open(self, route):
         # This may take a while.
@@ -152,54 +237,99 @@ class Navigator(object):
                     self._store.open(route)
                     num_points = len(self._store)
                     if num_points > 0:
-                        _images = self._store.list_all_images()
-                        _codes, _coordinates, _keys, _values = [], [], [], []
-                        for im_id in range(len(_images)):
-                            _codes.append(self._store.get_image_navigation_point_id(im_id))
-                            _c, _k, _v = self._pull_image_features(_images[im_id])
-                            _coordinates.append(_c)
-                            _keys.append(_k)
-                            _values.append(_v)
+                        _files = self._store.list_all_image_files()
+                        _codes = [self._store.get_image_navigation_point_id(im_id) for im_id in range(len(_files))]
+                        _key = None if self._cache is None else self._feature_key()
+                        if _key is None:
+                            _coordinates, _keys, _values = self._pull_file_features(_files)
+                        else:
+                            _coordinates, _keys, _values = self._cache.features(route, _key, _files, self._pull_file_features)
                         self._memory.reset(num_points, _codes, _coordinates, _keys, _values)
 
     def _check_state(self, route=None):
+        # The watcher reloads the routes on change.
         if route is None:
             self._store.close()
-        elif route not in self._store.list_routes():
-            threading.Thread(target=self._store.load_routes).start()
-        elif route != self._store.get_selected_route():
-            threading.Thread(target=self._route_open, args=(route,)).start()
+        elif route in self._store.list_routes() and route != self._store.get_selected_route():
+            self._tasks.submit(self._route_open, route)
+
+    def _on_model_change(self, paths):
+        # The build runs off the watcher thread.
+        if any(fnmatch.fnmatch(os.path.basename(p), "runtime*.onnx") for p in paths):
+            self._tasks.submit(self.recompile)
+
+    def _on_routes_change(self, paths):
+        _store = self._store
+        if _store is not None:
+            _store.load_routes(force=True)
+
+    def _start_watcher(self):
+        # New routes and models are picked up on change instead of by scanning the directories.
+        if self._watcher is None:
+            self._watcher = DirectoryWatcher()
+            # A model is built only after it was written completely.
+            [self._watcher.watch(d, self._on_model_change, written_only=True) for d in self._model_directories if d is not None]
+            if self._routes_directory is not None:
+                self._watcher.watch(self._routes_directory, self._on_routes_change)
+            self._watcher.start()
 
     def recompile(self):
-        with self._lock:
-            if self._network is not None and self._network.will_compile():
-                self._network.reactivate()
+        # The current network keeps running while the newer model is built.
+        _network = self._network
+        if _network is not None and not self._quit_event.is_set() and _network.prewarm():
+            with self._lock:
+                if _network is self._network:
+                    _network.swap()
+                    # The route features of the previous model are invalid.
+                    self._memory.reset()
+                    self._store.close()
 
-    def restart(self, fn_dave_image, fn_alex_image, recognition_threshold=0, gpu_id=0, runtime_compilation=1):
+    def restart(self, fn_dave_image, fn_alex_image, recognition_threshold=0, gpu_id=0, runtime_compilation=1, route_batch_size=1, match_window=0, match_index_points=0, io_binding=False, session_options=None):
+        """
+        :param session_options: The execution providers in order of preference, thread counts and graph optimization level of the network.
+        """
         self._quit_event.clear()
         with self._lock:
-            _load_image = lambda fname: self._fn_alex_image(cv2.imread(fname))
-            _store = FileSystemRouteDataSource(self._routes_directory, fn_load_image=_load_image, load_instructions=False)
+            # The images are loaded on demand for features not in the cache.
+            _store = FileSystemRouteDataSource(self._routes_directory, load_instructions=False, load_images=False)
             self._store = ReloadableDataSource(_store)
             self._fn_dave_image = fn_dave_image
             self._fn_alex_image = fn_alex_image
-            if self._network is not None:
+            self._preprocess = create_fused_preprocessor(fn_dave_image, fn_alex_image)
+            self._route_batch_size = route_batch_size
+            # A network with the same settings is kept so the restart does not have to build the session again.
+            _network_args = (gpu_id, runtime_compilation, io_binding, session_options)
+            if self._network is not None and _network_args != self._network_args:
                 self._network.deactivate()
-            self._network = self._create_network(gpu_id, runtime_compilation)
-            self._network.activate()
+                self._network = None
+            if self._network is None:
+                self._network = self._create_network(gpu_id, runtime_compilation, io_binding, session_options)
+                self._network_args = _network_args
+                self._network.activate()
+            elif self._network.will_compile():
+                self._network.activate()
             self._store.load_routes()
             self._memory.reset()
             self._memory.set_threshold(recognition_threshold)
+            self._memory.set_search(window=match_window, index_points=match_index_points)
             self._destination = None
+        self._start_watcher()
+
+    def get_provider(self):
+        return None if self._network is None else self._network.get_provider()
+
+    def prepare(self, image):
+        if self._preprocess is not None:
+            return self._preprocess(image)
+        return self._network.prepare_inputs(self._fn_dave_image(image), self._fn_alex_image(image))
 
-    def forward(self, image, route=None):
+    def forward(self, image, route=None, prepared=None):
         # This runs at the service process frequency.
         self._check_state(route)
-        _dave_img = self._fn_dave_image(image)
-        _alex_img = self._fn_alex_image(image)
+        _dave_input, _alex_input = self.prepare(image) if prepared is None else prepared
         _destination = self._destination
         _command = 0 if _destination is None else 1
-        _out = self._network.forward(dave_image=_dave_img, alex_image=_alex_img, maneuver_command=_command, destination=_destination)
+        _out = self._network.forward_inputs(dave_input=_dave_input, alex_input=_alex_input, maneuver_command=_command, destination=_destination)
         action, critic, surprise, command, path, brake, brake_critic, coordinates, query = _out
 
         # noinspection PyUnusedLocal
@@ -215,13 +345,18 @@ class Navigator(object):
         self._destination = _destination
         return action, critic, surprise, brake, brake_critic, nav_point_id, nav_image_id, nav_distance, command, path
 
-    def quit(self):
+    def quit(self, restarting=False):
         # Store and network are thread-safe.
         self._quit_event.set()
         if self._store is not None:
             self._store.quit()
-        if self._network is not None:
+        # On restart the network is kept for when its settings remain the same.
+        if self._network is not None and not restarting:
             self._network.deactivate()
+            self._network = None
+        if self._watcher is not None and not restarting:
+            self._watcher.quit()
+            self._watcher = None
 
 
 def _norm_scale(v, min_=0.0, max_=1.0):
@@ -258,20 +393,28 @@ class TFRunner(Configurable):
         self._total_penalty_filter = None
         self._fn_steer_mu = None
         self._fn_brake_mu = None
+        self._pipelined = False
 
     def get_gpu(self):
         return self._gpu_id
 
+    def is_pipelined(self):
+        return self._pipelined
+
     def get_frequency(self):
         return self._process_frequency
 
+    def get_capabilities(self):
+        return {"provider": self._navigator.get_provider()}
+
     def internal_quit(self, restarting=False):
-        self._navigator.quit()
+        self._navigator.quit(restarting)
 
     def internal_start(self, **kwargs):
         _errors = []
         self._gpu_id = parse_option("gpu.id", int, 0, _errors, **kwargs)
         self._process_frequency = parse_option("clock.hz", int, 20, _errors, **kwargs)
+        self._pipelined = parse_option("runtime.pipeline", bool, False, _errors, **kwargs)
         self._steering_scale_left = parse_option("driver.dnn.steering.scale.left", lambda x: abs(float(x)), -1, _errors, **kwargs)
         self._steering_scale_right = parse_option("driver.dnn.steering.scale.right", float, 1, _errors, **kwargs)
         _penalty_up_momentum = parse_option("driver.autopilot.filter.momentum.up", float, 0.35, _errors, **kwargs)
@@ -286,14 +429,45 @@ class TFRunner(Configurable):
         _fn_alex_image = get_registered_function("dnn.image.transform.alex", "alex__200_100", _errors, **kwargs)
         _nav_threshold = parse_option("navigator.point.recognition.threshold", float, 0.100, _errors, **kwargs)
         _rt_compile = parse_option("runtime.graph.compilation", int, 1, _errors, **kwargs)
-        self._navigator.restart(fn_dave_image=_fn_dave_image, fn_alex_image=_fn_alex_image, recognition_threshold=_nav_threshold, gpu_id=self._gpu_id, runtime_compilation=_rt_compile)
+        _route_batch_size = parse_option("navigator.route.batch.size", int, 8, _errors, **kwargs)
+        _match_window = parse_option("navigator.match.window", int, 0, _errors, **kwargs)
+        _match_index_points = parse_option("navigator.match.index.points", int, 0, _errors, **kwargs)
+        _io_binding = parse_option("runtime.io.binding", bool, False, _errors, **kwargs)
+        _providers = [x.strip().lower() for x in parse_option("runtime.providers", str, "cuda,cpu", _errors, **kwargs).split(",") if x.strip()]
+        for _provider in [x for x in _providers if x not in EXECUTION_PROVIDERS]:
+            _errors.append(PropertyError("runtime.providers", "Unknown execution provider '{}'.".format(_provider), suggestions=sorted(EXECUTION_PROVIDERS.keys())))
+        _graph_optimization = parse_option("runtime.graph.optimization", str, "all", _errors, **kwargs)
+        if _graph_optimization not in GRAPH_OPTIMIZATION_LEVELS:
+            _errors.append(PropertyError("runtime.graph.optimization", "Unknown level '{}'.".format(_graph_optimization), suggestions=sorted(GRAPH_OPTIMIZATION_LEVELS.keys())))
+        _session_options = dict(
+            providers=_providers,
+            intra_op_threads=parse_option("runtime.threads.intra", int, 0, _errors, **kwargs),
+            inter_op_threads=parse_option("runtime.threads.inter", int, 0, _errors, **kwargs),
+            graph_optimization=_graph_optimization,
+        )
+        self._navigator.restart(
+            fn_dave_image=_fn_dave_image,
+            fn_alex_image=_fn_alex_image,
+            recognition_threshold=_nav_threshold,
+            gpu_id=self._gpu_id,
+            runtime_compilation=_rt_compile,
+            route_batch_size=_route_batch_size,
+            match_window=_match_window,
+            match_index_points=_match_index_points,
+            io_binding=_io_binding,
+            session_options=_session_options,
+        )
         return _errors
 
     def _dnn_steering(self, raw):
         return raw * (self._steering_scale_left if raw < 0 else self._steering_scale_right)
 
-    def forward(self, image, route=None):
-        _out = self._navigator.forward(image, route)
+    def prepare(self, image):
+        return self._navigator.prepare(image)
+
+    def forward(self, image, route=None, trace=None, prepared=None):
+        _trace = stamp_trace(trace, "capture")
+        _out = self._navigator.forward(image, route, prepared)
         action, critic, surprise, brake, brake_critic, nav_point_id, nav_image_id, nav_distance, command, path = _out
         _command_index = int(np.argmax(command))
         _steer_penalty = min(1, max(0, self._fn_steer_mu(surprise=max(0, surprise), loss=abs(surprise - critic))))
@@ -322,6 +496,7 @@ class TFRunner(Configurable):
             navigation_distance=float(1 if nav_distance is None else nav_distance),
             navigation_command=int(_command_index),
             navigation_path=[float(v) for v in path],
+            trace=stamp_trace(_trace, "inference"),
         )
 
 
@@ -343,6 +518,10 @@ class InferenceApplication(Application):
         self.ipc_server = None
         self.teleop = None
         self.ipc_chatter = None
+        # The network runs on the executor in pipelined mode.
+        self._executor = None
+        self._pending = None
+        self._capabilities = None
 
     @staticmethod
     def _glob(directory, pattern):
@@ -364,12 +543,23 @@ class InferenceApplication(Application):
         if self.active():
             _restarted = self._runner.restart(**self._config())
             if _restarted:
-                self.ipc_server.register_start(self._runner.get_errors())
+                self._capabilities = self._runner.get_capabilities()
+                self.ipc_server.register_start(self._runner.get_errors(), self._capabilities)
                 _frequency = self._runner.get_frequency()
                 self.set_hz(_frequency)
-                self.logger.info("Processing at {} Hz on gpu {}.".format(_frequency, self._runner.get_gpu()))
+                self._set_pipelined(self._runner.is_pipelined())
+                self.logger.info("Processing at {} Hz on gpu {} pipelined {} with {}.".format(_frequency, self._runner.get_gpu(), self._runner.is_pipelined(), self._runner.get_capabilities()))
+
+    def _set_pipelined(self, pipelined):
+        if pipelined and self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        elif not pipelined and self._executor is not None:
+            self._flush()
+            self._executor.shutdown(wait=True)
+            self._executor = None
 
     def finish(self):
+        self._set_pipelined(False)
         self._runner.quit()
 
     # def run(self):
@@ -379,20 +569,45 @@ class InferenceApplication(Application):
     #         super(InferenceApplication, self).run()
     #     profiler.dump_stats('/config/inference.stats')
 
+    def _forward(self, md, image, route, prepared=None):
+        state = self._runner.forward(image=image, route=route, trace=md.get("trace"), prepared=prepared)
+        # The time of the camera frame the state is derived from.
+        state["image_time"] = md.get("time")
+        return state
+
+    def _publish(self, state):
+        state["_fps"] = self.get_actual_hz()
+        self.publisher.publish(state)
+
+    def _flush(self):
+        if self._pending is not None:
+            _pending, self._pending = self._pending, None
+            self._publish(_pending.result())
+
     def step(self):
         # Leave the state as is on empty teleop state.
         c_teleop = self.teleop()
-        image = self.camera.capture()[-1]
+        md, image = self.camera.capture()
         if image is not None:
             # The teleop service is the authority on route state.
             c_route = None if c_teleop is None else c_teleop.get("navigator").get("route")
-            state = self._runner.forward(image=image, route=c_route)
-            state["_fps"] = self.get_actual_hz()
-            self.publisher.publish(state)
+            if self._executor is None:
+                self._publish(self._forward(md, image, c_route))
+            else:
+                # Prepare this frame while the previous one runs through the network.
+                _prepared = self._runner.prepare(image)
+                self._flush()
+                self._pending = self._executor.submit(self._forward, md, image, c_route, _prepared)
         chat = self.ipc_chatter()
         if chat is not None:
             if chat.get("command") == "restart":
+                self._flush()
                 self.setup()
+        # A newer model swapped in by the navigator may run on another provider.
+        _capabilities = self._runner.get_capabilities()
+        if self._capabilities is not None and _capabilities != self._capabilities:
+            self._capabilities = _capabilities
+            self.ipc_server.register_capabilities(_capabilities)
 
 
 def main():
@@ -406,16 +621,17 @@ def main():
     application = InferenceApplication(config_dir=args.config, internal_models=args.internal, user_models=args.user, navigation_routes=args.routes)
     quit_event = application.quit_event
 
-    teleop = json_collector(url="ipc:///byodr/teleop.sock", topic=b"aav/teleop/input", event=quit_event)
-    ipc_chatter = json_collector(url="ipc:///byodr/teleop_c.sock", topic=b"aav/teleop/chatter", pop=True, event=quit_event)
+    collector = PollingCollectorThread(event=quit_event)
+    teleop = collector.add(JSONReceiver(url="ipc:///byodr/teleop.sock", topic=b"aav/teleop/input"))
+    ipc_chatter = collector.add(JSONReceiver(url="ipc:///byodr/teleop_c.sock", topic=b"aav/teleop/chatter", pop=True))
 
-    application.publisher = JSONPublisher(url="ipc:///byodr/inference.sock", topic="aav/inference/state")
+    application.publisher = JSONPublisher(url="ipc:///byodr/inference.sock", topic="aav/inference/state", codec="msgpack")
     application.camera = CameraThread(url="ipc:///byodr/camera_0.sock", topic=b"aav/camera/0", event=quit_event)
     application.ipc_server = LocalIPCServer(url="ipc:///byodr/inference_c.sock", name="inference", event=quit_event)
     application.teleop = lambda: teleop.get()
     application.ipc_chatter = lambda: ipc_chatter.get()
 
-    threads = [teleop, ipc_chatter, application.camera, application.ipc_server]
+    threads = [collector, application.camera, application.ipc_server]
     if quit_event.is_set():
         return 0
 
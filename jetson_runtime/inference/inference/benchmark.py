@@ -0,0 +1,225 @@
+from __future__ import absolute_import
+
+import argparse
+import csv
+import io
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import zipfile
+
+import cv2
+import numpy as np
+
+from BYODR_utils.common.latency import LatencyTracker, new_trace
+from .app import Navigator, RouteMemory, TFRunner
+from .image import create_fused_preprocessor, get_registered_function, hwc_to_chw
+
+if sys.version_info > (3,):
+    from configparser import ConfigParser as SafeConfigParser
+else:
+    from six.moves.configparser import SafeConfigParser
+
+logger = logging.getLogger(__name__)
+
+
+def _synthetic_route(n_images, images_per_point, coordinate_size, key_size, value_size, seed=0):
+    _random = np.random.RandomState(seed)
+    n_points = max(1, n_images // images_per_point)
+    code_points = [min(n_points - 1, i // images_per_point) for i in range(n_images)]
+    coordinates = _random.rand(n_images, coordinate_size).astype(np.float32)
+    keys = _random.rand(n_images, key_size).astype(np.float32)
+    values = _random.rand(n_images, value_size).astype(np.float32)
+    return n_points, code_points, coordinates, keys, values
+
+
+def _legacy_kernel(code_book, keys, features, query):
+    # The per frame cost of the sklearn and scipy implementation.
+    from scipy.special import softmax
+    from sklearn.metrics.pairwise import cosine_distances
+
+    _p_out = softmax(np.matmul(query.reshape([1, -1]), keys.T)).flatten()
+    _errors = cosine_distances(code_book, np.reshape(features, [1, -1])).flatten()
+    return _p_out * np.exp(-np.e * _errors)
+
+
+def match(args):
+    print("{:>8} {:>12} {:>12} {:>12} {:>12}".format("images", "legacy ms", "full ms", "window ms", "index ms"))
+    for n_images in args.sizes:
+        n_points, code_points, coordinates, keys, values = _synthetic_route(n_images, args.images_per_point, args.coordinate_size, args.key_size, args.value_size)
+        # Frames follow the route images with some noise.
+        _random = np.random.RandomState(1)
+        _frames = [(coordinates[i] + 0.05 * _random.rand(args.coordinate_size).astype(np.float32), keys[i]) for i in range(0, n_images, max(1, n_images // args.frames))]
+        timings = [np.mean([timeit.timeit(lambda: _legacy_kernel(coordinates, keys, f, q), number=1) for f, q in _frames])]
+        for window, index_points in ((0, 0), (args.window, 0), (0, args.index_points)):
+            memory = RouteMemory()
+            memory.set_threshold(args.threshold)
+            memory.set_search(window=window, index_points=index_points)
+            memory.reset(n_points, code_points, coordinates, keys, values)
+            timings.append(np.mean([timeit.timeit(lambda: memory.match(f, q), number=1) for f, q in _frames]))
+        print("{:>8} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}".format(n_images, *[1e3 * t for t in timings]))
+
+
+def preprocess(args):
+    _errors = []
+    fn_dave_image = get_registered_function("dave", args.dave, _errors)
+    fn_alex_image = get_registered_function("alex", args.alex, _errors)
+    fused = create_fused_preprocessor(fn_dave_image, fn_alex_image)
+    if _errors or fused is None:
+        print("The transforms '{}' and '{}' cannot be fused.".format(args.dave, args.alex))
+        return
+    _random = np.random.RandomState(0)
+    image = _random.randint(0, 255, (args.height, args.width, 3)).astype(np.uint8)
+
+    def _separate():
+        # The previous path with the input wrapping of the driver.
+        return np.array([hwc_to_chw(fn_dave_image(image))], dtype=np.uint8), np.array([hwc_to_chw(fn_alex_image(image))], dtype=np.uint8)
+
+    assert all(np.array_equal(a, b) for a, b in zip(_separate(), fused(image))), "The fused inputs differ."
+    _separate_ms = 1e3 * min(timeit.repeat(_separate, number=args.number, repeat=5)) / args.number
+    _fused_ms = 1e3 * min(timeit.repeat(lambda: fused(image), number=args.number, repeat=5)) / args.number
+    print("{}x{} separate {:.3f} ms fused {:.3f} ms".format(args.width, args.height, _separate_ms, _fused_ms))
+
+
+def _archive_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(root, f) for root, _, names in os.walk(path) for f in names if f.endswith(".zip")))
+        else:
+            files.append(path)
+    return files
+
+
+def _archive_images(archive):
+    # The session csv lists the images in order of capture but it is only written when the session closes.
+    _csv = [n for n in archive.namelist() if n.endswith(".csv")]
+    if _csv:
+        with io.TextIOWrapper(archive.open(_csv[0])) as f:
+            return [row["image_uri"] for row in csv.DictReader(f)]
+    return sorted(n for n in archive.namelist() if n.endswith(".jpg"))
+
+
+def load_frames(paths, max_frames=0):
+    """Decodes the camera images of the autopilot sessions written by the logbox zip data source."""
+    frames = []
+    for path in _archive_files(paths):
+        with zipfile.ZipFile(path) as archive:
+            for name in _archive_images(archive):
+                if 0 < max_frames <= len(frames):
+                    return frames
+                frames.append(cv2.imdecode(np.frombuffer(archive.read(name), dtype=np.uint8), cv2.IMREAD_COLOR))
+    return frames
+
+
+def _replay_config(args):
+    parser = SafeConfigParser()
+    if args.config is not None:
+        parser.read(args.config)
+    cfg = dict(parser.items("inference")) if parser.has_section("inference") else {}
+    cfg["runtime.providers"] = args.providers
+    return cfg
+
+
+def _replay_model(model, frames, args):
+    # Each model gets its own directories so the session caches start out the same.
+    _directory = tempfile.mkdtemp()
+    try:
+        _models, _user, _routes = [os.path.join(_directory, x) for x in ("models", "user", "routes")]
+        [os.makedirs(x) for x in (_models, _user, _routes)]
+        os.symlink(os.path.abspath(model), os.path.join(_models, "runtime.onnx"))
+        runner = TFRunner(navigator=Navigator(_user, _models, _routes))
+        runner.start(**_replay_config(args))
+        if runner.get_errors():
+            logger.warning("Configuration errors {}.".format([str(e) for e in runner.get_errors()]))
+        tracker = LatencyTracker(stages=("camera", "capture", "inference"))
+        capabilities = runner.get_capabilities()
+        states = []
+        try:
+            _period = 0 if args.hz <= 0 else 1.0 / args.hz
+            for image in frames[: args.warmup]:
+                runner.forward(image=image, prepared=runner.prepare(image))
+            _start = time.time()
+            for i, image in enumerate(frames):
+                if _period > 0:
+                    time.sleep(max(0, _start + i * _period - time.time()))
+                _trace = new_trace("camera")
+                state = runner.forward(image=image, trace=_trace, prepared=runner.prepare(image))
+                tracker.record(state["trace"], end_stage="done")
+                states.append(state)
+            _duration = time.time() - _start
+        finally:
+            runner.quit()
+        return len(frames) / max(1e-9, _duration), tracker.summary(), capabilities, states
+    finally:
+        shutil.rmtree(_directory, ignore_errors=True)
+
+
+def replay(args):
+    frames = load_frames(args.archives, args.max_frames)
+    if not frames:
+        print("There are no images in {}.".format(args.archives))
+        return
+    print("Replaying {} frames of {}x{}.".format(len(frames), frames[0].shape[1], frames[0].shape[0]))
+    # Time spent in the camera stage is the input preparation and capture to inference is the network and navigation.
+    results = []
+    for model in args.models:
+        fps, summary, capabilities, states = _replay_model(model, frames, args)
+        # The maximum resident size is the peak of the process so it includes the models replayed before.
+        _rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        print("{} on {} {:.1f} fps peak rss so far {:.0f} MB".format(model, capabilities.get("provider"), fps, _rss_mb))
+        for name, values in summary.items():
+            print("  {:>20} p50 {:8.3f} p95 {:8.3f} p99 {:8.3f} ms".format(name, values["p50"], values["p95"], values["p99"]))
+        results.append(states)
+    if len(results) > 1:
+        for key in ("action", "obstacle", "surprise_out", "critic_out"):
+            _difference = np.abs(np.array([s[key] for s in results[0]]) - np.array([s[key] for s in results[1]]))
+            print("{:>14} mean abs difference {:.5f} max {:.5f}".format(key, np.mean(_difference), np.max(_difference)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inference benchmarks.")
+    subparsers = parser.add_subparsers(dest="command")
+    _match = subparsers.add_parser("match", help="Per frame cost of the route memory match by route size.")
+    _match.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000, 20000], help="Number of route images.")
+    _match.add_argument("--images-per-point", type=int, default=5, help="Number of images per navigation point.")
+    _match.add_argument("--coordinate-size", type=int, default=512, help="Length of the coordinate features.")
+    _match.add_argument("--key-size", type=int, default=64, help="Length of the destination keys.")
+    _match.add_argument("--value-size", type=int, default=150, help="Length of the destination values.")
+    _match.add_argument("--frames", type=int, default=200, help="Number of frames to match per route.")
+    _match.add_argument("--threshold", type=float, default=0.1, help="Recognition threshold.")
+    _match.add_argument("--window", type=int, default=5, help="Number of navigation points on either side in window mode.")
+    _match.add_argument("--index-points", type=int, default=10, help="Number of centroids to search in index mode.")
+    _match.set_defaults(func=match)
+    _preprocess = subparsers.add_parser("preprocess", help="Per frame cost of the network input preparation.")
+    _preprocess.add_argument("--width", type=int, default=640, help="Camera image width.")
+    _preprocess.add_argument("--height", type=int, default=480, help="Camera image height.")
+    _preprocess.add_argument("--dave", type=str, default="dave__320_240__200_66__0", help="Registered dave transform.")
+    _preprocess.add_argument("--alex", type=str, default="alex__200_100", help="Registered alex transform.")
+    _preprocess.add_argument("--number", type=int, default=500, help="Number of frames per repeat.")
+    _preprocess.set_defaults(func=preprocess)
+    _replay = subparsers.add_parser("replay", help="Throughput and latency of the inference runner over recorded autopilot sessions.")
+    _replay.add_argument("archives", type=str, nargs="+", help="Session zip files or directories with them.")
+    _replay.add_argument("--models", type=str, nargs="+", required=True, help="One onnx model or two to compare.")
+    _replay.add_argument("--config", type=str, default=None, help="Inference ini file with an inference section.")
+    _replay.add_argument("--providers", type=str, default="cpu", help="Execution providers in order of preference.")
+    _replay.add_argument("--hz", type=float, default=0, help="Frame rate to feed the frames at, zero is as fast as possible.")
+    _replay.add_argument("--warmup", type=int, default=10, help="Number of frames to run before the measurement.")
+    _replay.add_argument("--max-frames", type=int, default=0, help="Maximum number of frames to load, zero is all.")
+    _replay.set_defaults(func=replay)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+    else:
+        args.func(args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s: %(asctime)s %(filename)s %(funcName)s %(message)s", datefmt="%Y%m%d:%H:%M:%S %p %Z")
+    logging.getLogger().setLevel(logging.WARNING)
+    main()
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_ARRAY_NAMES = ("coordinates", "keys", "values")
+
+
+def file_hash(path, block_size=1 << 20):
+    _sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            _sha.update(block)
+    return _sha.hexdigest()
+
+
+def function_description(fn):
+    # The registered image transforms are partial functions.
+    return "{}{}".format(getattr(getattr(fn, "func", fn), "__name__", ""), sorted(getattr(fn, "keywords", {}).items()))
+
+
+class RouteFeatureCache(object):
+    """
+    On disk features of the route images in a directory per route and feature key e.g. the model file hash.
+    Rows are reused as long as the image file has the same modification time.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def _load(self, directory):
+        try:
+            with open(os.path.join(directory, "index.json")) as f:
+                index = json.load(f)
+            arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in _ARRAY_NAMES]
+            return index, arrays
+        except (IOError, OSError, ValueError):
+            return {}, None
+
+    def _save(self, route, directory, index, arrays):
+        # Features of other keys for this route are stale.
+        _route_directory = os.path.dirname(directory)
+        if os.path.isdir(_route_directory):
+            [shutil.rmtree(os.path.join(_route_directory, d), ignore_errors=True) for d in os.listdir(_route_directory) if d != os.path.basename(directory)]
+        _tmp = directory + ".tmp"
+        shutil.rmtree(_tmp, ignore_errors=True)
+        os.makedirs(_tmp)
+        for name, array in zip(_ARRAY_NAMES, arrays):
+            np.save(os.path.join(_tmp, name + ".npy"), array)
+        with open(os.path.join(_tmp, "index.json"), "w") as f:
+            json.dump(index, f)
+        # Mapped arrays of the previous version remain valid after the swap.
+        shutil.rmtree(directory, ignore_errors=True)
+        os.rename(_tmp, directory)
+        logger.info("Cached the features of {} images for route '{}'.".format(len(index), route))
+
+    def features(self, route, key, files, fn_features):
+        """
+        :param fn_features: Computes the coordinates, keys and values for a list of image files.
+        :return: The coordinates, keys and values in the order of the files.
+        """
+        _directory = os.path.join(self._directory, route, key)
+        _mtimes = [os.path.getmtime(f) for f in files]
+        index, arrays = self._load(_directory)
+        _rows = [index.get(f, (-1, None)) for f in files]
+        _misses = [i for i, (row, mtime) in enumerate(_rows) if row < 0 or mtime != _mtimes[i]]
+        _computed = fn_features([files[i] for i in _misses]) if _misses else ([], [], [])
+        _results = [[None] * len(files) for _ in _ARRAY_NAMES]
+        for i, (row, _) in enumerate(_rows):
+            if row >= 0:
+                for result, array in zip(_results, arrays):
+                    result[i] = array[row]
+        for j, i in enumerate(_misses):
+            for result, computed in zip(_results, _computed):
+                result[i] = computed[j]
+        if files and (_misses or len(index) != len(files)):
+            try:
+                self._save(route, _directory, dict((f, (i, _mtimes[i])) for i, f in enumerate(files)), [np.array(r) for r in _results])
+            except (IOError, OSError) as e:
+                logger.warning("Unable to cache the route features: {}".format(e))
+        return _results
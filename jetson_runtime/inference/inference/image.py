@@ -65,6 +65,48 @@ _registered_functions = {
 }
 
 
+class FusedPreprocessor(object):
+    """
+    Computes the dave and alex network inputs from one shared resized image.
+    The inputs are written to preallocated N,C,H,W buffers which rotate so the previous inputs stay valid while the next are prepared.
+    """
+
+    def __init__(self, resize_wh, dave_crop=(0, 0, 0, 0), dave_wh=(200, 66), alex_wh=(200, 100), num_buffers=2):
+        self._resize_wh = resize_wh
+        self._dave_crop = dave_crop
+        self._dave_wh = dave_wh
+        self._alex_wh = alex_wh
+        self._intermediate = np.empty((resize_wh[1], resize_wh[0], 3), dtype=np.uint8)
+        self._dave_hwc = np.empty((dave_wh[1], dave_wh[0], 3), dtype=np.uint8)
+        self._alex_hwc = np.empty((alex_wh[1], alex_wh[0], 3), dtype=np.uint8)
+        self._buffers = [(np.empty((1, 3, dave_wh[1], dave_wh[0]), dtype=np.uint8), np.empty((1, 3, alex_wh[1], alex_wh[0]), dtype=np.uint8)) for _ in range(num_buffers)]
+        self._index = 0
+
+    def __call__(self, image):
+        self._index = (self._index + 1) % len(self._buffers)
+        dave, alex = self._buffers[self._index]
+        _shared = cv2.resize(image, self._resize_wh, dst=self._intermediate)
+        top, right, bottom, left = self._dave_crop
+        cv2.resize(_shared[top : _shared.shape[0] - bottom, left : _shared.shape[1] - right], self._dave_wh, dst=self._dave_hwc)
+        cv2.resize(_shared, self._alex_wh, dst=self._alex_hwc)
+        np.copyto(dave[0], hwc_to_chw(self._dave_hwc))
+        np.copyto(alex[0], hwc_to_chw(self._alex_hwc))
+        return dave, alex
+
+
+def create_fused_preprocessor(fn_dave_image, fn_alex_image, num_buffers=2):
+    """Returns None when the registered transforms cannot be computed from one shared image."""
+    _dave, _alex = getattr(fn_dave_image, "func", None), getattr(fn_alex_image, "func", None)
+    if _dave is not caffe_dave_200_66 or _alex is not hwc_squeeze:
+        return None
+    _dave_kw, _alex_kw = fn_dave_image.keywords, fn_alex_image.keywords
+    _resize_wh = _dave_kw.get("resize_wh")
+    _plain_dave = _dave_kw.get("dave", True) and not _dave_kw.get("yuv", True) and not _dave_kw.get("chw", True)
+    if _resize_wh is None or _resize_wh != _alex_kw.get("resize_wh") or not _plain_dave or fn_dave_image.args or fn_alex_image.args:
+        return None
+    return FusedPreprocessor(resize_wh=_resize_wh, dave_crop=_dave_kw.get("crop", (0, 0, 0, 0)), num_buffers=num_buffers)
+
+
 def get_registered_function(key, default_value, errors, **kwargs):
     name = kwargs.get(key, default_value)
     if name in _registered_functions:
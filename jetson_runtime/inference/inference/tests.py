@@ -1,11 +1,20 @@
 from __future__ import absolute_import
 
+import hashlib
+import json
 import os
 import sys
+import threading
 from io import open
 
+import numpy as np
+import pytest
+
 from BYODR_utils.common.testing import CollectPublisher, QueueReceiver, CollectServer, QueueCamera
-from .app import InferenceApplication, TFRunner
+from .cache import RouteFeatureCache, file_hash
+from .app import InferenceApplication, RouteMemory, TFRunner
+from .image import FusedPreprocessor
+from .torched import TRTDriver
 
 if sys.version_info > (3,):
     from configparser import ConfigParser as SafeConfigParser
@@ -17,10 +26,13 @@ class FakeNavigator(object):
     def recompile(self):
         pass
 
-    def restart(self, fn_dave_image, fn_alex_image, recognition_threshold=0, gpu_id=0, runtime_compilation=1):
+    def restart(self, fn_dave_image, fn_alex_image, recognition_threshold=0, gpu_id=0, runtime_compilation=1, route_batch_size=1, match_window=0, match_index_points=0, io_binding=False, session_options=None):
         pass
 
-    def quit(self):
+    def get_provider(self):
+        return None
+
+    def quit(self, restarting=False):
         pass
 
 
@@ -66,3 +78,238 @@ def test_create_and_setup(tmpdir):
         assert app.get_process_frequency() == new_process_frequency
     finally:
         app.finish()
+
+
+class PipelineNavigator(FakeNavigator):
+    def __init__(self):
+        self._preprocess = FusedPreprocessor(resize_wh=(32, 24), dave_wh=(8, 6), alex_wh=(8, 4), num_buffers=2)
+        self._expected = FusedPreprocessor(resize_wh=(32, 24), dave_wh=(8, 6), alex_wh=(8, 4), num_buffers=1)
+        self._next = threading.Event()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.errors = []
+
+    def prepare(self, image):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self._next.set()
+        return self._preprocess(image)
+
+    def forward(self, image, route=None, prepared=None):
+        # Keep the frame in the network until the next one is prepared.
+        self._next.wait(0.2)
+        self._next.clear()
+        _dave, _alex = self._expected(image)
+        if not (np.array_equal(prepared[0], _dave) and np.array_equal(prepared[1], _alex)):
+            self.errors.append(int(image[0, 0, 0]))
+        self.in_flight -= 1
+        return 0.0, 0.0, 0.0, 0.0, 0.0, None, None, None, [1, 0, 0, 0], [0.0]
+
+
+def test_pipeline_within_the_preprocessor_buffers(tmpdir):
+    directory = str(tmpdir.realpath())
+    _parser = SafeConfigParser()
+    _parser.add_section("inference")
+    _parser.set("inference", "runtime.pipeline", "true")
+    with open(os.path.join(directory, "pipeline.ini"), "w") as f:
+        _parser.write(f)
+    navigator = PipelineNavigator()
+    app = InferenceApplication(runner=TFRunner(navigator=navigator), config_dir=directory, internal_models=directory)
+    app.publisher = CollectPublisher()
+    app.camera = QueueCamera()
+    app.ipc_server = CollectServer()
+    app.teleop = lambda: None
+    app.ipc_chatter = lambda: None
+    try:
+        app.setup()
+        assert app._runner.is_pipelined()
+        for i in range(10):
+            app.camera.add(dict(time=i), np.full((24, 32, 3), i * 10, dtype=np.uint8))
+            app.step()
+    finally:
+        app.finish()
+    # A frame is prepared while the previous one runs so no more than the two buffers are in use.
+    assert navigator.max_in_flight == 2
+    assert navigator.errors == []
+    assert [x["image_time"] for x in app.publisher.collect()] == list(range(10))
+
+
+def test_route_memory_search_modes():
+    _random = np.random.RandomState(0)
+    n_points, n_images = 40, 200
+    code_points = [i // 5 for i in range(n_images)]
+    coordinates = _random.randn(n_images, 32).astype(np.float32)
+    keys = _random.rand(n_images, 8).astype(np.float32)
+    values = _random.rand(n_images, 150).astype(np.float32)
+
+    memories = []
+    for window, index_points in ((0, 0), (3, 0), (0, 4)):
+        memory = RouteMemory()
+        memory.set_threshold(0.1)
+        memory.set_search(window=window, index_points=index_points)
+        memory.reset(n_points, code_points, coordinates, keys, values)
+        memories.append(memory)
+
+    # The cosine distances without candidate restrictions.
+    features = coordinates[7] + 0.01
+    _expected = 1 - np.matmul(coordinates, features) / (np.linalg.norm(coordinates, axis=1) * np.linalg.norm(features))
+    assert np.allclose(memories[0]._distances(features / np.linalg.norm(features)), _expected, atol=1e-6)
+
+    # Driving the route in order the restricted searches find the same points as long as the features are distinct.
+    matches = [[], [], []]
+    for image_id in range(n_images):
+        for memory, _matches in zip(memories, matches):
+            _match, _image, _distance, _ = memory.match(coordinates[image_id] + 0.01, keys[image_id])
+            _matches.append(_match)
+    assert len([m for m in matches[0] if m is not None]) > n_points / 2
+    assert matches[0] == matches[1] == matches[2]
+
+
+def _toy_model(directory, weight=1.0, name="runtime.onnx"):
+    # The graph outputs in the order of the model with the feature outputs from the alex image and the heads from the dave image.
+    onnx = pytest.importorskip("onnx")
+    from onnx import TensorProto, helper, numpy_helper
+
+    inputs = [
+        helper.make_tensor_value_info("input/dave_image", TensorProto.UINT8, [None, 3, 8, 8]),
+        helper.make_tensor_value_info("input/alex_image", TensorProto.UINT8, [None, 3, 8, 8]),
+        helper.make_tensor_value_info("input/maneuver_command", TensorProto.FLOAT, [None, 1]),
+        helper.make_tensor_value_info("input/current_destination", TensorProto.FLOAT, [None, 150]),
+    ]
+    nodes = [
+        helper.make_node("Cast", ["input/dave_image"], ["dave"], to=TensorProto.FLOAT),
+        helper.make_node("Flatten", ["dave"], ["dave_flat"]),
+        helper.make_node("MatMul", ["dave_flat", "weights"], ["head"]),
+        helper.make_node("Cast", ["input/alex_image"], ["alex"], to=TensorProto.FLOAT),
+        helper.make_node("Flatten", ["alex"], ["alex_flat"]),
+    ]
+    outputs = []
+    for i in range(12):
+        _source = "alex_flat" if i in (7, 8, 10, 11) else "head"
+        nodes.append(helper.make_node("ReduceMean", [_source], ["output/{}".format(i)], axes=[1], keepdims=1))
+        outputs.append(helper.make_tensor_value_info("output/{}".format(i), TensorProto.FLOAT, [None, 1]))
+    _weights = numpy_helper.from_array(np.full((192, 16), weight, dtype=np.float32), "weights")
+    model = helper.make_model(helper.make_graph(nodes, "toy", inputs, outputs, [_weights]), opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, os.path.join(directory, name))
+
+
+def test_features_graph(tmpdir):
+    directory = str(tmpdir.realpath())
+    _toy_model(directory)
+    driver = TRTDriver(directory, None, providers=("cpu",))
+    driver.activate()
+    try:
+        # The route features run on the sub-graph without the heads.
+        assert driver._features_sess is not None
+        assert os.path.isfile(os.path.join(directory, ".cache", "onnx", "{}_features.onnx".format(driver.get_model_hash()[:16])))
+        images = [np.full((8, 8, 3), i, dtype=np.uint8) for i in range(3)]
+        coordinates, keys, values = driver.features_batch(images, images, batch_size=2)
+        assert [float(x[0]) for x in keys] == [0, 1, 2]
+        assert np.allclose(coordinates, [[i, i] for i in range(3)])
+        _full = driver.forward(images[2], images[2])
+        assert np.allclose(_full[7], coordinates[2])
+    finally:
+        driver.deactivate()
+
+
+def test_file_hash(tmpdir):
+    _file = str(tmpdir.join("graph.onnx"))
+    with open(_file, "wb") as f:
+        f.write(b"graph" * 1000)
+    # The hash does not depend on the block size the file is read in.
+    assert file_hash(_file) == file_hash(_file, block_size=7) == hashlib.sha1(b"graph" * 1000).hexdigest()
+    with open(_file, "ab") as f:
+        f.write(b"!")
+    assert file_hash(_file) != hashlib.sha1(b"graph" * 1000).hexdigest()
+
+
+def test_route_feature_cache(tmpdir):
+    _routes = str(tmpdir.join("routes"))
+    files = []
+    for i in range(3):
+        files.append(str(tmpdir.join("{}.jpg".format(i))))
+        with open(files[-1], "wb") as f:
+            f.write(b"jpg")
+    _computed = []
+
+    def _features(paths):
+        _computed.extend(paths)
+        _values = [float(os.path.basename(p)[0]) + os.path.getmtime(p) % 1 for p in paths]
+        return [[np.full(2, v) for v in _values], [np.full(4, v) for v in _values], [np.full(1, v) for v in _values]]
+
+    coordinates, keys, values = RouteFeatureCache(_routes).features("route", "model", files, _features)
+    assert _computed == files
+    assert [k[0] for k in keys] == [float(i) + os.path.getmtime(f) % 1 for i, f in enumerate(files)]
+    # Reopened on the next start the rows are reused.
+    del _computed[:]
+    coordinates, keys, values = RouteFeatureCache(_routes).features("route", "model", files, _features)
+    assert _computed == []
+    assert [c.shape for c in coordinates] == [(2,)] * 3 and [k.shape for k in keys] == [(4,)] * 3
+    # The image that was modified is computed again.
+    _mtime = os.path.getmtime(files[1]) + 10.5
+    os.utime(files[1], (_mtime, _mtime))
+    coordinates, keys, values = RouteFeatureCache(_routes).features("route", "model", files, _features)
+    assert _computed == [files[1]]
+    assert values[1][0] == 1 + _mtime % 1
+    # Removed images leave the index.
+    del _computed[:]
+    RouteFeatureCache(_routes).features("route", "model", [files[0], files[2]], _features)
+    assert _computed == []
+    with open(os.path.join(_routes, "route", "model", "index.json")) as f:
+        assert sorted(json.load(f)) == sorted([files[0], files[2]])
+    # Another model replaces the features of the route.
+    RouteFeatureCache(_routes).features("route", "other", files, _features)
+    assert os.listdir(os.path.join(_routes, "route")) == ["other"]
+
+
+def test_swap_prunes_the_previous_model(tmpdir):
+    directory = str(tmpdir.realpath())
+    _toy_model(directory)
+    driver = TRTDriver(directory, None, providers=("cpu",))
+    driver.activate()
+    _cache = os.path.join(directory, ".cache", "onnx")
+    try:
+        _previous = driver.get_model_hash()[:16]
+        _toy_model(directory, weight=2.0, name="runtime_next.onnx")
+        _mtime = os.path.getmtime(os.path.join(directory, "runtime.onnx")) + 10
+        os.utime(os.path.join(directory, "runtime_next.onnx"), (_mtime, _mtime))
+        # The caches of the running model stay while the next one is built.
+        assert driver.prewarm()
+        assert driver.get_model_hash()[:16] == _previous
+        assert len(set(x[:16] for x in os.listdir(_cache))) == 2
+        driver.swap()
+        assert driver.get_model_hash()[:16] != _previous
+        assert set(x[:16] for x in os.listdir(_cache)) == {driver.get_model_hash()[:16]}
+    finally:
+        driver.deactivate()
+
+
+class SwapNavigator(FakeNavigator):
+    def __init__(self):
+        self.provider = "CUDAExecutionProvider"
+
+    def get_provider(self):
+        return self.provider
+
+
+def test_capabilities_follow_the_swap(tmpdir):
+    directory = str(tmpdir.realpath())
+    navigator = SwapNavigator()
+    app = InferenceApplication(runner=TFRunner(navigator=navigator), config_dir=directory, internal_models=directory)
+    app.publisher = CollectPublisher()
+    app.camera = QueueCamera()
+    app.ipc_server = CollectServer()
+    app.teleop = lambda: None
+    app.ipc_chatter = lambda: None
+    try:
+        app.setup()
+        app.step()
+        assert app.ipc_server.get_capabilities() == {"provider": "CUDAExecutionProvider"}
+        # The background build of a newer model fell back to the cpu.
+        navigator.provider = "CPUExecutionProvider"
+        app.step()
+        assert app.ipc_server.get_capabilities() == {"provider": "CPUExecutionProvider"}
+        assert len(app.ipc_server.collect()) == 1
+    finally:
+        app.finish()
@@ -4,14 +4,33 @@ import glob
 import logging
 import multiprocessing
 import os
+import shutil
+import threading
 
 import numpy as np
 import onnxruntime as ort
 
+try:
+    import onnx
+    import onnx.utils
+except ImportError:
+    onnx = None
+
+from .cache import file_hash
 from .image import hwc_to_chw
 
 logger = logging.getLogger(__name__)
 
+# The configurable execution providers by their short name.
+EXECUTION_PROVIDERS = {"tensorrt": "TensorrtExecutionProvider", "cuda": "CUDAExecutionProvider", "cpu": "CPUExecutionProvider"}
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disabled": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
 
 class DynamicMomentum(object):
     """Low-pass filter with separate acceleration and deceleration momentum."""
@@ -58,31 +77,183 @@ def _newest_file(paths, pattern):
 
 
 class TRTDriver(object):
-    def __init__(self, user_directory, internal_directory, gpu_id=0, runtime_compilation=1):
+    def __init__(self, user_directory, internal_directory, gpu_id=0, runtime_compilation=1, io_binding=False, providers=("cuda", "cpu"), intra_op_threads=0, inter_op_threads=0, graph_optimization="all"):
         self._gpu_id = gpu_id
         self._rt_compile = runtime_compilation
+        self._io_binding = io_binding
+        self._providers = [p for p in providers if p in EXECUTION_PROVIDERS]
+        self._intra_op_threads = intra_op_threads
+        self._inter_op_threads = inter_op_threads
+        self._graph_optimization = graph_optimization
+        self._cache_directory = None if user_directory is None else os.path.join(os.path.expanduser(user_directory), ".cache")
         self.model_directories = [user_directory, internal_directory]
         self._lock = multiprocessing.Lock()
+        self._build_lock = threading.Lock()
+        self._warm = None
         self._zero_vector = np.zeros(shape=(150,), dtype=np.float32)
+        self._command_input = np.zeros(shape=(1, 1), dtype=np.float32)
+        self._destination_input = np.zeros(shape=(1, 150), dtype=np.float32)
         self._sess = None
+        self._provider = None
+        self._binding = None
+        self._bound_outputs = None
         self._onnx_file = None
+        self._onnx_hash = None
+        self._feature_outputs = None
+        self._features_sess = None
+
+    def _session_options(self):
+        options = ort.SessionOptions()
+        # Zero leaves the thread pool size to the runtime.
+        options.intra_op_num_threads = self._intra_op_threads
+        options.inter_op_num_threads = self._inter_op_threads
+        if self._inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS.get(self._graph_optimization, ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+        return options
+
+    def _provider_options(self, name, cache_key):
+        if name == "tensorrt":
+            _options = {"device_id": str(self._gpu_id)}
+            if self._cache_directory is not None:
+                _engine_directory = os.path.join(self._cache_directory, "tensorrt", cache_key)
+                if not os.path.exists(_engine_directory):
+                    os.makedirs(_engine_directory)
+                _options.update(trt_engine_cache_enable="True", trt_engine_cache_path=_engine_directory)
+            return _options
+        elif name == "cuda":
+            return {"device_id": str(self._gpu_id)}
+        return {}
+
+    def _cache_key(self, onnx_hash, name):
+        # Compiled engines and optimized graphs are only valid for the same model, device and runtime.
+        return "{}_{}_gpu{}_ort{}".format(onnx_hash[:16], name, self._gpu_id, ort.__version__)
+
+    def _open_session(self, rt_file, name, cache_key):
+        _provider = EXECUTION_PROVIDERS[name]
+        _provider_options = [self._provider_options(name, cache_key)]
+        # The tensorrt provider has its own engine cache and compiled nodes cannot be saved.
+        if self._cache_directory is None or name == "tensorrt" or self._graph_optimization == "disabled":
+            return ort.InferenceSession(rt_file, sess_options=self._session_options(), providers=[_provider], provider_options=_provider_options)
+        _optimized_file = os.path.join(self._cache_directory, "onnx", "{}_{}.onnx".format(cache_key, self._graph_optimization))
+        if os.path.isfile(_optimized_file):
+            options = self._session_options()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            try:
+                return ort.InferenceSession(_optimized_file, sess_options=options, providers=[_provider], provider_options=_provider_options)
+            except Exception as e:
+                logger.warning("Discarding optimized graph '{}': {}".format(_optimized_file, e))
+                os.remove(_optimized_file)
+        if not os.path.exists(os.path.dirname(_optimized_file)):
+            os.makedirs(os.path.dirname(_optimized_file))
+        options = self._session_options()
+        options.optimized_model_filepath = _optimized_file + ".tmp"
+        session = ort.InferenceSession(rt_file, sess_options=options, providers=[_provider], provider_options=_provider_options)
+        if os.path.isfile(options.optimized_model_filepath):
+            if session.get_providers()[0] == _provider:
+                os.rename(options.optimized_model_filepath, _optimized_file)
+            else:
+                os.remove(options.optimized_model_filepath)
+        return session
 
-    def _activate(self):
+    def _prune_cache(self, onnx_hash):
+        # Only the newest model is in use.
+        for _directory in [os.path.join(self._cache_directory, x) for x in ("onnx", "tensorrt")]:
+            if os.path.isdir(_directory):
+                for name in [x for x in os.listdir(_directory) if not x.startswith(onnx_hash[:16])]:
+                    _path = os.path.join(_directory, name)
+                    if os.path.isdir(_path):
+                        shutil.rmtree(_path, ignore_errors=True)
+                    else:
+                        os.remove(_path)
+
+    def _features_model(self, rt_file, onnx_hash, output_names):
+        # The runtime executes the whole graph whatever the outputs fetched so the feature outputs get a graph of their own.
+        _file = None if self._cache_directory is None else os.path.join(self._cache_directory, "onnx", "{}_features.onnx".format(onnx_hash[:16]))
+        if _file is not None and os.path.isfile(_file):
+            return _file
+        _model = onnx.load(rt_file)
+        # Older graphs list the weights among the inputs.
+        _weights = set(x.name for x in _model.graph.initializer)
+        _model = onnx.utils.Extractor(_model).extract_model([x.name for x in _model.graph.input if x.name not in _weights], output_names)
+        if _file is None:
+            return _model.SerializeToString()
+        if not os.path.exists(os.path.dirname(_file)):
+            os.makedirs(os.path.dirname(_file))
+        onnx.save(_model, _file + ".tmp")
+        os.rename(_file + ".tmp", _file)
+        return _file
+
+    def _create_features_session(self, rt_file, onnx_hash, name, output_names):
+        if onnx is None:
+            logger.info("The onnx package is not installed, the route features are computed with the full graph.")
+            return None
+        try:
+            _model = self._features_model(rt_file, onnx_hash, output_names)
+            return self._open_session(_model, name, self._cache_key(onnx_hash, name) + "_features")
+        except Exception as e:
+            logger.warning("Could not create the route features graph, the full graph is used: {}".format(e))
+            return None
+
+    def _create_session(self, rt_file, onnx_hash):
+        _available = ort.get_available_providers()
+        for name in self._providers:
+            _provider = EXECUTION_PROVIDERS[name]
+            if _provider not in _available:
+                logger.info("Execution provider '{}' is not available.".format(_provider))
+                continue
+            try:
+                session = self._open_session(rt_file, name, self._cache_key(onnx_hash, name))
+            except Exception as e:
+                logger.warning("Execution provider '{}' failed: {}".format(_provider, e))
+                continue
+            # The runtime itself falls back to the cpu when the provider cannot be initialized.
+            if session.get_providers()[0] == _provider:
+                return session, name
+            logger.warning("Execution provider '{}' could not be initialized.".format(_provider))
+        return None, None
+
+    def _load(self):
         rt_file = _newest_file(self.model_directories, "runtime*.onnx")
         if rt_file is None or not os.path.isfile(rt_file):
             logger.warning("Missing optimized graph.")
-            return
+            return None
 
         logger.info("Located optimized graph '{}'.".format(rt_file))
-        # self._sess = ort.InferenceSession(rt_file, providers=["CPUExecutionProvider"])
-        self._sess = ort.InferenceSession(rt_file, providers=["CUDAExecutionProvider"], provider_options=[{"device_id": str(self._gpu_id)}])
-        self._onnx_file = rt_file
-        # self._iota_model = 'iota' in rt_file
+        _onnx_hash = file_hash(rt_file)
+        _sess, _name = self._create_session(rt_file, _onnx_hash)
+        if _sess is None:
+            logger.error("None of the execution providers {} could run graph '{}'.".format(self._providers, rt_file))
+            return None
+        _provider = EXECUTION_PROVIDERS[_name]
+        logger.info("Running on execution provider '{}'.".format(_provider))
+        # Positions of coord1, coord2, key and value in the graph outputs.
+        _outputs = _sess.get_outputs()
+        _feature_outputs = [_outputs[i].name for i in (7, 8, 10, 11)]
+        _features_sess = self._create_features_session(rt_file, _onnx_hash, _name, _feature_outputs)
+        return rt_file, _onnx_hash, _sess, _provider, _feature_outputs, _features_sess
+
+    def _install(self, loaded):
+        self._deactivate()
+        if loaded is not None:
+            self._onnx_file, self._onnx_hash, self._sess, self._provider, self._feature_outputs, self._features_sess = loaded
+            # self._iota_model = 'iota' in rt_file
+
+    def _prune(self, loaded):
+        # The caches of the previous model are removed only once its session is out of use.
+        if loaded is not None and self._cache_directory is not None:
+            self._prune_cache(loaded[1])
 
     def _deactivate(self):
         del self._sess
         self._sess = None
+        self._features_sess = None
+        self._provider = None
         self._onnx_file = None
+        self._onnx_hash = None
+        self._feature_outputs = None
+        self._binding = None
+        self._bound_outputs = None
 
     @staticmethod
     def _dave_prepare(image):
@@ -92,42 +263,112 @@ class TRTDriver(object):
     def _alex_prepare(image):
         return hwc_to_chw(image)
 
+    def get_model_hash(self):
+        return self._onnx_hash
+
+    def get_provider(self):
+        return self._provider
+
     def will_compile(self):
         rt_file = _newest_file(self.model_directories, "runtime*.onnx")
         return rt_file is not None and (self._onnx_file is None or os.path.getmtime(rt_file) > os.path.getmtime(self._onnx_file))
 
     def deactivate(self):
-        with self._lock:
-            self._deactivate()
+        with self._build_lock:
+            self._warm = None
+            with self._lock:
+                self._deactivate()
 
     def activate(self):
-        with self._lock:
-            self._activate()
+        # The session is built outside of the lock so the current one keeps serving.
+        with self._build_lock:
+            self._warm = None
+            _loaded = self._load()
+            with self._lock:
+                self._install(_loaded)
+            self._prune(_loaded)
 
     def reactivate(self):
-        with self._lock:
-            self._deactivate()
-            self._activate()
+        self.activate()
+
+    def prewarm(self):
+        """Builds the session of a newer model in the background of the current one and returns whether it is ready to swap in."""
+        with self._build_lock:
+            if self._warm is None and self.will_compile():
+                self._warm = self._load()
+            return self._warm is not None
+
+    def swap(self):
+        with self._build_lock:
+            if self._warm is not None:
+                with self._lock:
+                    self._install(self._warm)
+                self._prune(self._warm)
+                self._warm = None
+
+    def _batch_size(self, requested):
+        # Graphs exported with a fixed batch dimension only accept that many images per run.
+        _dim = self._sess.get_inputs()[0].shape[0]
+        return _dim if isinstance(_dim, int) and _dim > 0 else max(1, requested)
 
     def features(self, dave_image, alex_image):
-        _out = self._forward_all(dave_image, alex_image)
-        return _out["coordinate"], _out["key"], _out["value"]
+        coordinates, keys, values = self.features_batch([dave_image], [alex_image])
+        return coordinates[0], keys[0], values[0]
+
+    def features_batch(self, dave_images, alex_images, batch_size=1):
+        """
+        Runs the sub-graph of the feature outputs when it could be extracted from the model, or else the full graph.
+        The lock is taken per batch to let the regular forward calls through in between.
+        """
+        coordinates, keys, values = [], [], []
+        start = 0
+        while start < len(dave_images):
+            with self._lock:
+                assert self._sess is not None, "There is no session - run activation prior to calling this method."
+                _n = min(self._batch_size(batch_size), len(dave_images) - start)
+                _dave, _alex = dave_images[start : start + _n], alex_images[start : start + _n]
+                assert all(x.dtype == np.uint8 for x in _dave + _alex), "Expected np.uint8 images."
+                _feed = {
+                    "input/dave_image": np.array([self._dave_prepare(x) for x in _dave], dtype=np.uint8),
+                    "input/alex_image": np.array([self._alex_prepare(x) for x in _alex], dtype=np.uint8),
+                    "input/maneuver_command": np.zeros((_n, 1), dtype=np.float32),
+                    "input/current_destination": np.zeros((_n,) + self._zero_vector.shape, dtype=np.float32),
+                }
+                _sess = self._sess if self._features_sess is None else self._features_sess
+                # The sub-graph may not take all the inputs of the model.
+                _feed = dict((x.name, _feed[x.name]) for x in _sess.get_inputs())
+                coord1, coord2, key, value = [x.reshape([_n, -1]) for x in _sess.run(self._feature_outputs, _feed)]
+            coordinates.extend(np.concatenate([coord1, coord2], axis=-1))
+            keys.extend(key)
+            values.extend(value)
+            start += _n
+        return coordinates, keys, values
+
+    def prepare_inputs(self, dave_image, alex_image):
+        # The network inputs are batches of channel first images.
+        return np.array([self._dave_prepare(dave_image)], dtype=np.uint8), np.array([self._alex_prepare(alex_image)], dtype=np.uint8)
 
     def forward(self, dave_image, alex_image, maneuver_command=0, destination=None):
-        _out = self._forward_all(dave_image, alex_image, maneuver_command, destination)
+        return self.forward_inputs(*self.prepare_inputs(dave_image, alex_image), maneuver_command=maneuver_command, destination=destination)
+
+    def forward_inputs(self, dave_input, alex_input, maneuver_command=0, destination=None):
+        _out = self._forward_all(dave_input, alex_input, maneuver_command, destination)
         return (_out["steering"], _out["critic"], _out["surprise"], _out["command"], _out["path"], _out["brake"], _out["brake_critic"], _out["coordinate"], _out["query"])
 
-    def _forward_all(self, dave_image, alex_image, maneuver_command=0, destination=None):
+    def _forward_all(self, dave_input, alex_input, maneuver_command=0, destination=None):
         with self._lock:
-            assert dave_image.dtype == np.uint8 and alex_image.dtype == np.uint8, "Expected np.uint8 images."
+            assert dave_input.dtype == np.uint8 and alex_input.dtype == np.uint8, "Expected np.uint8 images."
             assert self._sess is not None, "There is no session - run activation prior to calling this method."
-            _direction = self._zero_vector if destination is None else destination
+            self._command_input[0, 0] = maneuver_command
+            self._destination_input[0] = self._zero_vector if destination is None else destination
             _feed = {
-                "input/dave_image": np.array([self._dave_prepare(dave_image)], dtype=np.uint8),
-                "input/alex_image": np.array([self._alex_prepare(alex_image)], dtype=np.uint8),
-                "input/maneuver_command": np.array([[maneuver_command]], dtype=np.float32),
-                "input/current_destination": np.array([_direction], dtype=np.float32),
+                "input/dave_image": dave_input,
+                "input/alex_image": alex_input,
+                "input/maneuver_command": self._command_input,
+                "input/current_destination": self._destination_input,
             }
+            if self._io_binding:
+                return self._forward_bound(_feed)
             _out = [x.flatten() for x in self._sess.run(None, _feed)]
             steering, critic, surprise, command, path, brake, br_critic, coord1, coord2, query, key, value = _out
             _map = dict(steering=steering, critic=critic, surprise=surprise, command=command, path=path, brake=brake)
@@ -137,3 +378,33 @@ class TRTDriver(object):
             _map["key"] = key
             _map["value"] = value
             return _map
+
+    def _create_binding(self, feed):
+        # Run once to learn the output shapes.
+        _names = [x.name for x in self._sess.get_outputs()]
+        _positions = dict(steering=0, critic=1, surprise=2, command=3, path=4, brake=5, brake_critic=6, query=9)
+        _samples = dict(zip(range(10), self._sess.run(_names[:10], feed)))
+        binding = self._sess.io_binding()
+        outputs = {}
+        # The key and value heads are only used for the route features and left out.
+        for key, position in _positions.items():
+            _buffer = np.empty_like(_samples[position])
+            binding.bind_output(_names[position], "cpu", 0, _buffer.dtype.type, _buffer.shape, _buffer.ctypes.data)
+            outputs[key] = _buffer.reshape([-1])
+        # Both coordinate outputs are written to their part of one buffer.
+        coord1, coord2 = _samples[7], _samples[8]
+        _coordinate = np.empty(coord1.size + coord2.size, dtype=coord1.dtype)
+        binding.bind_output(_names[7], "cpu", 0, coord1.dtype.type, coord1.shape, _coordinate[: coord1.size].ctypes.data)
+        binding.bind_output(_names[8], "cpu", 0, coord2.dtype.type, coord2.shape, _coordinate[coord1.size :].ctypes.data)
+        outputs["coordinate"] = _coordinate
+        self._binding = binding
+        self._bound_outputs = outputs
+
+    def _forward_bound(self, feed):
+        # The outputs are views of buffers that are overwritten by the next call.
+        if self._binding is None:
+            self._create_binding(feed)
+        for name, value in feed.items():
+            self._binding.bind_cpu_input(name, value)
+        self._sess.run_with_iobinding(self._binding)
+        return self._bound_outputs
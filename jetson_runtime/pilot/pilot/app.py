@@ -17,10 +17,11 @@ from tornado.httpserver import HTTPServer
 from tornado.platform.asyncio import AnyThreadEventLoopPolicy
 
 from BYODR_utils.common import Application, ApplicationExit
-from BYODR_utils.common.ipc import JSONPublisher, LocalIPCServer, json_collector
+from BYODR_utils.common.ipc import JSONPublisher, JSONReceiver, LocalIPCServer, PollingCollectorThread
 from BYODR_utils.common.navigate import FileSystemRouteDataSource, ReloadableDataSource
 from BYODR_utils.common.option import parse_option
 from BYODR_utils.common.usbrelay import SearchUsbRelayFactory, StaticRelayHolder, TransientMemoryRelay
+from BYODR_utils.common.watcher import DirectoryWatcher
 from BYODR_utils.JETSON_specific.gpio_relay import ThreadSafeJetsonGpioRelay
 
 from .core import CommandProcessor
@@ -116,6 +117,7 @@ class PilotApplication(Application):
                 _cfg = self._config()
                 self._set_pulse_channels(**_cfg)
                 _errors = self._monitor.setup()
+                self.ipc_server.register_latency(self._monitor.get_latency)
                 _restarted = self._processor.restart(**_cfg)
                 if _restarted:
                     self.ipc_server.register_start(_errors + self._processor.get_errors())
@@ -155,22 +157,25 @@ def main():
     args = parser.parse_args()
 
     route_store = ReloadableDataSource(FileSystemRouteDataSource(directory=args.routes, load_instructions=True))
+    watcher = DirectoryWatcher(event=quit_event)
+    route_store.watch(watcher, args.routes)
     application = PilotApplication(quit_event, processor=CommandProcessor(route_store), config_dir=args.config)
 
-    teleop = json_collector(url="ipc:///byodr/teleop.sock", topic=b"aav/teleop/input", event=quit_event)
-    ros = json_collector(url="ipc:///byodr/ros.sock", topic=b"aav/ros/input", hwm=10, pop=True, event=quit_event)
-    vehicle = json_collector(url="ipc:///byodr/vehicle.sock", topic=b"aav/vehicle/state", event=quit_event)
-    inference = json_collector(url="ipc:///byodr/inference.sock", topic=b"aav/inference/state", event=quit_event)
-    ipc_chatter = json_collector(url="ipc:///byodr/teleop_c.sock", topic=b"aav/teleop/chatter", pop=True, event=quit_event)
+    collector = PollingCollectorThread(event=quit_event)
+    teleop = collector.add(JSONReceiver(url="ipc:///byodr/teleop.sock", topic=b"aav/teleop/input"))
+    ros = collector.add(JSONReceiver(url="ipc:///byodr/ros.sock", topic=b"aav/ros/input", hwm=10, pop=True))
+    vehicle = collector.add(JSONReceiver(url="ipc:///byodr/vehicle.sock", topic=b"aav/vehicle/state"))
+    inference = collector.add(JSONReceiver(url="ipc:///byodr/inference.sock", topic=b"aav/inference/state"))
+    ipc_chatter = collector.add(JSONReceiver(url="ipc:///byodr/teleop_c.sock", topic=b"aav/teleop/chatter", pop=True))
 
     application.teleop = lambda: teleop.get()
     application.ros = lambda: ros.get()
     application.vehicle = lambda: vehicle.get()
     application.inference = lambda: inference.get()
     application.ipc_chatter = lambda: ipc_chatter.get()
-    application.publisher = JSONPublisher(url="ipc:///byodr/pilot.sock", topic="aav/pilot/output")
+    application.publisher = JSONPublisher(url="ipc:///byodr/pilot.sock", topic="aav/pilot/output", codec="msgpack")
     application.ipc_server = LocalIPCServer(url="ipc:///byodr/pilot_c.sock", name="pilot", event=quit_event)
-    threads = [teleop, ros, vehicle, inference, ipc_chatter, application.ipc_server, threading.Thread(target=application.run)]
+    threads = [collector, watcher, application.ipc_server, threading.Thread(target=application.run)]
     if quit_event.is_set():
         return 0
 
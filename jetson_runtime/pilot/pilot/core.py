@@ -15,6 +15,8 @@ from simple_pid import PID as pid_control
 from six.moves import zip
 
 from BYODR_utils.common import timestamp, Configurable
+from BYODR_utils.common.executor import CoalescingExecutor
+from BYODR_utils.common.latency import stamp_trace
 from BYODR_utils.common.navigate import NavigationCommand, NavigationInstructions
 from BYODR_utils.common.option import parse_option
 
@@ -85,6 +87,7 @@ class Blob(AttrDict):
         self.navigation_match_distance = kwargs.get("navigation_match_distance", 1)
         self.navigation_match_point = kwargs.get("navigation_match_point")
         self.inference_brake = kwargs.get("inference_brake", 0)
+        self.trace = kwargs.get("trace")
         if self.forced_steering is None:
             self.forced_steering = _is_forced_value(self.steering)
         if self.forced_throttle is None:
@@ -522,6 +525,8 @@ class Navigator(object):
     def __init__(self, route_store):
         self._store = route_store
         self._open_lock = threading.Lock()
+        # Identical store requests are coalesced while one is pending.
+        self._tasks = CoalescingExecutor(max_workers=1)
         self._override_requests = collections.deque(maxlen=1)
         self._match_point = None
         self._match_image = None
@@ -571,9 +576,11 @@ class Navigator(object):
         if route is None:
             self.close()
         elif route not in self._store.list_routes():
-            threading.Thread(target=self.reload).start()
+            # A watched store picks up new routes by itself.
+            if not self._store.is_watched():
+                self._tasks.submit(self.reload)
         elif route != self._store.get_selected_route():
-            threading.Thread(target=self._open_store, args=(route,)).start()
+            self._tasks.submit(self._open_store, route)
 
     def set_override_request(self, request):
         self._override_requests.append(request)
@@ -638,6 +645,8 @@ class DriverManager(Configurable):
         self._lock = multiprocessing.RLock()
         self._driver = None
         self._driver_ctl = None
+        # Deactivation of the previous driver and activation of the next one run side by side.
+        self._tasks = CoalescingExecutor(max_workers=2)
 
     def internal_quit(self, restarting=False):
         for driver in self._driver_cache.values():
@@ -760,11 +769,11 @@ class DriverManager(Configurable):
                 # The switch must be immediate. Do not force wait on the previous driver to deactivate.
                 if control != self._driver_ctl:
                     if self._driver is not None:
-                        threading.Thread(target=self._driver.deactivate).start()
+                        self._tasks.submit(self._driver.deactivate)
                     self._driver_ctl = control
                     self._navigation_queue.clear()
                     self._driver = self._get_driver(control=control)
-                    threading.Thread(target=self._activate).start()
+                    self._tasks.submit(self._activate)
                     logger.info("Pilot switch control to '{}'.".format(control))
 
     def noop(self):
@@ -907,6 +916,13 @@ class CommandProcessor(Configurable):
 
     def next_action(self, *args):
         teleop, ros, vehicle, inference = self._unpack_commands(*args)
+        blob = self._next_action(teleop, ros, vehicle, inference)
+        if blob is not None and inference is not None:
+            # Carry the trace of the camera frame the command is derived from.
+            blob.trace = stamp_trace(inference.get("trace"), "pilot")
+        return blob
+
+    def _next_action(self, teleop, ros, vehicle, inference):
         # Handle instructions first.
         self._process(teleop, ros, inference)
         # What to do on message timeout depends on which driver is active.
@@ -11,6 +11,7 @@ from configparser import ConfigParser
 
 from BYODR_utils.common import timestamp
 from BYODR_utils.common.ipc import ReceiverThread, JSONZmqClient
+from BYODR_utils.common.latency import LatencyTracker, stamp_trace
 from BYODR_utils.common.option import parse_option, hash_dict
 from BYODR_utils.common.protocol import MessageStreamProtocol
 
@@ -49,6 +50,9 @@ class AbstractRelay(six.with_metaclass(ABCMeta, object)):
     def step(self, pilot, teleop):
         pass
 
+    def get_latency(self):
+        return {}
+
     def quit(self):
         pass
 
@@ -81,19 +85,26 @@ class RealMonitoringRelay(AbstractRelay):
         self._pi_client = None
         self._pi_status = None
         self._servo_config = None
+        self._latency = LatencyTracker()
+        self._trace_time = None
         self.n_violations = 0
 
     def _send_config(self, data):
         if self._pi_client is not None and data is not None:
             self._pi_client.call(dict(time=timestamp(), method="ras/driver/config", data=data))
 
-    def _send_drive(self, throttle=0.0, steering=0.0, reverse_gear=False, wakeup=False):
+    def _send_drive(self, throttle=0.0, steering=0.0, reverse_gear=False, wakeup=False, trace=None):
         if self._pi_client is not None:
             throttle = max(-1.0, min(1.0, throttle))
             steering = max(-1.0, min(1.0, steering))
             _reverse = 1 if reverse_gear else 0
             _wakeup = 1 if wakeup else 0
-            self._pi_client.call(dict(time=timestamp(), method="ras/servo/drive", data=dict(steering=steering, throttle=throttle, reverse=_reverse, wakeup=_wakeup)))
+            _message = dict(time=timestamp(), method="ras/servo/drive", data=dict(steering=steering, throttle=throttle, reverse=_reverse, wakeup=_wakeup))
+            # The pilot runs faster than inference so trace every camera frame once.
+            if trace is not None and trace.get("camera") != self._trace_time:
+                self._trace_time = trace.get("camera")
+                _message.update(trace=stamp_trace(trace, "relay"))
+            self._pi_client.call(_message)
 
     def _drive(self, pilot, teleop):
         pi_status = None if self._pi_status is None else self._pi_status.pop_latest()
@@ -104,7 +115,7 @@ class RealMonitoringRelay(AbstractRelay):
         else:
             _reverse = teleop and teleop.get("arrow_down", 0)
             _wakeup = teleop and teleop.get("button_b", 0)
-            self._send_drive(steering=pilot.get("steering"), throttle=pilot.get("throttle"), reverse_gear=_reverse, wakeup=_wakeup)
+            self._send_drive(steering=pilot.get("steering"), throttle=pilot.get("throttle"), reverse_gear=_reverse, wakeup=_wakeup, trace=pilot.get("trace"))
 
     def _config(self):
         parser = ConfigParser()
@@ -119,6 +130,12 @@ class RealMonitoringRelay(AbstractRelay):
 
     def _on_receive(self, msg):
         self._integrity.on_message(msg.get("time"))
+        if msg.get("trace") is not None:
+            # The pi reports the durations on its side of the trace.
+            self._latency.record(msg.get("trace"), remote=msg.get("trace_pi"))
+
+    def get_latency(self):
+        return self._latency.summary()
 
     def setup(self):
         _hash = hash_dict(**self._config())
@@ -137,6 +137,22 @@ class RealCameraController {
 		this.socketCaptureTimer = null;
 		this.socketCloseTimer = null;
 		this.socket = null;
+		/** @type {boolean} Let the server push the frames instead of requesting each one. */
+		this.push = true;
+	}
+
+	/**
+	 * Asks the server to push the frames at the target rate or to stop pushing at a zero rate.
+	 */
+	requestPush() {
+		try {
+			if (this.socket != null && this.socket.readyState === 1) {
+				const fps = this.frameController.targetFps;
+				this.socket.send(JSON.stringify(fps > 0 ? { action: 'push', fps: fps, quality: this.frameController.maxJpegQuality } : { action: 'pull' }));
+			}
+		} catch (error) {
+			console.error('Error requesting the frame push:', error);
+		}
 	}
 
 	clearSocketCloseTimer() {
@@ -185,19 +201,20 @@ class RealCameraController {
 			switch (rate) {
 				case 'fast':
 					this.frameController.setTargetFps(16);
-					this.socketCaptureTimer = setTimeout(() => {
-						this.capture();
-					}, 0);
 					break;
 				case 'slow':
 					this.frameController.setTargetFps(4);
-					this.socketCaptureTimer = setTimeout(() => {
-						this.capture();
-					}, 0);
 					break;
 				default:
 					this.frameController.setTargetFps(0);
 			}
+			if (this.push) {
+				this.requestPush();
+			} else if (this.frameController.targetFps > 0) {
+				this.socketCaptureTimer = setTimeout(() => {
+					this.capture();
+				}, 0);
+			}
 		} catch (error) {
 			console.error('Error setting the frame rate:', error);
 		}
@@ -224,7 +241,12 @@ class RealCameraController {
 				ws.onmessage = (evt) => {
 					this.clearSocketCloseTimer();
 					const timeout = this.frameController.updateFramerate();
-					if (timeout !== undefined && timeout >= 0) {
+					if (this.push) {
+						// The server starts pushing once asked to after its init message.
+						if (typeof evt.data === 'string') {
+							this.requestPush();
+						}
+					} else if (timeout !== undefined && timeout >= 0) {
 						this.socketCaptureTimer = setTimeout(() => {
 							this.capture();
 						}, timeout);
@@ -400,6 +422,9 @@ class MJPEGPageController {
 		this.cameras.forEach((cam) => {
 			cam.frameController.maxJpegQuality = this.getMaxQuality();
 			cam.frameController.minJpegQuality = this.getMinQuality();
+			if (cam.push) {
+				cam.requestPush();
+			}
 		});
 	}
 
@@ -8,6 +8,11 @@ class LogBox {
 		this.currentPage = 1;
 		this.pagesAmount = 1;
 		this.totalRecords = 0;
+		// The page on display and the times of its first and last rows to find the neighbouring pages from.
+		this.shownPage = 1;
+		this.firstTime = null;
+		this.lastTime = null;
+		this.pageKeys = {};
 
 		this._data_map = {};
 		this.elements = {
@@ -51,6 +56,7 @@ class LogBox {
 		this.length = Number(this.elements.selectElement.value);
 		this.start = 0;
 		this.currentPage = 1;
+		this.pageKeys = {};
 		this.fetchData();
 	}
 
@@ -85,6 +91,22 @@ class LogBox {
 	 */
 	changePage() {
 		this.start = (this.currentPage - 1) * this.length;
+		// Locate the page from the rows on display so the server does not have to skip over all the rows before it.
+		const pageKeys = {};
+		if (this.currentPage === 1 || this.firstTime === null) {
+			// The first page.
+		} else if (this.currentPage === this.pagesAmount) {
+			// The server sizes the last page from its current count.
+			pageKeys.last = 1;
+			pageKeys.start = 0;
+		} else if (this.currentPage > this.shownPage) {
+			pageKeys.after = this.lastTime;
+			pageKeys.start = (this.currentPage - this.shownPage - 1) * this.length;
+		} else if (this.currentPage < this.shownPage) {
+			pageKeys.before = this.firstTime;
+			pageKeys.start = (this.shownPage - this.currentPage - 1) * this.length;
+		}
+		this.pageKeys = pageKeys;
 		this.fetchData();
 	}
 
@@ -112,23 +134,30 @@ class LogBox {
 			start: this.start,
 			length: this.length,
 			'order[0][dir]': this.orderDir,
+			...this.pageKeys,
 		});
+		const page = this.currentPage;
 
 		fetch(`${this.apiUrl}?${params.toString()}`)
 			.then((response) => response.json())
-			.then((data) => this.handleFetchResponse(data))
+			.then((data) => this.handleFetchResponse(data, page))
 			.catch((error) => console.error('Error loading the data:', error));
 	}
 
 	/**
 	 * Handles the API response, updating the table and pagination.
 	 * @param {Object} data - The data returned from the API.
+	 * @param {number} page - The page the data was requested for.
 	 */
-	handleFetchResponse(data) {
+	handleFetchResponse(data, page) {
 		if (data.error) {
 			console.error('Error from server:', data.error);
 			return;
 		}
+		const rows = data.data;
+		this.shownPage = page;
+		this.firstTime = rows.length > 0 ? rows[0][1] : null;
+		this.lastTime = rows.length > 0 ? rows[rows.length - 1][1] : null;
 		this.totalRecords = data.recordsTotal;
 		this.displayNumbers();
 		this.createImgData(data.data); // Call the data processing method
@@ -94,18 +94,15 @@ class PackageApplication(Application):
     def finish(self):
         pass
 
-    def _mark(self, item):
-        self._mongo.update_event({"_id": item.get("_id")}, {"$set": {"lb_is_packaged": 1}})
-
     def _write_out_photos(self):
         if not self._user.is_busy(wait_sec=10):
             items = self._mongo.list_all_non_packaged_photo_events()
             if len(items) > 0 and not self._user.is_busy(wait_sec=10):
                 _directory = os.path.join(self._photo_dir, datetime.fromtimestamp(items[0].get("time") * 1e-6).strftime("%Y%B"))
                 _directory = get_or_create_directory(_directory)
+                self._mongo.mark_events_packaged([x.get("_id") for x in items])
                 with open(os.path.join(_directory, "photo.log"), "a+") as f:
                     for item in items:
-                        self._mark(item)
                         _timestamp = item.get("time")
                         _dts = datetime.fromtimestamp(_timestamp * 1e-6).strftime("%Y%b%dT%H%M%S")
                         latitude = str(item.get("veh_gps_latitude"))[:8].replace(".", "_")
@@ -143,33 +140,50 @@ class PackageApplication(Application):
         event.valid = pil_valid and veh_valid
         return event
 
-    def _package_next(self):
+    def _package_next(self, mark_size=200):
         # Start by saving the photo snapshots.
         self._write_out_photos()
         # Proceed unless new user activity.
         if self._user.is_busy():
             return False
-        # The save events not previously processed are packaged together in a zip.
-        items = self._mongo.list_next_batch_of_non_packaged_save_events()
-        if len(items) < 1:
-            return False
-        # Mark regardless of zip write success.
-        list([self._mark(x) for x in items])
-        # Do the zip write in time ascending order - filter out invalid saves.
-        events = list(filter(lambda x: x.valid, map(self._event, reversed(items))))
-        if len(events) < 1:
-            return False
-        logger.info("Packaging {} valid events out of {} total items.".format(len(events), len(items)))
-        _archive = create_data_source(events[0].timestamp, self._recorder_dir)
+        # The save events not previously processed are written to a zip in time ascending order as they arrive.
+        cursor = self._mongo.iterate_next_batch_of_non_packaged_save_events()
+        _archive = None
+        _marks, _num_items, _num_events = [], 0, 0
         try:
-            _archive.open()
-            assert _archive.is_open(), "Could not create a new archive."
-            list(map(lambda x: _archive.create_event(x), events))
-            _archive.close()
+            for item in cursor:
+                # Mark regardless of zip write success.
+                _marks.append(item.get("_id"))
+                _num_items += 1
+                # Filter out invalid saves.
+                event = self._event(item)
+                if event.valid:
+                    if _archive is None:
+                        _archive = create_data_source(event.timestamp, self._recorder_dir)
+                        _archive.open()
+                        assert _archive.is_open(), "Could not create a new archive."
+                    _archive.create_event(event)
+                    _num_events += 1
+                if len(_marks) >= mark_size:
+                    # The events are marked only once their images are safely in the archive.
+                    if _archive is not None:
+                        _archive.flush()
+                    self._mongo.mark_events_packaged(_marks)
+                    _marks = []
+            if _archive is not None:
+                _archive.close()
         except Exception as e:
             logger.warning(e)
             logger.error("Packager#next: {}".format(traceback.format_exc()))
             return False
+        finally:
+            cursor.close()
+            self._mongo.mark_events_packaged(_marks)
+            if _archive is not None and _archive.is_open():
+                _archive.close()
+        if _num_events < 1:
+            return False
+        logger.info("Packaged {} valid events out of {} total items.".format(_num_events, _num_items))
         return not self._user.is_busy()
 
     def step(self):
@@ -203,9 +217,9 @@ class PhotoLog(object):
 
 
 class LogApplication(Application):
-    def __init__(self, mongo, user, state, event, config_dir=os.getcwd()):
+    def __init__(self, writer, user, state, event, config_dir=os.getcwd()):
         super(LogApplication, self).__init__(quit_event=event, run_hz=state.get_hz())
-        self._mongo = mongo
+        self._writer = writer
         self._user = user
         self._state = state
         self._config_dir = config_dir
@@ -215,9 +229,9 @@ class LogApplication(Application):
 
     def _insert(self, trigger, content, save_image=False):
         _time, pil, veh, inf, image_md, image = content
-        _img_fields = prepare_image_persist(image, persist=save_image)
         _pil_steering_scale = _float(pil, "steering_scale", default=1.0)
-        self._mongo.insert_event(
+        # The image fields are added by the writer.
+        self._writer.put(
             {
                 "time": _time,
                 "trigger": trigger,
@@ -246,11 +260,9 @@ class LogApplication(Application):
                 "inf_obstruction_confidence": _str(inf, "brake_confidence"),
                 "inf_total_penalty": _str(inf, "total_penalty"),
                 "img_time": get_timestamp(image_md),
-                "img_shape": _img_fields[0],
-                "img_num_bytes": _img_fields[1],
-                "img_buffer": _img_fields[2],
                 "lb_is_packaged": 0,
-            }
+            },
+            image=image if save_image else None,
         )
 
     def setup(self):
@@ -0,0 +1,116 @@
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import timeit
+import zipfile
+from io import StringIO
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from .store import Event, ZipDataSource
+
+logger = logging.getLogger(__name__)
+
+
+def _events(n_events, start=1600000000000000):
+    _random = np.random.RandomState(0)
+    _jpeg = cv2.imencode(".jpg", _random.randint(0, 255, (240, 320, 3)).astype(np.uint8))[1].tobytes()
+    events = []
+    for i in range(n_events):
+        # The packager passes the values as strings the way they are stored in the logbox.
+        event = Event(
+            timestamp=start + i * 50000,
+            image_shape=(240, 320, 3),
+            jpeg_buffer=_jpeg,
+            steer_src="src.dnn",
+            speed_src="src.console",
+            command_src="src.dnn",
+            steering=str(_random.uniform(-1, 1)),
+            desired_speed=str(_random.uniform(0, 5)),
+            actual_speed=str(_random.uniform(0, 5)),
+            heading=str(_random.uniform(0, 360)),
+            throttle=str(_random.uniform(0, 1)),
+            command=None,
+            x_coordinate=str(_random.uniform(-90, 90)),
+            y_coordinate=str(_random.uniform(-180, 180)),
+            inference_brake=str(_random.uniform(0, 1)),
+        )
+        event.vehicle = "na"
+        event.vehicle_config = "na"
+        events.append(event)
+    return events
+
+
+def _legacy_session(events, directory):
+    # The previous recorder with a frame row append per event and the archive opened per image.
+    data = pd.DataFrame(columns=list(ZipDataSource.COLUMNS))
+    _file = os.path.join(directory, "legacy.zip")
+    for event in events:
+        filename = "{}.jpg".format(event.timestamp)
+        with zipfile.ZipFile(_file, mode="a", compression=0) as archive:
+            archive.writestr(filename, event.jpeg_buffer)
+        data.loc[len(data)] = [
+            event.timestamp,
+            event.vehicle,
+            event.vehicle_config,
+            filename,
+            event.steer_src,
+            event.speed_src,
+            event.steering,
+            event.desired_speed,
+            event.actual_speed,
+            event.heading,
+            event.throttle,
+            event.command_src,
+            event.command,
+            event.x_coordinate,
+            event.y_coordinate,
+            event.inference_brake,
+        ]
+    buf = StringIO()
+    data.to_csv(buf, index=False)
+    with zipfile.ZipFile(_file, mode="a", compression=0) as archive:
+        archive.writestr("legacy.csv", buf.getvalue())
+
+
+def _session(events, directory):
+    _archive = ZipDataSource(events[0].timestamp, directory=directory)
+    _archive.open()
+    [_archive.create_event(x) for x in events]
+    _archive.close(run_gc=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Logbox packaging benchmark.")
+    parser.add_argument("--events", type=int, default=10000, help="Number of events per session.")
+    parser.add_argument("--legacy-events", type=int, default=2000, help="Number of events for the previous recorder, zero to skip.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of sessions to time.")
+    args = parser.parse_args()
+
+    _directory = tempfile.mkdtemp()
+    try:
+        for name, fn, n_events in (("zip data source", _session, args.events), ("legacy", _legacy_session, args.legacy_events)):
+            if n_events < 1:
+                continue
+            events = _events(n_events)
+            _timings = []
+            for _ in range(args.repeat):
+                _session_directory = tempfile.mkdtemp(dir=_directory)
+                _timings.append(timeit.timeit(lambda: fn(events, _session_directory), number=1))
+                shutil.rmtree(_session_directory)
+            _best = min(_timings)
+            print("{:>16} {:>6} events {:8.3f} s {:10.1f} events/s".format(name, n_events, _best, n_events / _best))
+    finally:
+        shutil.rmtree(_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s: %(asctime)s %(filename)s %(funcName)s %(message)s", datefmt="%Y%m%d:%H:%M:%S %p %Z")
+    logging.getLogger().setLevel(logging.WARNING)
+    main()
@@ -1,5 +1,11 @@
 import collections
+import logging
+import multiprocessing
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import cv2
 import numpy as np
@@ -8,6 +14,9 @@ from bson.binary import Binary
 from bson.objectid import ObjectId
 from pymongo import MongoClient
 from BYODR_utils.common import timestamp
+from BYODR_utils.common.latency import LatencyTracker, new_trace, stamp_trace
+
+logger = logging.getLogger(__name__)
 
 TRIGGER_SERVICE_START = 2**0
 TRIGGER_SERVICE_END = 2**1
@@ -41,6 +50,13 @@ def prepare_image_persist(image, persist=True):
     return _shape, _num_bytes, _buffer
 
 
+def _persist_copy(image):
+    # The resize makes a copy as well.
+    if image.shape != (240, 320, 3):
+        return cv2.resize(image, (320, 240))
+    return np.array(image)
+
+
 def get_or_create_directory(directory, mode=0o775):
     if not os.path.exists(directory):
         _mask = os.umask(000)
@@ -111,11 +127,129 @@ def _create_index_if_not_exists(collection, keys, name, unique=False, background
         pass
 
 
+class ThumbnailCache(object):
+    """
+    Keeps the jpeg thumbnails of the event images in memory and on disk once they are first asked for.
+    The image of an event does not change so a thumbnail never goes stale, the least recently used are removed to stay within the sizes.
+    """
+
+    def __init__(self, mongo, directory=None, size=(200, 80), max_entries=1000, max_disk_mb=64):
+        self._mongo = mongo
+        self._directory = directory
+        self._size = size
+        self._max_entries = max_entries
+        self._max_disk_bytes = int(max_disk_mb * (1 << 20))
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._disk_lock = threading.Lock()
+        # By path the number of bytes of the thumbnails on disk, least recently used first. Read from the directory on first use.
+        self._disk_files = None
+        self._disk_bytes = 0
+
+    def get_tag(self, object_id):
+        return "{}x{}-{}".format(self._size[0], self._size[1], object_id)
+
+    def _path(self, object_id):
+        # The leading characters of the object id are its creation time which keeps the directories to a moderate size.
+        return os.path.join(self._directory, object_id[:4], self.get_tag(object_id) + ".jpg")
+
+    def _scan(self):
+        # The files left by a previous run are ordered by modification time.
+        _files = []
+        for root, _, names in os.walk(self._directory):
+            for name in names:
+                _path = os.path.join(root, name)
+                try:
+                    _stat = os.stat(_path)
+                    _files.append((_stat.st_mtime, _path, _stat.st_size))
+                except OSError:
+                    pass
+        self._disk_files = collections.OrderedDict((path, size) for _, path, size in sorted(_files))
+        self._disk_bytes = sum(self._disk_files.values())
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            # The directory still holds other thumbnails.
+            pass
+
+    def _touch(self, path, num_bytes=None):
+        with self._disk_lock:
+            if self._disk_files is None:
+                self._scan()
+            if num_bytes is not None:
+                self._disk_bytes += num_bytes - self._disk_files.get(path, 0)
+                self._disk_files[path] = num_bytes
+            if path in self._disk_files:
+                self._disk_files.move_to_end(path)
+            while self._disk_bytes > self._max_disk_bytes and len(self._disk_files) > 1:
+                _path, _num_bytes = self._disk_files.popitem(last=False)
+                self._disk_bytes -= _num_bytes
+                self._remove(_path)
+
+    def get_disk_usage(self):
+        """Returns the number of thumbnails and bytes on disk."""
+        with self._disk_lock:
+            return (0, 0) if self._disk_files is None else (len(self._disk_files), self._disk_bytes)
+
+    def _read(self, object_id):
+        _path = self._path(object_id)
+        try:
+            with open(_path, "rb") as f:
+                chunk = f.read()
+        except (IOError, OSError):
+            return None
+        self._touch(_path)
+        return chunk
+
+    def _write(self, object_id, chunk):
+        _path = self._path(object_id)
+        try:
+            get_or_create_directory(os.path.dirname(_path))
+            with open(_path + ".tmp", "wb") as f:
+                f.write(chunk)
+            os.rename(_path + ".tmp", _path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not store thumbnail '{}': {}".format(_path, e))
+            return
+        self._touch(_path, len(chunk))
+
+    def _create(self, object_id):
+        _fields = self._mongo.load_event_image_fields(object_id)
+        if _fields is None or not _fields[1] > 0:
+            return None
+        return jpeg_encode(cv2.resize(cv2_image_from_bytes(_fields[-1]), self._size)).tobytes()
+
+    def get(self, object_id):
+        """Returns the thumbnail jpeg bytes or none when the event does not exist or has no image."""
+        with self._lock:
+            chunk = self._entries.get(object_id)
+            if chunk is not None:
+                self._entries.move_to_end(object_id)
+                return chunk
+        chunk = None if self._directory is None else self._read(object_id)
+        if chunk is None:
+            chunk = self._create(object_id)
+            if chunk is None:
+                return None
+            if self._directory is not None:
+                self._write(object_id, chunk)
+        with self._lock:
+            self._entries[object_id] = chunk
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return chunk
+
+
 class MongoLogBox(object):
     def __init__(self, client):
         self._client = client
         self._database = client.logbox
-
+        self._count_lock = threading.Lock()
+        self._count = None
+        self._count_time = 0
 
     def close(self):
         self._client.close()
@@ -130,17 +264,50 @@ class MongoLogBox(object):
 
     def load_event_image_fields(self, object_id):
         # Images are stored as jpeg encoded bytes.
-        event = self._database.events.find_one({"_id": ObjectId(object_id)})
-        return None if event is None else event.get("img_shape"), event.get("img_num_bytes"), event.get("img_buffer")
+        event = self._database.events.find_one({"_id": ObjectId(object_id)}, projection=["img_shape", "img_num_bytes", "img_buffer"])
+        return None if event is None else (event.get("img_shape"), event.get("img_num_bytes"), event.get("img_buffer"))
+
+    def count_events(self, max_age_seconds=10):
+        # The estimate comes from the collection metadata whereas an exact count scans the whole index.
+        with self._count_lock:
+            if self._count is None or time.time() - self._count_time > max_age_seconds:
+                self._count = self._database.events.estimated_document_count()
+                self._count_time = time.time()
+            return self._count
 
     def paginate_events(self, load_image=False, **kwargs):
-        _filter = {}
-        _projection = {} if load_image else {"img_buffer": False}
+        """
+        Returns the estimated number of events and an iterator over a page of events in time order.
+        The page follows after or comes before the time of an event on a neighbouring page, with start as the offset from there.
+        Pages found like that or from either end of the order cost the same at any depth.
+        The last page holds the events left over after the full pages of the current count.
+        """
         start = kwargs.get("start", 0)
         length = kwargs.get("length", 10)
         time_order = kwargs.get("order", -1)
-        cursor = self._database.events.find(filter=_filter, projection=_projection, sort=[("time", time_order)], batch_size=length, limit=length, skip=start)
-        return cursor.collection.count_documents(_filter), cursor
+        after = kwargs.get("after")
+        before = kwargs.get("before")
+        fields = kwargs.get("fields")
+        if fields is None:
+            _projection = {} if load_image else {"img_buffer": False}
+        else:
+            _projection = list(fields) + (["img_buffer"] if load_image else [])
+        # Times are unique so the time of an event marks its position.
+        _filter, _order = {}, time_order
+        if after is not None:
+            _filter = {"time": {"$lt" if time_order < 0 else "$gt": after}}
+        elif before is not None:
+            _filter = {"time": {"$gt" if time_order < 0 else "$lt": before}}
+            _order = -time_order
+        elif kwargs.get("last", False):
+            # The count is refreshed so the page lines up with the number of pages the client is told about.
+            length = self.count_events(max_age_seconds=0) % length or length
+            _order = -time_order
+        cursor = self._database.events.find(filter=_filter, projection=_projection, sort=[("time", _order)], batch_size=length, limit=length, skip=start)
+        if _order != time_order:
+            # The page was read from the other end.
+            cursor = iter(list(cursor)[::-1])
+        return self.count_events(), cursor
 
     # noinspection PyUnresolvedReferences
     def insert_event(self, document):
@@ -150,16 +317,140 @@ class MongoLogBox(object):
         except pymongo.errors.DuplicateKeyError:
             return False
 
+    # noinspection PyUnresolvedReferences
+    def insert_events(self, documents):
+        """Returns the number of documents inserted. As with single inserts the documents with an existing timestamp are skipped."""
+        try:
+            return len(self._database.events.insert_many(documents, ordered=False).inserted_ids)
+        except pymongo.errors.BulkWriteError as e:
+            _errors = [x.get("errmsg") for x in e.details.get("writeErrors", []) if x.get("code") != 11000]
+            if _errors:
+                logger.warning("Failed to insert {} events: {}".format(len(_errors), _errors[0]))
+            return e.details.get("nInserted", 0)
+
     def update_event(self, query, update):
         return self._database.events.update_one(query, update)
 
-    def list_next_batch_of_non_packaged_save_events(self, batch_size=1000):
+    def mark_events_packaged(self, object_ids):
+        # One round trip for the whole batch.
+        if object_ids:
+            return self._database.events.update_many({"_id": {"$in": list(object_ids)}}, {"$set": {"lb_is_packaged": 1}})
+
+    def iterate_next_batch_of_non_packaged_save_events(self, batch_size=1000, fetch_size=50):
         # The event must have an associated image.
+        # The documents carry the jpeg buffers so they are fetched from the server a few at a time.
         _filter = {"pil_is_save_event": 1, "lb_is_packaged": 0, "img_num_bytes": {"$gt": 0}}
-        cursor = self._database.events.find(filter=_filter, sort=[("time", -1)], batch_size=batch_size, limit=batch_size)
-        return list(cursor)
+        return self._database.events.find(filter=_filter, sort=[("time", 1)], batch_size=fetch_size, limit=batch_size)
 
     def list_all_non_packaged_photo_events(self):
         _filter = {"trigger": TRIGGER_PHOTO_SNAPSHOT, "lb_is_packaged": 0, "img_num_bytes": {"$gt": 0}}
         cursor = self._database.events.find(filter=_filter)
         return list(cursor)
+
+
+class EventWriter(threading.Thread):
+    """
+    Inserts the logbox events in the background with one unordered insert per batch of events.
+    The images are encoded on a pool of threads and the events keep their order.
+    Events put while the queue is full are dropped and counted.
+    """
+
+    def __init__(self, mongo, event=None, batch_size=32, flush_ms=500, max_pending=128, encode_workers=2, report_seconds=60):
+        super(EventWriter, self).__init__()
+        self._mongo = mongo
+        self._quit_event = multiprocessing.Event() if event is None else event
+        self._batch_size = batch_size
+        self._flush_seconds = flush_ms * 1e-3
+        self._report_seconds = report_seconds
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._encoder = ThreadPoolExecutor(max_workers=encode_workers)
+        self._tracker = LatencyTracker(stages=("queue", "encode"))
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def put(self, document, image=None):
+        """Queues the document with the image to encode into it. Returns false when the event was dropped."""
+        if self._queue.full():
+            self._count("dropped")
+            return False
+        if image is None:
+            _fields = Future()
+            _fields.set_result(prepare_image_persist(None))
+        else:
+            # The caller's image may be a view on a buffer reused by later frames so the pool encodes a copy taken now.
+            _fields = self._encoder.submit(prepare_image_persist, _persist_copy(image))
+        try:
+            self._queue.put_nowait((new_trace("queue"), document, _fields))
+            return True
+        except queue.Full:
+            _fields.cancel()
+            self._count("dropped")
+            return False
+
+    def get_metrics(self):
+        with self._lock:
+            _metrics = dict(self._counts)
+        _metrics["pending"] = self._queue.qsize()
+        _metrics["latency"] = self._tracker.summary()
+        return _metrics
+
+    def quit(self):
+        self._quit_event.set()
+
+    def _next_batch(self):
+        batch = []
+        _until = time.time() + self._flush_seconds
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(0, _until - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        traces, documents = [], []
+        for trace, document, fields in batch:
+            try:
+                _shape, _num_bytes, _buffer = fields.result()
+            except Exception as e:
+                logger.warning("Failed to encode the image of event {}: {}".format(document.get("time"), e))
+                _shape, _num_bytes, _buffer = prepare_image_persist(None)
+            document.update(img_shape=_shape, img_num_bytes=_num_bytes, img_buffer=_buffer)
+            traces.append(stamp_trace(trace, "encode"))
+            documents.append(document)
+        if not documents:
+            return
+        try:
+            self._count("inserted", self._mongo.insert_events(documents))
+        except Exception as e:
+            logger.warning("Failed to insert {} events: {}".format(len(documents), e))
+            self._count("failed", len(documents))
+        _now = timestamp()
+        [self._tracker.record(x, end_stage="insert", ts=_now) for x in traces]
+
+    def _report(self):
+        _metrics = self.get_metrics()
+        _latency = _metrics["latency"].get("total")
+        logger.info(
+            "Logbox writer pending {} inserted {} dropped {} failed {} latency p50 {:.1f} p99 {:.1f} ms.".format(
+                _metrics["pending"], _metrics.get("inserted", 0), _metrics.get("dropped", 0), _metrics.get("failed", 0), *((_latency["p50"], _latency["p99"]) if _latency else (0, 0))
+            )
+        )
+
+    def run(self):
+        _reported = time.time()
+        try:
+            while not self._quit_event.is_set():
+                self._write(self._next_batch())
+                if time.time() - _reported > self._report_seconds:
+                    _reported = time.time()
+                    self._report()
+            # Write out the events queued up to the quit.
+            while not self._queue.empty():
+                self._write(self._next_batch())
+        finally:
+            self._encoder.shutdown(wait=False)
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import collections
 import gc
 import logging
 import multiprocessing
@@ -8,9 +9,8 @@ import uuid
 import zipfile
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
-from io import StringIO, BytesIO
+from io import StringIO
 
-import numpy as np
 import pandas as pd
 import six
 from six.moves import map
@@ -72,14 +72,40 @@ platform-uuid-node: "{uuid_node}"
 image-shape-hwc: "{image_shape}"
 """
 
-    def __init__(self, timestamp, directory=os.getcwd()):
+    COLUMNS = (
+        "time",
+        "vehicle",
+        "vehicle_conf",
+        "image_uri",
+        "steer_src",
+        "speed_src",
+        "steering",
+        "desired_speed",
+        "actual_speed",
+        "heading",
+        "throttle",
+        "turn_src",
+        "turn_val",
+        "x_coord",
+        "y_coord",
+        "inference_brake",
+    )
+
+    def __init__(self, timestamp, directory=os.getcwd(), flush_events=200):
+        """
+        :param flush_events: The number of images after which the archive is closed so the images so far can be read back after a crash.
+        """
         assert os.path.exists(directory), "The directory '{}' does not exist.".format(directory)
         self._date_time = datetime.fromtimestamp(timestamp * 1e-6)
         self._directory = directory
         self._lock = multiprocessing.Lock()
         self._running = False
         self._session = None
-        self._data = None
+        # The rows are collected by column and turned into a frame once at close.
+        self._columns = None
+        self._archive = None
+        self._flush_events = flush_events
+        self._num_unflushed = 0
         self._image_shape = None
 
     def _zip_file_at_write(self):
@@ -92,9 +118,29 @@ image-shape-hwc: "{image_shape}"
             os.umask(_mask)
         return os.path.join(_directory, self._session + ".zip")
 
+    def _open_archive(self):
+        # One handle for a batch of events which is only created with the first event.
+        if self._archive is None:
+            self._archive = zipfile.ZipFile(self._zip_file_at_write(), mode="a", compression=0)
+        return self._archive
+
+    def _close_archive(self):
+        # Closing writes the central directory, the next batch is appended to the archive.
+        if self._archive is not None:
+            try:
+                self._archive.close()
+            finally:
+                self._archive = None
+                self._num_unflushed = 0
+
+    def flush(self):
+        """Writes out the archive so the images of the events so far survive a crash."""
+        with self._lock:
+            self._close_archive()
+
     def __len__(self):
         with self._lock:
-            return 0 if not self._running else len(self._data)
+            return 0 if not self._running else len(self._columns["time"])
 
     def is_open(self):
         with self._lock:
@@ -107,40 +153,26 @@ image-shape-hwc: "{image_shape}"
                 return
             self._running = True
             self._session = self._date_time.strftime("%Y%b%dT%H%M_%S%s")
-            self._data = pd.DataFrame(
-                columns=[
-                    "time",
-                    "vehicle",
-                    "vehicle_conf",
-                    "image_uri",
-                    "steer_src",
-                    "speed_src",
-                    "steering",
-                    "desired_speed",
-                    "actual_speed",
-                    "heading",
-                    "throttle",
-                    "turn_src",
-                    "turn_val",
-                    "x_coord",
-                    "y_coord",
-                    "inference_brake",
-                ]
-            )
+            self._columns = collections.OrderedDict((name, []) for name in ZipDataSource.COLUMNS)
 
     def close(self, run_gc=True):
         with self._lock:
-            if self._running and len(self._data) > 0:
-                logger.info("Writing session '{}' with {} rows.".format(self._session, len(self._data)))
-                with zipfile.ZipFile(self._zip_file_at_write(), mode="a", compression=0) as archive:
+            _num_rows = 0 if self._columns is None else len(self._columns["time"])
+            if self._running and _num_rows > 0:
+                logger.info("Writing session '{}' with {} rows.".format(self._session, _num_rows))
+                archive = self._open_archive()
+                try:
                     buf = StringIO()
-                    self._data.to_csv(buf, index=False)
+                    # Object columns keep the values as given, missing values would turn whole integer columns into floats.
+                    pd.DataFrame(self._columns, columns=ZipDataSource.COLUMNS, dtype=object).to_csv(buf, index=False)
                     archive.writestr("{}.csv".format(self._session), buf.getvalue())
                     _image_shape_str = "null" if self._image_shape is None else "x".join(map(str, self._image_shape))
-                    archive.writestr("meta-inf/manifest.mf", ZipDataSource.MF_TEMPLATE.format(**dict(num_entries=len(self._data), uuid_node=hex(uuid.getnode()), image_shape=_image_shape_str)))
+                    archive.writestr("meta-inf/manifest.mf", ZipDataSource.MF_TEMPLATE.format(**dict(num_entries=_num_rows, uuid_node=hex(uuid.getnode()), image_shape=_image_shape_str)))
+                finally:
+                    self._close_archive()
                 self._running = False
                 self._session = None
-                self._data = None
+                self._columns = None
                 if run_gc:
                     gc.collect()
 
@@ -157,10 +189,12 @@ image-shape-hwc: "{image_shape}"
                 throttle = float(event.throttle)
                 steer_src = event.steer_src
                 filename = "{}__st{:+2.2f}__th{:+2.2f}__dsp{:+2.1f}__he{:+2.2f}__{}.jpg".format(str(timestamp), steering, throttle, desired_speed, heading, str(steer_src))
-                with zipfile.ZipFile(self._zip_file_at_write(), mode="a", compression=0) as archive:
-                    archive.writestr(filename, BytesIO(np.frombuffer(memoryview(event.jpeg_buffer), dtype=np.uint8)).getvalue())
+                self._open_archive().writestr(filename, bytes(memoryview(event.jpeg_buffer)))
+                self._num_unflushed += 1
+                if self._num_unflushed >= self._flush_events:
+                    self._close_archive()
                 #
-                self._data.loc[len(self._data)] = [
+                _row = (
                     timestamp,
                     event.vehicle,
                     event.vehicle_config,
@@ -177,4 +211,6 @@ image-shape-hwc: "{image_shape}"
                     event.x_coordinate,
                     event.y_coordinate,
                     event.inference_brake,
-                ]
+                )
+                for column, value in zip(self._columns.values(), _row):
+                    column.append(value)
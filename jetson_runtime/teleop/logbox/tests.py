@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+import zipfile
+
+import cv2
+import numpy as np
+
+from .core import EventWriter, ThumbnailCache, cv2_image_from_bytes
+from .store import Event, ZipDataSource
+
+
+def _event(timestamp, command=None):
+    event = Event(
+        timestamp=timestamp,
+        image_shape=(240, 320, 3),
+        jpeg_buffer=b"jpeg",
+        steer_src="src.dnn",
+        speed_src="src.console",
+        command_src=None,
+        steering=0.25,
+        desired_speed=3,
+        actual_speed="1.5",
+        heading=90,
+        throttle=0,
+        command=command,
+        x_coordinate=None,
+        y_coordinate=52.1,
+        inference_brake=1,
+    )
+    event.vehicle = "na"
+    event.vehicle_config = "na"
+    return event
+
+
+def _archive_file(directory):
+    _files = [os.path.join(r, f) for r, _, files in os.walk(directory) for f in files if f.endswith(".zip")]
+    assert len(_files) == 1
+    return _files[0]
+
+
+def test_zip_data_source_session(tmpdir):
+    _directory = str(tmpdir)
+    events = [_event(1600000000000000 + i * 50000, command=(3 if i == 1 else None)) for i in range(5)]
+    source = ZipDataSource(events[0].timestamp, directory=_directory, flush_events=2)
+    source.open()
+    [source.create_event(e) for e in events]
+    assert len(source) == 5
+    source.close(run_gc=False)
+    assert not source.is_open()
+    with zipfile.ZipFile(_archive_file(_directory)) as archive:
+        _names = archive.namelist()
+        assert len([n for n in _names if n.endswith(".jpg")]) == 5
+        assert "meta-inf/manifest.mf" in _names
+        _csv = archive.read([n for n in _names if n.endswith(".csv")][0]).decode("utf-8")
+    _lines = _csv.splitlines()
+    assert _lines[0] == ",".join(ZipDataSource.COLUMNS)
+    # The values are written as given, an integer column with missing values does not turn into floats.
+    assert _lines[2].split(",")[6:] == ["0.25", "3", "1.5", "90", "0", "", "3", "", "52.1", "1"]
+    assert _lines[1].split(",")[12] == ""
+
+
+def test_zip_data_source_readable_before_close(tmpdir):
+    _directory = str(tmpdir)
+    source = ZipDataSource(1600000000000000, directory=_directory, flush_events=2)
+    source.open()
+    [source.create_event(_event(1600000000000000 + i)) for i in range(3)]
+    # The archive holds the flushed batch while the session is still open.
+    with zipfile.ZipFile(_archive_file(_directory)) as archive:
+        assert len(archive.namelist()) == 2
+    source.flush()
+    with zipfile.ZipFile(_archive_file(_directory)) as archive:
+        assert len(archive.namelist()) == 3
+    source.close(run_gc=False)
+    with zipfile.ZipFile(_archive_file(_directory)) as archive:
+        assert len(archive.namelist()) == 5
+
+
+class _Mongo(object):
+    def __init__(self):
+        self.batches = []
+
+    def insert_events(self, documents):
+        self.batches.append(documents)
+        return len(documents)
+
+
+def test_event_writer_batches():
+    mongo = _Mongo()
+    writer = EventWriter(mongo, batch_size=4, flush_ms=50, encode_workers=1)
+    # Hold up the pool while the events are put.
+    _gate = threading.Event()
+    writer._encoder.submit(_gate.wait)
+    image = np.zeros((240, 320, 3), dtype=np.uint8)
+    [writer.put({"time": i}, image=(image if i % 2 == 0 else None)) for i in range(10)]
+    # The buffer of the image is reused by the next frame before the pool got to it.
+    image.fill(255)
+    _gate.set()
+    writer.start()
+    try:
+        _until = time.time() + 5
+        while writer.get_metrics().get("inserted", 0) < 10 and time.time() < _until:
+            time.sleep(0.01)
+    finally:
+        writer.quit()
+        writer.join()
+    assert [len(b) for b in mongo.batches] == [4, 4, 2]
+    documents = [d for b in mongo.batches for d in b]
+    assert [d["time"] for d in documents] == list(range(10))
+    assert [d["img_num_bytes"] > 0 for d in documents] == [i % 2 == 0 for i in range(10)]
+    assert cv2_image_from_bytes(documents[0]["img_buffer"]).max() < 16
+
+
+def test_event_writer_drops_when_full():
+    writer = EventWriter(_Mongo(), max_pending=2)
+    try:
+        assert writer.put({"time": 0}) and writer.put({"time": 1})
+        assert not writer.put({"time": 2})
+        assert writer.get_metrics()["dropped"] == 1
+    finally:
+        writer.quit()
+        writer._encoder.shutdown()
+
+
+class _ImageMongo(object):
+    def __init__(self):
+        self.loads = 0
+
+    def load_event_image_fields(self, object_id):
+        self.loads += 1
+        _buffer = cv2.imencode(".jpg", np.random.RandomState(0).randint(0, 255, (240, 320, 3)).astype(np.uint8))[1].tobytes()
+        return (240, 320, 3), len(_buffer), _buffer
+
+
+def test_thumbnail_cache_disk_bounded(tmpdir):
+    _directory = str(tmpdir)
+    mongo = _ImageMongo()
+    thumbnails = ThumbnailCache(mongo, directory=_directory, max_entries=1)
+    _num_bytes = len(thumbnails.get("5f00000000000000000000a0"))
+    # Room on disk for three thumbnails.
+    thumbnails = ThumbnailCache(mongo, directory=_directory, max_entries=1, max_disk_mb=(3.5 * _num_bytes) / (1 << 20))
+    _ids = ["5f0{}000000000000000000a{}".format(i % 2, i) for i in range(6)]
+    [thumbnails.get(x) for x in _ids]
+    assert thumbnails.get_disk_usage() == (3, 3 * _num_bytes)
+    _files = sorted(f for _, _, files in os.walk(_directory) for f in files)
+    assert _files == sorted(thumbnails.get_tag(x) + ".jpg" for x in _ids[-3:])
+    # The thumbnails on disk are served without the database.
+    _loads = mongo.loads
+    assert thumbnails.get(_ids[3]) is not None and mongo.loads == _loads
+    assert thumbnails.get(_ids[0]) is not None and mongo.loads == _loads + 1
@@ -37,6 +37,30 @@ def _float_or_default(x, default=0.0):
 
 
 class WebEventViewer(object):
+    # The event fields the table shows.
+    FIELDS = (
+        "_id",
+        "time",
+        "img_num_bytes",
+        "trigger",
+        "pil_driver_mode",
+        "pil_cruise_speed",
+        "pil_desired_speed",
+        "veh_velocity",
+        "pil_steering",
+        "pil_steering_scale",
+        "pil_throttle",
+        "pil_is_steering_intervention",
+        "pil_is_throttle_intervention",
+        "pil_is_save_event",
+        "veh_gps_latitude",
+        "veh_gps_longitude",
+        "inf_steer_action",
+        "inf_obstruction",
+        "inf_steer_confidence",
+        "inf_obstruction_confidence",
+    )
+
     def __init__(self):
         pass
 
@@ -71,13 +95,27 @@ class DataTableRequestHandler(web.RequestHandler):
     # noinspection PyAttributeOutsideInit
     def initialize(self, **kwargs):
         self._box = kwargs.get("mongo_box")
+        self._tasks = kwargs.get("tasks")
         self._view = WebEventViewer()
 
     def data_received(self, chunk):
         pass
 
-    @tornado.gen.coroutine
-    def get(self):
+    def _int_argument(self, name):
+        value = self.get_query_argument(name, None)
+        return None if value is None else int(value)
+
+    def _page(self, start, length, time_order, keys):
+        c_total, cursor = self._box.paginate_events(start=start, length=length, order=time_order, fields=WebEventViewer.FIELDS, **keys)
+        data = []
+        for _ in range(length):
+            try:
+                data.append(self._view(**next(cursor)))
+            except StopIteration:
+                break
+        return c_total, data
+
+    async def get(self):
         # logger.info(self.request.arguments)
         try:
             # Parse the draw as integer for security reasons: https://datatables.net/manual/server-side.
@@ -86,19 +124,17 @@ class DataTableRequestHandler(web.RequestHandler):
             length = int(self.get_query_argument("length"))
             time_order = self.get_query_argument("order[0][dir]")
             time_order = 1 if time_order == "desc" else -1
+            # Neighbouring pages are found from the time of the first or last event on the page shown.
+            keys = dict(after=self._int_argument("after"), before=self._int_argument("before"), last=self._int_argument("last") == 1)
         except ValueError:
             draw = 0
             start = 0
             length = 10
             time_order = -1
+            keys = {}
 
-        c_total, cursor = self._box.paginate_events(start=start, length=length, order=time_order)
-        data = []
-        for _ in range(length):
-            try:
-                data.append(self._view(**next(cursor)))
-            except StopIteration:
-                break
+        # The mongo queries run off the ioloop.
+        c_total, data = await self._tasks.run("datalog_table", self._page, start, length, time_order, keys)
         blob = dict(draw=draw, recordsTotal=c_total, recordsFiltered=c_total, data=data)
         # Include the error property when errors occur.
         message = json.dumps(blob)
@@ -112,25 +148,36 @@ class DataTableRequestHandler(web.RequestHandler):
 class JPEGImageRequestHandler(web.RequestHandler):
     # noinspection PyAttributeOutsideInit
     def initialize(self, **kwargs):
-        self._box = kwargs.get("mongo_box")
+        self._thumbnails = kwargs.get("thumbnails")
+        self._tasks = kwargs.get("tasks")
 
     def data_received(self, chunk):
         pass
 
-    @tornado.gen.coroutine
-    def get(self):
-        _fields = self._box.load_event_image_fields(self.get_query_argument("object_id"))
-        _written = False
-        if _fields is not None:
-            _exists = _fields[1] > 0
-            if _exists:
-                img = cv2.resize(cv2_image_from_bytes(_fields[-1]), (200, 80))
-                _bytes = jpeg_encode(img).tobytes()
-                self.set_status(200)
-                self.set_header("Content-Type", "image/jpeg")
-                self.set_header("Content-Length", len(_bytes))
-                self.write(_bytes)
-                _written = True
-        if not _written:
+    def compute_etag(self):
+        return '"{}"'.format(self._thumbnails.get_tag(self.get_query_argument("object_id")))
+
+    async def get(self):
+        object_id = self.get_query_argument("object_id")
+        if not ObjectId.is_valid(object_id):
+            self.set_status(404)
+            self.write("")
+            return
+        # The thumbnail of an event never changes so the browser may keep it and revalidate without a lookup.
+        self.set_header("Cache-Control", "private, max-age=86400, immutable")
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        # The lookup and image transcoding run off the ioloop.
+        _bytes = await self._tasks.run("datalog_image", self._thumbnails.get, object_id)
+        if _bytes is not None:
+            self.set_status(200)
+            self.set_header("Content-Type", "image/jpeg")
+            self.set_header("Content-Length", len(_bytes))
+            self.write(_bytes)
+        else:
+            self.clear_header("Cache-Control")
+            self.clear_header("Etag")
             self.set_status(404)
             self.write("")
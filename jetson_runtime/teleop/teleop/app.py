@@ -8,12 +8,12 @@ import glob
 import logging
 import multiprocessing
 import os
+import shutil
 import signal
 import threading
-from concurrent.futures import ThreadPoolExecutor
 
 from logbox.app import LogApplication, PackageApplication
-from logbox.core import MongoLogBox, SharedState, SharedUser
+from logbox.core import EventWriter, MongoLogBox, SharedState, SharedUser, ThumbnailCache
 from logbox.web import DataTableRequestHandler, JPEGImageRequestHandler
 from pymongo import MongoClient
 from tornado import ioloop, web
@@ -21,9 +21,11 @@ from tornado.httpserver import HTTPServer
 from tornado.platform.asyncio import AnyThreadEventLoopPolicy
 
 from BYODR_utils.common import Application, ApplicationExit, hash_dict
-from BYODR_utils.common.ipc import CameraThread, JSONPublisher, JSONZmqClient, json_collector
+from BYODR_utils.common.executor import TimedExecutor
+from BYODR_utils.common.ipc import CameraThread, JSONPublisher, JSONReceiver, JSONZmqClient, PollingCollectorThread
 from BYODR_utils.common.navigate import FileSystemRouteDataSource, ReloadableDataSource
 from BYODR_utils.common.option import parse_option
+from BYODR_utils.common.watcher import DirectoryWatcher
 
 from .server import *
 from .tel_utils import EndpointHandlers, FollowingUtils, ThrottleController
@@ -37,8 +39,8 @@ signal.signal(signal.SIGINT, lambda sig, frame: _interrupt())
 signal.signal(signal.SIGTERM, lambda sig, frame: _interrupt())
 
 quit_event = multiprocessing.Event()
-# A thread pool to run blocking tasks
-thread_pool = ThreadPoolExecutor()
+# The blocking work of the web handlers runs on a few threads off the ioloop.
+web_tasks = TimedExecutor(max_workers=4)
 
 
 def _interrupt():
@@ -139,28 +141,47 @@ def main():
     parser.add_argument("--config", type=str, default="/config", help="Config directory path.")
     parser.add_argument("--routes", type=str, default="/routes", help="Directory with the navigation routes.")
     parser.add_argument("--sessions", type=str, default="/sessions", help="Sessions directory.")
+    parser.add_argument("--cache", type=str, default="/cache", help="Directory for the caches that can be rebuilt, kept out of the sessions shared over ftp.")
+    parser.add_argument("--thumbnail-cache-mb", type=float, default=64, help="Disk space for the logbox thumbnails in megabytes.")
+    parser.add_argument("--route-cache-mb", type=float, default=16, help="Memory for the navigation images of the selected route in megabytes.")
+    parser.add_argument("--route-prefetch-points", type=int, default=1, help="Navigation points on either side of the current one to load ahead.")
     args = parser.parse_args()
 
     # The mongo client is thread-safe and provides for transparent connection pooling.
     _mongo = MongoLogBox(MongoClient())
     _mongo.ensure_indexes()
+    logbox_thumbnails = ThumbnailCache(_mongo, directory=os.path.join(args.cache, "thumbnails"), max_disk_mb=args.thumbnail_cache_mb)
+    # The thumbnails were kept with the sessions before.
+    shutil.rmtree(os.path.join(args.sessions, ".cache", "thumbnails"), ignore_errors=True)
 
-    route_store = ReloadableDataSource(FileSystemRouteDataSource(directory=args.routes, fn_load_image=_load_nav_image, load_instructions=False))
+    # The navigation images are only needed for display and loaded on demand.
+    route_store = ReloadableDataSource(FileSystemRouteDataSource(directory=args.routes, fn_load_image=_load_nav_image, load_instructions=False, cache_mb=args.route_cache_mb, prefetch_points=args.route_prefetch_points))
     route_store.load_routes()
+    watcher = DirectoryWatcher(event=quit_event)
+    route_store.watch(watcher, args.routes)
 
     camera_front = CameraThread(url="ipc:///byodr/camera_0.sock", topic=b"aav/camera/0", event=quit_event)
     camera_rear = CameraThread(url="ipc:///byodr/camera_1.sock", topic=b"aav/camera/1", event=quit_event)
-    pilot = json_collector(url="ipc:///byodr/pilot.sock", topic=b"aav/pilot/output", event=quit_event, hwm=20)
-    following_comm_socket = json_collector(url="ipc:///byodr/following.sock", topic=b"aav/following/controls", event=quit_event, hwm=1)
-    vehicle = json_collector(url="ipc:///byodr/vehicle.sock", topic=b"aav/vehicle/state", event=quit_event, hwm=20)
-    inference = json_collector(url="ipc:///byodr/inference.sock", topic=b"aav/inference/state", event=quit_event, hwm=20)
+    collector = PollingCollectorThread(event=quit_event)
+    pilot = collector.add(JSONReceiver(url="ipc:///byodr/pilot.sock", topic=b"aav/pilot/output", hwm=20))
+    following_comm_socket = collector.add(JSONReceiver(url="ipc:///byodr/following.sock", topic=b"aav/following/controls", hwm=1))
+    vehicle = collector.add(JSONReceiver(url="ipc:///byodr/vehicle.sock", topic=b"aav/vehicle/state", hwm=20))
+    inference = collector.add(JSONReceiver(url="ipc:///byodr/inference.sock", topic=b"aav/inference/state", hwm=20))
     teleop_publisher = JSONPublisher(url="ipc:///byodr/teleop.sock", topic="aav/teleop/input")
     chatter = JSONPublisher(url="ipc:///byodr/teleop_c.sock", topic="aav/teleop/chatter")
     zm_client = JSONZmqClient(urls=["ipc:///byodr/pilot_c.sock", "ipc:///byodr/inference_c.sock", "ipc:///byodr/vehicle_c.sock", "ipc:///byodr/relay_c.sock", "ipc:///byodr/camera_c.sock"])
 
+    # The camera sockets share the encoded frames.
+    front_frames = JPEGFrameCache(image_capture=(lambda: camera_front.capture()))
+    rear_frames = JPEGFrameCache(image_capture=(lambda: camera_rear.capture()))
+    camera_front.add_listener(front_frames.on_frame)
+    camera_rear.add_listener(rear_frames.on_frame)
+
     logbox_user = SharedUser()
     logbox_state = SharedState(channels=(camera_front, (lambda: pilot.get()), (lambda: vehicle.get()), (lambda: inference.get())), hz=16)
-    log_application = LogApplication(_mongo, logbox_user, logbox_state, event=quit_event, config_dir=args.config)
+    # Mongo writes and image encoding are kept off the logging loop.
+    logbox_writer = EventWriter(_mongo, event=quit_event)
+    log_application = LogApplication(logbox_writer, logbox_user, logbox_state, event=quit_event, config_dir=args.config)
     package_application = PackageApplication(_mongo, logbox_user, event=quit_event, hz=0.100, sessions_dir=args.sessions)
     throttle_controller = ThrottleController(teleop_publisher, route_store)
     application = TeleopApplication(tel_chatter=chatter, throttle_controller=throttle_controller, fol_comm_socket=following_comm_socket, event=quit_event, config_dir=args.config, hz=20)
@@ -168,7 +189,7 @@ def main():
     logbox_thread = threading.Thread(target=log_application.run)
     package_thread = threading.Thread(target=package_application.run)
 
-    threads = [camera_front, camera_rear, pilot, following_comm_socket, vehicle, inference, logbox_thread, package_thread, threading.Thread(target=application.run)]
+    threads = [camera_front, camera_rear, collector, watcher, logbox_writer, logbox_thread, package_thread, threading.Thread(target=application.run)]
     application.setup()
     if quit_event.is_set():
         return 0
@@ -199,21 +220,22 @@ def main():
                 (r"/(menu_logbox)", TemplateRenderer),
                 (r"/(menu_settings)", TemplateRenderer),
                 (r"/run_get_SSID", GetSegmentSSID),
-                (r"/latest_image", LatestImageHandler, {"path": "/byodr/yolo_person", "following_utils": application.following_utils}),
+                (r"/latest_image", LatestImageHandler, {"path": "/byodr/yolo_person", "following_utils": application.following_utils, "tasks": web_tasks}),
                 (r"/fol_handler", FollowingHandler, dict(fn_control=application.following_utils)),
                 (r"/ws/switch_confidence", ConfidenceHandler, dict(inference_s=inference, vehicle_s=vehicle)),
-                (r"/api/datalog/event/v10/table", DataTableRequestHandler, dict(mongo_box=_mongo)),
-                (r"/api/datalog/event/v10/image", JPEGImageRequestHandler, dict(mongo_box=_mongo)),
+                (r"/api/datalog/event/v10/table", DataTableRequestHandler, dict(mongo_box=_mongo, tasks=web_tasks)),
+                (r"/api/datalog/event/v10/image", JPEGImageRequestHandler, dict(thumbnails=logbox_thumbnails, tasks=web_tasks)),
                 # Get movement commands from the controller in normal UI
                 (r"/ws/ctl", ControlServerSocket, dict(fn_control=throttle_controller.throttle_control)),
                 (r"/ws/log", MessageServerSocket, dict(fn_state=(lambda: (pilot.peek(), vehicle.peek(), inference.peek())))),
-                (r"/ws/cam/front", CameraMJPegSocket, dict(image_capture=(lambda: camera_front.capture()))),
-                (r"/ws/cam/rear", CameraMJPegSocket, dict(image_capture=(lambda: camera_rear.capture()))),
-                (r"/ws/nav", NavImageHandler, dict(fn_get_image=(lambda image_id: endpoint_handlers.get_navigation_image(image_id)))),
+                (r"/ws/cam/front", CameraMJPegSocket, dict(frame_cache=front_frames)),
+                (r"/ws/cam/rear", CameraMJPegSocket, dict(frame_cache=rear_frames)),
+                (r"/ws/nav", NavImageHandler, dict(fn_get_image=(lambda image_id: endpoint_handlers.get_navigation_image(image_id)), tasks=web_tasks)),
                 # Get or save the options for the user
                 (r"/teleop/user/options", ApiUserOptionsHandler, dict(user_options=(UserOptions(application.get_user_config_file())), fn_on_save=endpoint_handlers.on_options_save)),
                 (r"/teleop/system/state", JSONMethodDumpRequestHandler, dict(fn_method=endpoint_handlers.list_process_start_messages)),
                 (r"/teleop/system/capabilities", JSONMethodDumpRequestHandler, dict(fn_method=endpoint_handlers.list_service_capabilities)),
+                (r"/teleop/system/latency", JSONMethodDumpRequestHandler, dict(fn_method=web_tasks.get_metrics)),
                 (r"/teleop/navigation/routes", JSONNavigationHandler, dict(route_store=route_store)),
                 # Path to where the static files are stored (JS,CSS, images)
                 (r"/(.*)", web.StaticFileHandler, {"path": htm_folder}),
@@ -230,13 +252,17 @@ def main():
     except KeyboardInterrupt:
         quit_event.set()
     finally:
-        _mongo.close()
         _periodic.stop()
 
     route_store.quit()
+    front_frames.quit()
+    rear_frames.quit()
+    web_tasks.quit()
 
     logger.info("Waiting on threads to stop.")
     [t.join() for t in threads]
+    # The logbox writer inserts the remaining events before it stops.
+    _mongo.close()
 
 
 if __name__ == "__main__":
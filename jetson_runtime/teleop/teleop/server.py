@@ -2,6 +2,7 @@
 
 from __future__ import absolute_import
 
+import asyncio
 import collections
 import fcntl
 import json
@@ -10,6 +11,7 @@ import os
 import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from io import open
 
 import cv2
@@ -18,6 +20,7 @@ import tornado
 import tornado.ioloop
 import tornado.web
 from BYODR_utils.common import timestamp
+from BYODR_utils.common.executor import CoalescingExecutor
 from BYODR_utils.common.ssh import Router
 from six.moves import range
 from six.moves.configparser import SafeConfigParser
@@ -33,12 +36,27 @@ import tornado.websocket
 latest_message = {}
 
 
+def _read_latest_image(directory):
+    # Fetch all jpg files in the directory and take the latest by creation time.
+    full_paths = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".jpg")]
+    if not full_paths:
+        return None
+    with open(max(full_paths, key=os.path.getctime), "rb") as img:
+        # Lock the file while reading to prevent conflicts
+        fcntl.flock(img, fcntl.LOCK_SH)
+        try:
+            return img.read()
+        finally:
+            fcntl.flock(img, fcntl.LOCK_UN)
+
+
 class LatestImageHandler(tornado.web.RequestHandler):
-    def initialize(self, path, following_utils):
+    def initialize(self, path, following_utils, tasks):
         self.image_save_path = path
         self.following_utils = following_utils  # Store the passed following_utils
+        self._tasks = tasks
 
-    def get(self):
+    async def get(self):
         # Use the following_utils to get the current following state
         following_state = self.following_utils.get_following_state()
 
@@ -56,31 +74,16 @@ class LatestImageHandler(tornado.web.RequestHandler):
         self.set_header("Expires", "0")
 
         try:
-            # Fetch all jpg files in the directory
-            image_files = [f for f in os.listdir(self.image_save_path) if f.endswith(".jpg")]
-
-            # Get full paths for the images
-            full_paths = [os.path.join(self.image_save_path, f) for f in image_files]
-
-            # Sort by creation time (latest first)
-            full_paths.sort(key=os.path.getctime, reverse=True)
-
-            if full_paths:
-                latest_image = full_paths[0]
-
-                # Try to read and serve the image
-                try:
-                    with open(latest_image, "rb") as img:
-                        # Lock the file while reading to prevent conflicts
-                        fcntl.flock(img, fcntl.LOCK_SH)
-                        self.write(img.read())
-                        fcntl.flock(img, fcntl.LOCK_UN)
-                except IOError:
-                    # Handle IO errors
-                    self.write("Error accessing the image file.")
-                    self.set_status(500)  # Internal Server Error
+            # The directory listing and file read are done off the ioloop.
+            image = await self._tasks.run("latest_image", _read_latest_image, self.image_save_path)
+            if image is not None:
+                self.write(image)
             else:
                 self.write("No images available.")
+        except IOError:
+            # Handle IO errors
+            self.write("Error accessing the image file.")
+            self.set_status(500)  # Internal Server Error
         except Exception as e:
             self.write(f"Error fetching the latest image: {str(e)}")
             self.set_status(500)  # Internal Server Error
@@ -294,13 +297,148 @@ def jpeg_encode(image, quality=95):
     return cv2.imencode(".jpg", image, [int(cv2.IMWRITE_JPEG_QUALITY), quality])[1]
 
 
+class StreamQuality(object):
+    """
+    Lowers the jpeg quality and then the resolution of a pushed stream while the client falls behind.
+    Both are raised again, one step at a time, once the frames keep going out well within the frame period.
+    """
+
+    def __init__(self, max_quality=50, min_quality=10, step=5, min_scale=0.25, patience=10):
+        self._max_quality = max_quality
+        self._min_quality = min_quality
+        self._step = step
+        self._min_scale = min_scale
+        self._patience = patience
+        self._quality = max_quality
+        self._scale = 1.0
+        self._num_good = 0
+
+    def set_max_quality(self, quality):
+        self._max_quality = max(self._min_quality, min(100, int(quality)))
+        self._quality = min(self._quality, self._max_quality)
+
+    def get(self):
+        return self._quality, self._scale
+
+    def on_behind(self):
+        self._num_good = 0
+        if self._quality > self._min_quality:
+            self._quality = max(self._min_quality, self._quality - 2 * self._step)
+        elif self._scale > self._min_scale:
+            self._scale = max(self._min_scale, self._scale / 2)
+            self._quality = self._max_quality
+
+    def on_sent(self, duration, period):
+        # The frame must have been flushed in half the period to have room for a larger one.
+        if duration > period:
+            self.on_behind()
+        elif duration < period / 2:
+            self._num_good += 1
+            if self._num_good >= self._patience:
+                self._num_good = 0
+                if self._quality < self._max_quality:
+                    self._quality = min(self._max_quality, self._quality + self._step)
+                elif self._scale < 1:
+                    self._scale = min(1.0, self._scale * 2)
+                    self._quality = self._min_quality
+
+
+class JPEGFrameCache(object):
+    """
+    Encodes each frame of a camera once per quality bucket and scale for all the sockets that show it.
+    The encoding runs on a thread of its own so the ioloop is free to handle the control messages.
+    Sockets that subscribe are pushed the frames as they arrive from the camera.
+    The camera thread hands out an image of its own per frame, from the ring or the message, so the frames are kept without a copy.
+    """
+
+    def __init__(self, image_capture, quality_step=5, max_entries=4):
+        self._fn_capture = image_capture
+        self._quality_step = quality_step
+        self._max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._images = collections.OrderedDict()
+        self._subscribers = set()
+        self._io_loop = None
+
+    def capture(self):
+        return self._fn_capture()
+
+    def quality_bucket(self, quality):
+        _step = self._quality_step
+        return max(_step, min(100, int(round(float(quality) / _step)) * _step))
+
+    @staticmethod
+    def _encode(image, quality, scale):
+        if scale < 1:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return jpeg_encode(image, quality).tobytes()
+
+    def frame(self, frame_time, image):
+        """Returns the image of the frame kept by the cache."""
+        with self._lock:
+            _image = self._images.setdefault(frame_time, image)
+            while len(self._images) > self._max_entries:
+                self._images.popitem(last=False)
+        return _image
+
+    def encode(self, frame_time, image, quality, scale=1.0):
+        """Returns the future of the jpeg bytes of the frame."""
+        _key = (frame_time, self.quality_bucket(quality), scale)
+        _image = self.frame(frame_time, image)
+        with self._lock:
+            future = self._entries.get(_key)
+            if future is None:
+                future = self._executor.submit(self._encode, _image, _key[1], scale)
+                self._entries[_key] = future
+                while len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+            return future
+
+    def subscribe(self, socket):
+        # Called on the ioloop.
+        self._io_loop = tornado.ioloop.IOLoop.current()
+        self._subscribers.add(socket)
+
+    def unsubscribe(self, socket):
+        self._subscribers.discard(socket)
+
+    def _publish(self, md, image):
+        [x.push_frame(md.get("time"), image) for x in list(self._subscribers)]
+
+    def on_frame(self, md, image):
+        # Called on the camera thread.
+        if self._subscribers and self._io_loop is not None:
+            self._io_loop.add_callback(self._publish, md, self.frame(md.get("time"), image))
+
+    def quit(self):
+        self._subscribers.clear()
+        with self._lock:
+            self._images.clear()
+        self._executor.shutdown(wait=False)
+
+
 class CameraMJPegSocket(websocket.WebSocketHandler):
+    """
+    Sends a frame per client request or, once the client asks for it, pushes the frames as they arrive.
+    A pushed frame is dropped while the previous one is still being encoded or written and the stream quality follows the client throughput.
+    """
+
     # noinspection PyAttributeOutsideInit
     def initialize(self, **kwargs):
-        self._fn_capture = kwargs.get("image_capture")
+        self._frames = kwargs.get("frame_cache")
         self._black_img = np.zeros(shape=(320, 240, 3), dtype=np.uint8)
         self._calltrace = collections.deque(maxlen=1)
         self._calltrace.append(timestamp())
+        self._quality = StreamQuality()
+        self._push_period = 0
+        self._frame_period = 0.1
+        self._last_frame = None
+        self._last_push = 0
+        self._sending = False
+        self._writing = False
+        self._num_dropped = 0
 
     def check_origin(self, origin):
         return True
@@ -310,19 +448,66 @@ class CameraMJPegSocket(websocket.WebSocketHandler):
 
     def open(self, *args, **kwargs):
         _width, _height = 640, 480
-        md = self._fn_capture()[0]
+        md = self._frames.capture()[0]
         if md is not None:
             _height, _width, _channels = md["shape"]
         self.write_message(json.dumps(dict(action="init", width=_width, height=_height)))
 
     def on_close(self):
-        pass
+        self._frames.unsubscribe(self)
+
+    def push_frame(self, frame_time, image):
+        # Called on the ioloop for every frame from the camera.
+        if self._last_frame is not None and frame_time > self._last_frame:
+            self._frame_period = 0.9 * self._frame_period + 0.1 * (frame_time - self._last_frame) * 1e-6
+        self._last_frame = frame_time
+        if time.time() - self._last_push < self._push_period:
+            return
+        if self._sending:
+            # Only the frames dropped on the write backlog mean the client is behind, not those waiting on the encoder.
+            if self._writing:
+                self._num_dropped += 1
+            return
+        self._last_push = time.time()
+        self._sending = True
+        tornado.ioloop.IOLoop.current().spawn_callback(self._send_frame, frame_time, image)
 
-    def on_message(self, message):
+    async def _send_frame(self, frame_time, image):
+        try:
+            quality, scale = self._quality.get()
+            chunk = await asyncio.wrap_future(self._frames.encode(frame_time, image, quality, scale))
+            _start = time.time()
+            self._writing = True
+            await self.write_message(chunk, binary=True)
+            self._writing = False
+            if self._num_dropped > 0:
+                self._quality.on_behind()
+            else:
+                self._quality.on_sent(time.time() - _start, max(self._push_period, self._frame_period))
+            self._num_dropped = 0
+        except websocket.WebSocketClosedError:
+            self._frames.unsubscribe(self)
+        except Exception as e:
+            logger.error("Camera socket@push: {} {}".format(e, traceback.format_exc()))
+        finally:
+            self._sending = False
+            self._writing = False
+
+    async def on_message(self, message):
         try:
             request = json.loads(message)
             quality = int(request.get("quality", 90))
-            md, img = self._fn_capture()
+            action = request.get("action")
+            if action == "push":
+                _fps = float(request.get("fps", 0))
+                self._push_period = 1.0 / _fps if _fps > 0 else 0
+                self._quality.set_max_quality(quality)
+                self._frames.subscribe(self)
+                return
+            if action == "pull":
+                self._frames.unsubscribe(self)
+                return
+            md, img = self._frames.capture()
             _timestamp = self._calltrace[-1] if md is None else md.get("time")
             if _timestamp == self._calltrace[-1]:
                 # Refrain from encoding and resending an old image.
@@ -330,10 +515,10 @@ class CameraMJPegSocket(websocket.WebSocketHandler):
             else:
                 # Always send something so the client is able to resume polling.
                 self._calltrace.append(_timestamp)
-                self.write_message(
-                    jpeg_encode((self._black_img if img is None else img), quality).tobytes(),
-                    binary=True,
-                )
+                chunk = await asyncio.wrap_future(self._frames.encode(_timestamp, (self._black_img if img is None else img), quality))
+                self.write_message(chunk, binary=True)
+        except websocket.WebSocketClosedError:
+            pass
         except Exception as e:
             logger.error("Camera socket@on_message: {} {}".format(e, traceback.format_exc()))
             logger.error("JSON message:---\n{}\n---".format(message))
@@ -343,24 +528,27 @@ class NavImageHandler(web.RequestHandler):
     # noinspection PyAttributeOutsideInit
     def initialize(self, **kwargs):
         self._fn_get_image = kwargs.get("fn_get_image")
+        self._tasks = kwargs.get("tasks")
         self._black_img = np.zeros(shape=(1, 1, 3), dtype=np.uint8)
         self._jpeg_quality = 95
 
     def data_received(self, chunk):
         pass
 
-    @tornado.gen.coroutine
-    def get(self):
+    def _load(self, image_id):
+        image = self._fn_get_image(image_id)
+        image = self._black_img if image is None else image
+        return jpeg_encode(image, quality=self._jpeg_quality).tobytes()
+
+    async def get(self):
         try:
             image_id = int(self.get_query_argument("im"))
         except ValueError:
             image_id = -1
-        image = self._fn_get_image(image_id)
-        image = self._black_img if image is None else image
-        chunk = jpeg_encode(image, quality=self._jpeg_quality)
+        chunk = await self._tasks.run("nav_image", self._load, image_id)
         self.set_header("Content-Type", "image/jpeg")
         self.set_header("Content-Length", len(chunk))
-        self.write(chunk.tobytes())
+        self.write(chunk)
 
 
 class UserOptions(object):
@@ -456,9 +644,13 @@ class UnknownPointNavigationRequestError(Exception):
         super(UnknownPointNavigationRequestError, self).__init__(args, kwargs)
 
 
+# Requests for the same route store operation are coalesced while one is pending.
+route_tasks = CoalescingExecutor(max_workers=1)
+
+
 def delayed_open(store, route_name):
     if store.get_selected_route() != route_name:
-        threading.Thread(target=store.open, args=(route_name,)).start()
+        route_tasks.submit(store.open, route_name)
 
 
 class JSONNavigationHandler(JSONRequestHandler):
@@ -473,7 +665,8 @@ class JSONNavigationHandler(JSONRequestHandler):
             _selected = self._store.get_selected_route()
             _response = {"routes": sorted(_routes), "selected": _selected}
             self.write(json.dumps(_response))
-            threading.Thread(target=self._store.load_routes).start()
+            if not self._store.is_watched():
+                route_tasks.submit(self._store.load_routes)
         else:
             self.write(json.dumps({}))
 
@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+
+import cv2
+import numpy as np
+import tornado.ioloop
+
+from .server import CameraMJPegSocket, JPEGFrameCache, StreamQuality
+
+
+def _image(value=0):
+    return np.full((48, 64, 3), value, dtype=np.uint8)
+
+
+def _decode(chunk):
+    return cv2.imdecode(np.frombuffer(chunk, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def test_jpeg_frame_cache_encodes_once():
+    frames = JPEGFrameCache(image_capture=(lambda: (None, None)), quality_step=5)
+    try:
+        image = _image()
+        # Qualities in the same bucket share the encoding.
+        assert frames.encode(1, image, 48) is frames.encode(1, image, 50)
+        assert frames.encode(1, image, 80) is not frames.encode(1, image, 50)
+        assert frames.encode(1, image, 50, scale=0.5) is not frames.encode(1, image, 50)
+        assert _decode(frames.encode(1, image, 50, scale=0.5).result()).shape == (24, 32, 3)
+    finally:
+        frames.quit()
+
+
+def test_jpeg_frame_cache_keeps_the_frame():
+    frames = JPEGFrameCache(image_capture=(lambda: (None, None)))
+    try:
+        image = _image(0)
+        # The camera hands out an image per frame, the cache keeps it as is.
+        assert frames.frame(1, image) is image
+        # Later encodings of the frame come from the image kept first.
+        assert frames.frame(1, _image(255)) is image
+        assert _decode(frames.encode(1, _image(255), 50).result()).max() < 16
+    finally:
+        frames.quit()
+
+
+def test_jpeg_frame_cache_bounded():
+    frames = JPEGFrameCache(image_capture=(lambda: (None, None)), max_entries=2)
+    try:
+        [frames.encode(i, _image(i), 50).result() for i in range(5)]
+        assert list(frames._entries) == [(3, 50, 1.0), (4, 50, 1.0)]
+        assert list(frames._images) == [3, 4]
+    finally:
+        frames.quit()
+
+
+def test_stream_quality_follows_the_client():
+    quality = StreamQuality(max_quality=50, min_quality=10, step=5, min_scale=0.25, patience=2)
+    # The quality goes down first and then the resolution.
+    [quality.on_behind() for _ in range(2)]
+    assert quality.get() == (30, 1.0)
+    [quality.on_behind() for _ in range(2)]
+    assert quality.get() == (10, 1.0)
+    quality.on_behind()
+    assert quality.get() == (50, 0.5)
+    # A frame written within half the period counts towards a step up.
+    quality.on_sent(0.01, 0.1)
+    assert quality.get() == (50, 0.5)
+    quality.on_sent(0.01, 0.1)
+    assert quality.get() == (10, 1.0)
+    quality.on_sent(0.2, 0.1)
+    assert quality.get() == (50, 0.5)
+
+
+def test_jpeg_frame_cache_publishes_the_frame():
+    frames = JPEGFrameCache(image_capture=(lambda: (None, None)))
+    _pushed = []
+
+    class _Socket(object):
+        def push_frame(self, frame_time, image):
+            _pushed.append((frame_time, image))
+
+    io_loop = tornado.ioloop.IOLoop()
+    try:
+        frames._io_loop = io_loop
+        frames._subscribers.add(_Socket())
+        image = _image(0)
+        frames.on_frame(dict(time=1), image)
+        io_loop.run_sync(lambda: None)
+        assert [t for t, _ in _pushed] == [1]
+        assert _pushed[0][1] is image and frames.frame(1, _image(255)) is image
+    finally:
+        frames.quit()
+        io_loop.close()
+
+
+def test_camera_socket_counts_the_write_backlog():
+    socket = CameraMJPegSocket.__new__(CameraMJPegSocket)
+    socket.initialize(frame_cache=None)
+    socket._sending = True
+    # A frame dropped while the previous one is encoded says nothing of the client.
+    socket.push_frame(1, None)
+    assert socket._num_dropped == 0
+    socket._writing = True
+    socket.push_frame(2, None)
+    assert socket._num_dropped == 1
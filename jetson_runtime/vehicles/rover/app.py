@@ -8,7 +8,7 @@ import shutil
 import subprocess
 
 from BYODR_utils.common import Application, Configurable, PeriodicCallTrace, timestamp
-from BYODR_utils.common.ipc import ImagePublisher, JSONPublisher, LocalIPCServer, ReceiverThread, json_collector
+from BYODR_utils.common.ipc import JSONPublisher, JSONReceiver, LocalIPCServer, PollingCollectorThread, ReceiverThread, SharedMemoryImagePublisher
 from BYODR_utils.common.location import GeoTracker
 from BYODR_utils.common.option import hash_dict, parse_option
 from configparser import ConfigParser as SafeConfigParser
@@ -156,8 +156,9 @@ class RoverHandler(Configurable):
         self._platform.restart(**kwargs)
         errors.extend(self._platform.get_errors())
         if not self._gst_sources:
-            front_camera = ImagePublisher(url="ipc:///byodr/camera_0.sock", topic="aav/camera/0")
-            rear_camera = ImagePublisher(url="ipc:///byodr/camera_1.sock", topic="aav/camera/1")
+            # The frames are written once to shared memory and read in place by inference, teleop and the logbox.
+            front_camera = SharedMemoryImagePublisher(url="ipc:///byodr/camera_0.sock", topic="aav/camera/0")
+            rear_camera = SharedMemoryImagePublisher(url="ipc:///byodr/camera_1.sock", topic="aav/camera/1")
             self._gst_sources.append(ConfigurableImageGstSource("front", image_publisher=front_camera))
             self._gst_sources.append(ConfigurableImageGstSource("rear", image_publisher=rear_camera))
         if not self._ptz_cameras:
@@ -357,12 +358,13 @@ def main():
     quit_event = application.quit_event
 
     # Sockets used to receive data from pilot and teleop.
-    pilot = json_collector(url="ipc:///byodr/pilot.sock", topic=b"aav/pilot/output", event=quit_event)
-    teleop = json_collector(url="ipc:///byodr/teleop.sock", topic=b"aav/teleop/input", event=quit_event)
-    ipc_chatter = json_collector(url="ipc:///byodr/teleop_c.sock", topic=b"aav/teleop/chatter", pop=True, event=quit_event)
+    collector = PollingCollectorThread(event=quit_event)
+    pilot = collector.add(JSONReceiver(url="ipc:///byodr/pilot.sock", topic=b"aav/pilot/output"))
+    teleop = collector.add(JSONReceiver(url="ipc:///byodr/teleop.sock", topic=b"aav/teleop/input"))
+    ipc_chatter = collector.add(JSONReceiver(url="ipc:///byodr/teleop_c.sock", topic=b"aav/teleop/chatter", pop=True))
 
     # Sockets used to send data to other services
-    application.state_publisher = JSONPublisher(url="ipc:///byodr/vehicle.sock", topic="aav/vehicle/state")
+    application.state_publisher = JSONPublisher(url="ipc:///byodr/vehicle.sock", topic="aav/vehicle/state", codec="msgpack")
     application.ipc_server = LocalIPCServer(url="ipc:///byodr/vehicle_c.sock", name="platform", event=quit_event)
 
     # Getting data from the received sockets declared above
@@ -371,7 +373,7 @@ def main():
     application.ipc_chatter = lambda: ipc_chatter.get()
 
     # Starting the socket threads
-    threads = [pilot, teleop, ipc_chatter, application.ipc_server]
+    threads = [collector, application.ipc_server]
     if quit_event.is_set():
         return 0
 
@@ -255,6 +255,7 @@ class MainApplication(Application):
         self._integrity = MessageStreamProtocol(max_age_ms=200, max_delay_ms=200)
         self._cmd_history = CommandHistory(hz=hz)
         self._config_queue = collections.deque(maxlen=1)
+        # The drive commands are queued with their trace and the time they were received.
         self._drive_queue = collections.deque(maxlen=4)
         self._last_drive_command = None
         self._chassis = None
@@ -285,39 +286,42 @@ class MainApplication(Application):
         return self._config_queue.popleft() if bool(self._config_queue) else None
 
     def _pop_drive(self):
-        """Get one command from one end of the drive queue"""
+        """Get one command from one end of the drive queue with the trace it came with and the time it was received"""
         # This case happens when booting for the first time and PIL didn't send anything yet
         if not self._drive_queue:
+            # The trace of a repeated command has already been returned.
             if self._last_drive_command:
                 # If the queue is empty and there's a last known command, return it instead of None
-                return self._last_drive_command
+                return self._last_drive_command, None, None
             else:
                 # A default command if no commands have ever been received
-                return {"steering": 0.0, "throttle": 0.0, "reverse": 0, "wakeup": 0}
+                return {"steering": 0.0, "throttle": 0.0, "reverse": 0, "wakeup": 0}, None, None
         else:
             # Pop the command from the queue and update the last known command
-            self._last_drive_command = self._drive_queue.popleft()
-            return self._last_drive_command
+            self._last_drive_command, _trace, _received = self._drive_queue.popleft()
+            return self._last_drive_command, _trace, _received
 
     def _on_message(self, message):
         self._integrity.on_message(message.get("time"))
         if message.get("method") == "ras/driver/config":
             self._config_queue.appendleft(message.get("data"))
         else:
-            self._drive_queue.appendleft(message.get("data"))
+            self._drive_queue.appendleft((message.get("data"), message.get("trace"), timestamp()))
 
     def finish(self):
         self._chassis.quit()
         self._odometer.quit()
 
     def step(self):
+        _step_start = timestamp()
         n_violations = self._integrity.check()
         if n_violations > 5:
             self._chassis.relay_violated(on_integrity=True)
             self._integrity.reset()
             return
 
-        c_config, c_drive = self._pop_config(), self._pop_drive()
+        c_config = self._pop_config()
+        c_drive, _trace, _received = self._pop_drive()
         # print(c_drive)
         self._chassis.set_configuration(c_config)
 
@@ -339,6 +343,9 @@ class MainApplication(Application):
             _data.update(dict(velocity=self._chassis.velocity()))
         elif self._odometer.is_enabled():
             _data.update(dict(velocity=self._odometer.velocity()))
+        if _trace is not None:
+            # Return the trace of the command driven with the durations in microseconds on the pi clock.
+            _data.update(dict(trace=_trace, trace_pi=dict(pi_wait=_step_start - _received, pi_drive=timestamp() - _step_start)))
 
         # Let the communication partner know we are operational.
         self.publisher.publish(data=_data)